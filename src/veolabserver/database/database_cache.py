@@ -0,0 +1,167 @@
+import functools
+import inspect
+import logging
+import threading
+import time
+import pymysql
+from collections import OrderedDict
+from .. import settings
+
+class MappingCache(object):
+    """
+    Caché de datos de referencia (mapeos iGEO -> Veolab) compartida por todas las
+    instancias de DatabaseVeolab del proceso. Acotada en tamaño (LRU) y con
+    caducidad (TTL). Cada entrada se etiqueta con las tablas de las que depende;
+    una sonda periódica (CHECKSUM TABLE) invalida las entradas de las tablas que
+    han cambiado, para que las ediciones en Veolab se vean sin reiniciar.
+    """
+
+    def __init__(self, max_entries=5000, ttl=300, check_interval=60):
+        self.max_entries = max_entries
+        self.ttl = ttl  # Segundos; 0 desactiva la caché
+        self.check_interval = check_interval  # Segundos entre sondas de cambios
+        self._entries = OrderedDict()  # clave -> (caduca, tablas, valor)
+        self._checksums = {}  # tabla -> último CHECKSUM visto
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._last_probe = 0.0
+        self._last_stats = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key):
+        # Devuelve (encontrado, valor)
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[2]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, tables):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, tuple(tables), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables=None):
+        # Descarta las entradas que dependen de alguna de las tablas (o todas si None)
+        with self._lock:
+            if tables is None:
+                removed = len(self._entries)
+                self._entries.clear()
+            else:
+                tables = set(tables)
+                stale = [k for k, entry in self._entries.items() if tables.intersection(entry[1])]
+                for key in stale:
+                    del self._entries[key]
+                removed = len(stale)
+            self.invalidations += removed
+        return removed
+
+    def tracked_tables(self):
+        with self._lock:
+            return sorted({table for entry in self._entries.values() for table in entry[1]})
+
+    def check_stale(self, cursor):
+        # Sonda barata de cambios: como mucho una vez cada check_interval segundos y
+        # solo para las tablas con entradas en caché. Si otro hilo ya está sondeando,
+        # no espera. No debe llamarse en mitad de una transacción de escritura.
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._last_probe < self.check_interval or not self._probe_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_probe = now
+            tables = self.tracked_tables()
+            if not tables:
+                return
+            cursor.execute("CHECKSUM TABLE " + ", ".join(tables))
+            changed = []
+            for row in cursor.fetchall():
+                table = row['Table'].split('.')[-1].upper()
+                checksum = row['Checksum']
+                previous = self._checksums.get(table)
+                self._checksums[table] = checksum
+                if previous is not None and previous != checksum:
+                    changed.append(table)
+            if changed:
+                removed = self.invalidate(changed)
+                logging.info(f"Mapeos modificados en Veolab ({', '.join(changed)}): {removed} entradas de caché descartadas")
+            if now - self._last_stats >= 600:
+                self._last_stats = now
+                logging.info(f"Caché de mapeos: {self.stats()}")
+        except pymysql.Error as e:
+            logging.warning(f"No se pudo comprobar cambios en las tablas de mapeo: {e}")
+        finally:
+            self._probe_lock.release()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+mapping_cache = MappingCache()
+
+
+def configure():
+    # Aplica VEOLAB_CACHE_* a mapping_cache; se llama al arrancar el servicio
+    mapping_cache.max_entries = settings.env_int('VEOLAB_CACHE_SIZE', 5000, minimum=0)
+    mapping_cache.ttl = settings.env_int('VEOLAB_CACHE_TTL', 300, minimum=0)
+    mapping_cache.check_interval = settings.env_int('VEOLAB_CACHE_CHECK', 60, minimum=1)
+
+
+def mapping_key(name, *args):
+    # Clave de caché de un método de mapeo con sus argumentos posicionales completos
+    return (name, ) + tuple(args)
+
+
+def copy_value(value):
+    # Las filas (dict) se devuelven copiadas para que el llamante no altere la caché
+    return dict(value) if isinstance(value, dict) else value
+
+
+def cached_mapping(*tables):
+    # Decorador para métodos de DatabaseVeolab que resuelven un mapeo iGEO -> Veolab.
+    # El resultado (incluido "no encontrado") se guarda en la caché compartida,
+    # etiquetado con las tablas de las que depende.
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            key = mapping_key(method.__name__, *list(bound.arguments.values())[1:])
+            found, value = mapping_cache.get(key)
+            if not found:
+                value = method(self, *args, **kwargs)
+                mapping_cache.put(key, copy_value(value), tables)
+            return copy_value(value)
+        return wrapper
+    return decorator
@@ -2,26 +2,30 @@ import os
 import sys
 import configparser
 import base64
+import threading
+from collections import namedtuple
 from getpass import getpass
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from dotenv import load_dotenv
 
+# Credenciales ya leídas y descifradas (inmutables), ver DatabaseConfig.snapshot
+ConfigSnapshot = namedtuple('ConfigSnapshot', ['host', 'port', 'database', 'user', 'passwd'])
+
+
 class DatabaseConfig(object):
     """
     Esta clase accede o solicita las credenciales de conexión a la base de datos.
     El archivo config.ini registra la información.    
     """
 
-    load_dotenv()
-
-    KEY_ENV = os.getenv('VEOLAB_AES_KEY')
-    if not KEY_ENV:
-        raise ValueError("Establezca el valor de la clave VEOLAB_AES_KEY en .env")
-    KEY = base64.b64decode(KEY_ENV)
+    KEY = None  # Clave AES (VEOLAB_AES_KEY), se carga al primer uso
     
     FILENAME = 'config.ini'  # Nombre del archivo de configuración
 
+    _snapshot = None  # (mtime de config.ini, ConfigSnapshot)
+    _lock = threading.Lock()
+
     def __init__(self, host=None, port=None, database=None, user=None, passwd=None):        
         self.host = host
         self.port = port
@@ -30,6 +34,38 @@ class DatabaseConfig(object):
         self.passwd = passwd
         self.config_path = os.path.join(os.path.dirname(__file__), self.FILENAME)
 
+    @classmethod
+    def key(cls):
+        if cls.KEY is None:
+            load_dotenv()
+            key_env = os.getenv('VEOLAB_AES_KEY')
+            if not key_env:
+                raise ValueError("Establezca el valor de la clave VEOLAB_AES_KEY en .env")
+            cls.KEY = base64.b64decode(key_env)
+        return cls.KEY
+
+    @classmethod
+    def snapshot(cls):
+        # Configuración del proceso: se lee y descifra una vez y solo se vuelve a
+        # leer si cambia la fecha de modificación de config.ini.
+        config = cls()
+        try:
+            mtime = os.stat(config.config_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with cls._lock:
+            if cls._snapshot is not None and mtime is not None and cls._snapshot[0] == mtime:
+                return cls._snapshot[1]
+            config.read_config()
+            snapshot = ConfigSnapshot(config.host, config.port, config.database, config.user, config.passwd)
+            try:
+                # read_config puede haber pedido los datos y escrito el fichero
+                mtime = os.stat(config.config_path).st_mtime_ns
+            except OSError:
+                mtime = None
+            cls._snapshot = (mtime, snapshot) if mtime is not None else None
+            return snapshot
+
     def input_config(self):
         print("A continuación se solicitarán los datos de conexión.")
         
@@ -61,7 +97,7 @@ class DatabaseConfig(object):
                 passwd_encrypt = bytes.fromhex(config['conection']['passwd'])
                 iv = passwd_encrypt[:AES.block_size]
                 passwd_encrypt = passwd_encrypt[AES.block_size:]
-                cipher = AES.new(self.KEY, AES.MODE_CFB, iv)
+                cipher = AES.new(self.key(), AES.MODE_CFB, iv)
                 self.passwd = cipher.decrypt(passwd_encrypt).decode()
             except (KeyError, ValueError) as e:
                 print("El archivo de configuración es inválido:", e)
@@ -71,7 +107,7 @@ class DatabaseConfig(object):
         config = configparser.ConfigParser()
         
         iv = get_random_bytes(AES.block_size)
-        cipher = AES.new(self.KEY, AES.MODE_CFB, iv)
+        cipher = AES.new(self.key(), AES.MODE_CFB, iv)
         passwd_encrypt = iv + cipher.encrypt(self.passwd.encode())
 
         config['conection'] = {
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from .. import settings
+
+class IdempotencyIndex(object):
+    """
+    Huella (payload_fingerprint) de los últimos datos aplicados a cada operación,
+    en un LRU de max_operations entradas: un UPDATE con los mismos datos que los
+    ya aplicados no escribe nada. Complementa a LABOPE.OPECHSH, que la conserva
+    tras un reinicio.
+    La existencia de una muestra y las reentregas siempre las decide la base de
+    datos: LABOPE puede cambiar por otras vías (Veolab, otra instancia del
+    servicio) y un mismo cuerpo puede llegar legítimamente más de una vez.
+    """
+
+    def __init__(self, max_operations=10000):
+        self.max_operations = max_operations  # 0 lo desactiva
+        self._applied = OrderedDict()  # (DEL3COD, OPE1SER, OPE1COD) -> huella de los datos aplicados
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(json_body):
+        # Huella del mensaje independiente del formato (indentado, orden de claves)
+        canonical = json.dumps(json_body, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def applied_fingerprint(self, operation):
+        # Huella de los últimos datos aplicados a la operación (o None si no se conoce)
+        with self._lock:
+            return self._applied.get(operation)
+
+    def remember_applied(self, operation, fingerprint):
+        if self.max_operations <= 0:
+            return
+        with self._lock:
+            self._applied[operation] = fingerprint
+            self._applied.move_to_end(operation)
+            while len(self._applied) > self.max_operations:
+                self._applied.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'operations': len(self._applied),
+            }
+
+
+idempotency_index = IdempotencyIndex()
+
+
+def configure():
+    # Aplica VEOLAB_UPDATE_FINGERPRINTS a idempotency_index; se llama al arrancar el servicio
+    idempotency_index.max_operations = settings.env_int('VEOLAB_UPDATE_FINGERPRINTS', 10000, minimum=0)
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+import pymysql
+
+class KeyAllocator(object):
+    """
+    Reparte claves técnicas de los contadores de ACCCLT reservando bloques
+    (hi/lo): una sola transacción avanza el contador block_size posiciones y las
+    claves del bloque se sirven desde memoria. Convive con el cliente de Veolab,
+    que usa el mismo contador con SELECT ... FOR UPDATE: tras la reserva el
+    contador ya apunta al final del bloque. Las claves que queden sin usar al
+    parar el servicio se pierden (huecos en la numeración).
+    La reserva usa una conexión propia para confirmarse sin arrastrar la
+    transacción de negocio en curso (p.ej. un lote de muestras).
+    """
+
+    SLOW_WAIT = 0.1  # Segundos de espera a partir de los que una reserva cuenta como contención
+
+    # Contadores que se sincronizan con el máximo real de su tabla en la primera
+    # reserva (y tras detectar una colisión), para no colisionar tras restauraciones,
+    # cambios de serie o limpiezas. Solo para tablas que escribe únicamente este servicio.
+    RECONCILE = {
+        'IGELOG': "SELECT COALESCE(MAX(LOG1COD), 0) AS maximo FROM IGELOG WHERE DEL3COD = %s",
+    }
+
+    def __init__(self, database_factory, block_size=50):
+        self.database_factory = database_factory
+        self.block_size = max(1, block_size)
+        self._ranges = {}  # (delegación, tabla, serie) -> [siguiente, último]
+        self._reconciled = set()  # Claves ya sincronizadas con el máximo real (RECONCILE)
+        self._lock = threading.RLock()
+        self._reserving = False  # Evita reentrar (p.ej. logdb de un fallo al abrir la conexión propia)
+        self._database = None
+        self._last_stats = time.monotonic()
+        self.reservations = 0
+        self.keys_served = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def next_key(self, division, table_name, serial):
+        key = (division, table_name, serial)
+        requested = time.monotonic()
+        with self._lock:
+            current = self._ranges.get(key)
+            if current is None or current[0] > current[1]:
+                if self._reserving:
+                    raise pymysql.Error("Reserva de claves en curso en este hilo")
+                self._reserving = True
+                try:
+                    first, last = self.reserve(division, table_name, serial, self.block_size, key not in self._reconciled)
+                finally:
+                    self._reserving = False
+                self._reconciled.add(key)
+                current = self._ranges[key] = [first, last]
+                self.record_wait(time.monotonic() - requested, key)
+            next_key = current[0]
+            current[0] += 1
+            self.keys_served += 1
+        return next_key
+
+    def resync(self, division, table_name, serial):
+        # Descarta el bloque en memoria y fuerza a resincronizar con el máximo real
+        # en la próxima reserva (p.ej. tras un error de clave duplicada).
+        key = (division, table_name, serial)
+        with self._lock:
+            self._ranges.pop(key, None)
+            self._reconciled.discard(key)
+        logging.warning(f"Contador {key} resincronizado con el máximo real")
+
+    def reserve(self, division, table_name, serial, count, reconcile=False):
+        # Avanza el contador count posiciones en una transacción propia y devuelve
+        # el rango reservado (primero, último). Con reconcile, el bloque empieza
+        # además por encima del máximo real de la tabla (RECONCILE).
+        database = self.connection()
+        for attempt in range(2):
+            try:
+                database.cursor.execute(
+                    "SELECT CLTNVAL FROM ACCCLT WHERE DEL3COD = %s AND CLTCTAB = %s AND CLTCSER = %s FOR UPDATE",
+                    (division, table_name, serial)
+                )
+                row = database.cursor.fetchone()
+                counter = row['CLTNVAL'] if row is not None else 0
+                if reconcile and table_name in self.RECONCILE:
+                    database.cursor.execute(self.RECONCILE[table_name], (division, ))
+                    counter = max(counter, database.cursor.fetchone()['maximo'])
+                first = counter + 1
+                last = first + count - 1
+                if row is None:
+                    query = "INSERT INTO ACCCLT (CLTNVAL, DEL3COD, CLTCTAB, CLTCSER) VALUES (%s, %s, %s, %s)"
+                else:
+                    query = "UPDATE ACCCLT SET CLTNVAL = %s WHERE DEL3COD = %s AND CLTCTAB = %s AND CLTCSER = %s"
+                database.cursor.execute(query, (last, division, table_name, serial))
+                database.connection.commit()
+                return first, last
+            except pymysql.IntegrityError:
+                # Otro proceso creó el contador a la vez: se reintenta ya como UPDATE
+                database.connection.rollback()
+                if attempt == 1:
+                    raise
+            except pymysql.Error:
+                try:
+                    database.connection.rollback()
+                except pymysql.Error:
+                    pass
+                raise
+
+    def connection(self):
+        if self._database is None:
+            self._database = self.database_factory()
+        self._database.ensure_connection()
+        return self._database
+
+    def record_wait(self, waited, key):
+        self.reservations += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if waited >= self.SLOW_WAIT:
+            self.contended += 1
+            logging.warning(f"Reserva de claves {key} esperó {waited * 1000:.0f} ms (contador bloqueado)")
+        now = time.monotonic()
+        if now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Claves técnicas: {self.stats()}")
+
+    def stats(self):
+        return {
+            'block_size': self.block_size,
+            'reservations': self.reservations,
+            'keys_served': self.keys_served,
+            'contended': self.contended,
+            'wait_avg_ms': round(self.wait_total / self.reservations * 1000, 1) if self.reservations else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 1),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._database is not None:
+                self._database.close()
+                self._database = None
@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+import time
+from .. import settings
+
+class LogWriter(object):
+    """
+    Escribe las líneas de IGELOG en segundo plano, con su propia conexión, para
+    que un IGELOG lento no frene la transacción de negocio. Las líneas llegan por
+    una cola acotada y se vuelcan con INSERT multi-fila cada flush_size líneas o
+    cada flush_interval segundos. Si la cola se llena, la línea queda solo en el
+    log de Python. Al parar se vuelca lo pendiente.
+    """
+
+    def __init__(self, max_queue=10000, flush_size=100, flush_interval=0.5):
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = None
+        self._database_factory = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, database_factory):
+        if self.running:
+            return
+        self._database_factory = database_factory
+        self._thread = threading.Thread(target=self._run, name="igelog-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        logging.info(f"Escritor de IGELOG detenido: {self.stats()}")
+
+    def submit(self, record):
+        # record: (DEL3COD, LOGTFEC, LOGCTIP, LOGCDES, LOGCDET). Devuelve False si la
+        # cola está llena (la línea ya se ha emitido por el log de Python).
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Cola de IGELOG llena; línea no registrada en Veolab: {record[2]} {record[3]} - {record[4]}")
+            return False
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        database = self._database_factory()
+        pending = []
+        deadline = None
+        stopping = False
+        try:
+            while not stopping:
+                timeout = self.flush_interval if deadline is None else max(0, deadline - time.monotonic())
+                try:
+                    record = self._queue.get(timeout=timeout)
+                    if record is None:
+                        stopping = True
+                    else:
+                        pending.append(record)
+                        if deadline is None:
+                            deadline = time.monotonic() + self.flush_interval
+                except queue.Empty:
+                    pass
+                if pending and (stopping or len(pending) >= self.flush_size or time.monotonic() >= deadline):
+                    self._flush(database, pending)
+                    pending = []
+                    deadline = None
+        finally:
+            database.close()
+
+    def _flush(self, database, records):
+        try:
+            database.ensure_connection()
+            database.write_log_records(records)
+            database.connection.commit()
+            self.written += len(records)
+        except Exception as e:
+            self.failed += len(records)
+            try:
+                database.connection.rollback()
+            except Exception:
+                pass
+            logging.error(f"No se pudieron registrar {len(records)} líneas en IGELOG: {e}")
+            for record in records:
+                logging.error(f"Línea IGELOG perdida: {record}")
+
+
+log_writer = LogWriter()
+
+
+def configure():
+    # Aplica VEOLAB_LOG_* a log_writer; se llama al arrancar el servicio, antes de start()
+    log_writer.flush_size = settings.env_int('VEOLAB_LOG_FLUSH_SIZE', 100, minimum=1)
+    log_writer.flush_interval = settings.env_int('VEOLAB_LOG_FLUSH_MS', 500, minimum=10) / 1000
+    if not log_writer.running:
+        log_writer._queue = queue.Queue(maxsize=settings.env_int('VEOLAB_LOG_QUEUE', 10000, minimum=1))
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+import pymysql
+
+class ConnectionPool(object):
+    """
+    Pool de conexiones a Veolab (objetos DatabaseVeolab ya abiertos) compartido
+    por todos los hilos del servicio. Abrir una conexión relee config.ini,
+    descifra la contraseña, conecta y vuelve a leer serie y delegación; el pool
+    lo hace una vez por conexión y la reutiliza.
+      - Hasta size conexiones abiertas a la vez; si no hay ninguna libre, acquire
+        espera hasta wait_timeout segundos.
+      - Una conexión que lleva más de validate_idle segundos sin usarse se
+        comprueba (ping) al sacarla del pool; con más de idle_timeout se cierra.
+      - Si no se puede conectar, los siguientes intentos se espacian con backoff
+        (retry_delay, 2x, ... hasta max_retry_delay) en lugar de reintentar en
+        cada llamada.
+    Los componentes que mantienen una conexión propia (escritor de IGELOG,
+    reserva de claves, hilos de muestras...) la sacan del pool y la devuelven
+    al parar, así que también cuentan para size.
+    """
+
+    def __init__(self, connect, size=16, wait_timeout=30, validate_idle=30, idle_timeout=600,
+                 retry_delay=1, max_retry_delay=60):
+        self.connect = connect  # connect() -> DatabaseVeolab abierto (connection None si falla)
+        self.size = max(1, size)
+        self.wait_timeout = wait_timeout
+        self.validate_idle = validate_idle
+        self.idle_timeout = idle_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._idle = []  # [(database, devuelta_en)], la última devuelta al final
+        self._open = 0
+        self._available = threading.Condition()
+        self._delay = retry_delay
+        self._next_attempt = 0.0
+        self._last_stats = time.monotonic()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.created = 0
+        self.validated = 0
+        self.discarded = 0
+        self.failures = 0
+
+    @property
+    def circuit_open(self):
+        # True mientras no se intenta conectar a MySQL por el backoff tras un fallo
+        with self._available:
+            return time.monotonic() < self._next_attempt
+
+    def acquire(self):
+        # Devuelve una conexión del pool (o una nueva si hay hueco). Lanza
+        # pymysql.Error si no se consigue ninguna.
+        requested = time.monotonic()
+        with self._available:
+            while True:
+                self.close_expired()
+                if self._idle:
+                    database, released = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    database, released = None, None
+                    self._open += 1
+                    break
+                remaining = self.wait_timeout - (time.monotonic() - requested)
+                if remaining <= 0:
+                    self.waits += 1
+                    raise pymysql.Error(f"No hay conexiones libres en el pool ({self.size} en uso)")
+                self._available.wait(remaining)
+            self.checkouts += 1
+        self.record_wait(time.monotonic() - requested)
+        try:
+            if database is not None and time.monotonic() - released >= self.validate_idle:
+                database = self.validate(database)
+            if database is None:
+                database = self.create()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+        database.pool = self
+        database.released = False
+        self.log_stats()
+        return database
+
+    def release(self, database, discard=False):
+        # Devuelve una conexión al pool. Lo que quedara sin confirmar se deshace para
+        # que el siguiente usuario empiece limpio; si eso falla, se descarta.
+        if database.pool is not self:
+            return
+        database.pool = None
+        database.released = True
+        if database._batch:
+            database.rollback_batch()
+        if not discard and database.connection is not None:
+            try:
+                database.connection.rollback()
+            except pymysql.Error:
+                discard = True
+        with self._available:
+            if discard or database.connection is None:
+                self._open -= 1
+                self.discarded += 1
+            else:
+                self._idle.append((database, time.monotonic()))
+                database = None
+            self._available.notify()
+        if database is not None:
+            database.disconnect()
+
+    def create(self):
+        now = time.monotonic()
+        with self._available:
+            if now < self._next_attempt:
+                raise pymysql.Error(f"Reconexión a MySQL en espera ({self._next_attempt - now:.0f}s)")
+        database = self.connect()
+        with self._available:
+            if database.connection is None:
+                self.failures += 1
+                self._next_attempt = time.monotonic() + self._delay
+                delay, self._delay = self._delay, min(self.max_retry_delay, self._delay * 2)
+                raise pymysql.Error(f"No se pudo conectar a MySQL; siguiente intento en {delay:.0f}s")
+            self._delay = self.retry_delay
+            self._next_attempt = 0.0
+            self.created += 1
+        return database
+
+    def validate(self, database):
+        # Devuelve la conexión si sigue viva; si no, la cierra y devuelve None
+        self.validated += 1
+        try:
+            database.connection.ping(reconnect=False)
+            return database
+        except pymysql.Error as e:
+            logging.info(f"Conexión del pool caída tras {self.validate_idle}s sin uso; se abre otra: {e}")
+            self.discarded += 1
+            database.disconnect()
+            return None
+
+    def close_expired(self):
+        # Cierra las conexiones libres que llevan más de idle_timeout sin usarse
+        # (con el lock tomado; las más antiguas están al principio)
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+            database, _ = self._idle.pop(0)
+            database.disconnect()
+            self._open -= 1
+            self.discarded += 1
+
+    def close(self):
+        # Cierra las conexiones libres (las que estén en uso se cierran al devolverlas)
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._available.notify_all()
+        for database, _ in idle:
+            database.disconnect()
+
+    def record_wait(self, waited):
+        with self._available:
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if waited >= 0.1:
+                self.waits += 1
+                logging.warning(f"Espera de {waited * 1000:.0f} ms por una conexión del pool ({self.size} en uso)")
+
+    def log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Pool de conexiones: {self.stats()}")
+
+    def stats(self):
+        with self._available:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_avg_ms': round(self.wait_total / self.checkouts * 1000, 1) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 1),
+                'created': self.created,
+                'validated': self.validated,
+                'discarded': self.discarded,
+                'failures': self.failures,
+            }
@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+
+class ReportScanner(object):
+    """
+    Decide en cada ciclo de informes si hace falta la consulta pesada de
+    candidatos (report_rows_query) y sobre cuáles:
+      - Una sonda barata (recuento de LABOPE pendientes y recuento/máximo de
+        LABINF.INFDENV) permite saltar el ciclo si nada ha cambiado desde el
+        anterior y no quedó nada pendiente.
+      - La consulta se limita a informes con INFDENV desde la marca de agua
+        (persistida en disco), salvo un barrido completo cada rescan_interval
+        segundos que recoge lo que la marca no ve (p.ej. una operación que el
+        usuario vuelve a poner pendiente en Veolab con un informe antiguo).
+    """
+
+    def __init__(self, state_file=None, rescan_interval=3600):
+        self.state_file = state_file
+        self.rescan_interval = rescan_interval  # 0: barrido completo en cada ciclo
+        self.watermark = None  # INFDENV a partir del que se buscan candidatos
+        self._signature = None  # Sonda al cierre del último ciclo
+        self._pending = True  # Quedaron informes sin publicar en el último ciclo
+        self._last_full = None
+        self._last_stats = time.monotonic()
+        self.cycles = 0
+        self.skipped = 0
+        self.full_scans = 0
+        self.rows_scanned = 0
+        self.published = 0
+        self.peak_bytes = 0
+        self._cycle = None
+        self.load()
+
+    def load(self):
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, encoding='utf-8') as f:
+                value = json.load(f).get('watermark')
+            self.watermark = datetime.fromisoformat(value) if value else None
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warning(f"No se pudo leer la marca de agua de informes ({self.state_file}): {e}")
+
+    def save(self):
+        if not self.state_file:
+            return
+        try:
+            tmp = self.state_file + ".tmp"
+            with open(tmp, "w", encoding='utf-8') as f:
+                json.dump({'watermark': self.watermark.isoformat() if self.watermark else None}, f)
+            os.replace(tmp, self.state_file)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar la marca de agua de informes ({self.state_file}): {e}")
+
+    def begin(self, database):
+        # Devuelve (hay_que_consultar, desde). desde es None en un barrido completo.
+        self.cycles += 1
+        self._cycle = {'rows': 0, 'published': 0, 'seen': None, 'pending': None, 'peak_bytes': 0}
+        signature = database.get_reports_signature()
+        now = time.monotonic()
+        full = self._last_full is None or self.watermark is None or now - self._last_full >= self.rescan_interval
+        if not full and not self._pending and signature == self._signature:
+            self.skipped += 1
+            self._signature = signature
+            self.log_stats()
+            return False, None
+        self._signature = signature
+        self._pending = True  # Hasta que finish confirme lo contrario
+        if full:
+            self._last_full = now
+            self.full_scans += 1
+            return True, None
+        return True, self.watermark
+
+    def row_seen(self, row):
+        # Fila candidata consultada (se haya podido construir su informe o no)
+        if self._cycle is None:
+            return
+        self._cycle['rows'] += 1
+        if row.get('INFDENV') is not None:
+            value = self.as_datetime(row['INFDENV'])
+            if self._cycle['seen'] is None or value > self._cycle['seen']:
+                self._cycle['seen'] = value
+
+    def row_published(self, row):
+        # Informe publicado y confirmado por el broker
+        if self._cycle is None:
+            return
+        self._cycle['published'] += 1
+
+    def row_pending(self, row):
+        # Informe construido que no se pudo publicar: la marca no lo sobrepasa.
+        # Antes del primer ciclo (p.ej. reintentos de la bandeja) no hay nada que anotar.
+        if self._cycle is None:
+            return
+        if row.get('INFDENV') is not None:
+            value = self.as_datetime(row['INFDENV'])
+            if self._cycle['pending'] is None or value < self._cycle['pending']:
+                self._cycle['pending'] = value
+
+    def track_memory(self, size):
+        # Bytes de informes en memoria (pendientes de confirmar) en este momento
+        if self._cycle is None:
+            return
+        self._cycle['peak_bytes'] = max(self._cycle['peak_bytes'], size)
+
+    def finish(self, database):
+        # La marca avanza hasta el último INFDENV visto, salvo que queden informes
+        # construidos sin publicar: entonces se queda en el más antiguo de ellos para
+        # reintentarlo. Los que no se pudieron construir (datos erróneos) no frenan la
+        # marca; se reintentan en el siguiente barrido completo.
+        cycle = self._cycle
+        self.rows_scanned += cycle['rows']
+        self.published += cycle['published']
+        self.peak_bytes = max(self.peak_bytes, cycle['peak_bytes'])
+        watermark = self.watermark
+        if cycle['pending'] is not None:
+            watermark = cycle['pending']
+        elif cycle['seen'] is not None:
+            watermark = max(cycle['seen'], self.watermark) if self.watermark else cycle['seen']
+        self._pending = cycle['pending'] is not None
+        if cycle['published']:
+            # Publicar cambia la sonda (OPECIGE R -> E): se toma de nuevo al cerrar
+            self._signature = database.get_reports_signature()
+        if watermark != self.watermark:
+            self.watermark = watermark
+            self.save()
+        if cycle['rows']:
+            logging.info(
+                f"Ciclo de informes: {cycle['rows']} candidatos consultados, {cycle['published']} publicados, "
+                f"pico de {cycle['peak_bytes'] / 1048576:.1f} MB de informes en memoria"
+            )
+        self.log_stats()
+
+    @staticmethod
+    def as_datetime(value):
+        if isinstance(value, datetime):
+            return value
+        if isinstance(value, date):
+            return datetime(value.year, value.month, value.day)
+        return datetime.fromisoformat(str(value))
+
+    def log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Búsqueda de informes: {self.stats()}")
+
+    def stats(self):
+        return {
+            'cycles': self.cycles,
+            'skipped': self.skipped,
+            'full_scans': self.full_scans,
+            'rows_scanned': self.rows_scanned,
+            'published': self.published,
+            'peak_mb': round(self.peak_bytes / 1048576, 1),
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+        }
@@ -1,11 +1,95 @@
 import pymysql
 import base64
 import json
+import hashlib
 import logging
+import re
 import time
+import unicodedata
+from functools import lru_cache
 from .database_config import DatabaseConfig
+from .database_keys import KeyAllocator
+from .database_pool import ConnectionPool
+from .database_log import log_writer
+from .database_idempotency import idempotency_index
+from .database_cache import mapping_cache, mapping_key, copy_value, cached_mapping
 from datetime import datetime
 from collections import namedtuple
+from .. import settings
+
+# Columnas de la técnica que devuelve get_parameter, en el orden en que se vuelcan a LABRES
+PARAMETER_COLUMNS = """
+    LABTEC.DEL3COD, LABTEC.TEC1COD, LABTEC.TECCNOM, LABTEC.TECCNOI, LABTEC.TECBCUR, LABTEC.TECDACR, LABTEC.TECCPAR,
+    LABTEC.TECCABR, LABTEC.TECCCAS, LABTEC.TECNPRE, LABTEC.TECCDTO, LABTEC.TECCUNI, LABTEC.TECCLEY, LABTEC.TECCMET,
+    LABTEC.TECCMEA,
+    CASE WHEN LABTYN.TYNCVAL <> '' THEN LABTYN.TYNCVAL ELSE LABTEC.TECCNOR END AS TECCNOR,
+    LABTEC.TECNTIE, LABTEC.TECCLIM, LABTEC.TECCMIN, LABTEC.TECCINC, LABTEC.TECCINS,
+    LABTEC.TECBEXP, LABTEC.SEC2DEL, LABTEC.SEC2COD,
+    LABTYC.TYCNPRE, LABTYC.TYCCDTO
+"""
+
+SelfDefining = namedtuple('SelfDefining', ['division', 'code'])
+SelfDefiningIndex = namedtuple('SelfDefiningIndex', ['by_name', 'by_key'])
+
+
+@lru_cache(maxsize=1024)
+def selfdefining_name(field):
+    # Nombre del autodefinible (AUTCNOM) que corresponde a un campo camelCase de iGEO
+    return re.sub(r'([A-Z])', r' \1', field).capitalize()
+
+
+@lru_cache(maxsize=4096)
+def selfdefining_key(human_name):
+    # Normaliza AUTCNOM como lo compara MySQL (intercalación *_ci): sin distinguir
+    # mayúsculas ni acentos y sin espacios finales.
+    text = unicodedata.normalize('NFKD', human_name)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text.casefold().rstrip()
+
+
+DUPLICATE_KEY = 1062  # Código de error MySQL ER_DUP_ENTRY
+
+# Inserción de valores de autodefinibles (LABOYA)
+LABOYA_VALUES = """
+    INSERT INTO LABOYA (OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD, OYACVAL) 
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+# Clave de queue_rows para LABCOR, que no es un INSERT ... VALUES sino una copia de LABCOT
+LABCOR_FROM_LABCOT = "LABCOR <- LABCOT"
+
+# Tablas hijas de LABOPE que se borran con la operación, en este orden
+DELETE_TABLES = ("LABCOR", "LABOYE", "LABOYD", "LABOYA", "LABOYS", "LABRES")
+
+# Autodefinible cero, obligatorio en toda operación
+SELFDEFINING_ZERO = ('', 0)
+
+# Claves por consulta IN (...) al preparar los informes de un ciclo
+REPORT_CHUNK = 500
+
+
+def tuple_in(columns, keys):
+    # Condición "(c1, c2, ...) IN ((%s, %s, ...), ...)" y sus parámetros
+    row = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    sql = "(" + ", ".join(columns) + ") IN (" + ", ".join([row] * len(keys)) + ")"
+    return sql, [value for key in keys for value in key]
+
+
+def payload_fingerprint(payload, igeo_id):
+    # Huella de los datos de una muestra tal como se aplican en LABOPE/LABOYA
+    return idempotency_index.fingerprint({'datos': payload, 'idEntidadIgeo': igeo_id})
+
+
+def same_value(stored, value):
+    # Compara un valor leído de MySQL con el que se escribiría. Ante la duda
+    # (tipos distintos) se considera cambiado: como mucho sobra una escritura.
+    if stored is None or value is None:
+        return stored is None and value is None
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, datetime) or isinstance(stored, datetime):
+        return stored == value
+    return str(stored) == str(value)
 
 class DatabaseVeolab (object):
     """
@@ -19,13 +103,20 @@ class DatabaseVeolab (object):
         self.serial = serial  # Serie
         self.division = division  # Delegación
         self._col_cache = {}  # Caché de existencia de columnas opcionales (OPECJSO, INFCJSO...)
+        self._batch = False  # Modo lote: varios mensajes en una sola transacción
+        self._pending = None  # Filas pendientes de volcar en modo lote, por sentencia
+        self._batch_keys = set()  # Muestras dadas de alta en el lote en curso (aún sin volcar)
+        self._batch_logs = []  # Líneas de IGELOG del lote en curso
+        self._applied = []  # Huellas de datos aplicados, se publican al confirmar
+        self.pool = None  # Pool al que se devuelve la conexión en close()
+        self.released = False  # Ya devuelta a su pool: un segundo close() no hace nada
+        self._checked = 0.0  # Última vez que se comprobó que la conexión sigue viva
 
     def open(self):
         # Conecta a la base de datos, prepara el cursor y carga la configuración
         try:
             # Conecta a MySQL
-            db_config = DatabaseConfig()
-            db_config.read_config()
+            db_config = DatabaseConfig.snapshot()
             self.connection = pymysql.connect(host=db_config.host,
                                         port=int(db_config.port), 
                                         user=db_config.user,
@@ -37,6 +128,7 @@ class DatabaseVeolab (object):
             self.cursor = self.connection.cursor()
             # Lee la configuración de serie y delegación
             self.refresh_serial()
+            self._checked = time.monotonic()
 
         except pymysql.Error as e:
             if self.connection is not None:
@@ -45,6 +137,13 @@ class DatabaseVeolab (object):
                 print ("Error al establecer la conexión con la base de datos:", e)
 
     def close(self):
+        # Devuelve la conexión a su pool o, si no viene de uno, la cierra
+        if self.pool is not None:
+            self.pool.release(self)
+        elif not self.released:
+            self.disconnect()
+
+    def disconnect(self):
         # Desconecta la base de datos
         try:
             if self.connection is not None:
@@ -53,14 +152,134 @@ class DatabaseVeolab (object):
             pass
 
     def ensure_connection(self):
+        # En modo lote no se reconecta: una reconexión silenciosa perdería la
+        # transacción en curso. Si la conexión cayó, el siguiente execute falla
+        # y el lote se reprocesa mensaje a mensaje.
+        # Una conexión usada hace menos de VEOLAB_DB_VALIDATE segundos no se comprueba
+        # (pymysql la marca como cerrada si una consulta falla por conexión caída).
+        if self._batch:
+            return
+        if self.connection is not None and self.connection.open and time.monotonic() - self._checked < database_pool.validate_idle:
+            self._checked = time.monotonic()
+            return
         try:
             if self.connection is None:
                 raise pymysql.Error("Conexión no inicializada")
             self.connection.ping(reconnect=True)
+            self._checked = time.monotonic()
         except pymysql.Error as e:
             logging.warning(f"Conexión perdida. Reintentando... {e}")
             self.open()
 
+    def commit(self):
+        # Confirma la transacción salvo en modo lote, donde se confirma todo junto
+        # al cerrar el lote (commit_batch).
+        if not self._batch:
+            self.connection.commit()
+            self.publish_applied()
+
+    def rollback(self):
+        # Deshace la transacción en curso fuera de modo lote; las huellas de lo aplicado
+        # en ella se descartan sin recordarse.
+        self._applied = []
+        if self.connection is None:
+            return
+        try:
+            self.connection.rollback()
+        except pymysql.Error as e:
+            logging.warning(f"No se pudo deshacer la transacción: {e}")
+
+    def publish_applied(self):
+        # Las huellas de los datos aplicados solo se recuerdan una vez confirmados
+        for operation, fingerprint in self._applied:
+            idempotency_index.remember_applied(operation, fingerprint)
+        self._applied = []
+
+    def begin_batch(self):
+        # Abre un lote: las confirmaciones intermedias se aplazan y las altas se
+        # acumulan para volcarlas con INSERT multi-fila por tabla.
+        self.refresh_mappings()
+        self._batch = True
+        self._pending = {}
+        self._batch_keys = set()
+        self._batch_logs = []
+
+    def commit_batch(self):
+        # Vuelca las filas acumuladas y confirma el lote en una sola transacción
+        try:
+            self.flush_pending()
+            logs = self._batch_logs
+            if logs and not log_writer.running:
+                self.write_log_records(logs)
+            self.connection.commit()
+            self.publish_applied()
+            if logs and log_writer.running:
+                for record in logs:
+                    log_writer.submit(record)
+        finally:
+            self._batch = False
+            self._pending = None
+            self._batch_keys = set()
+            self._batch_logs = []
+
+    def rollback_batch(self):
+        # Deshace el lote completo (las filas pendientes se descartan sin volcar)
+        self._batch = False
+        self._pending = None
+        self._batch_keys = set()
+        self._batch_logs = []
+        self._applied = []
+        try:
+            self.connection.rollback()
+        except pymysql.Error as e:
+            logging.warning(f"No se pudo deshacer el lote: {e}")
+
+    def queue_rows(self, query, rows):
+        # Inserta filas; en modo lote se acumulan por sentencia y se vuelcan juntas.
+        # pymysql convierte executemany de INSERT ... VALUES en un INSERT multi-fila.
+        if not rows:
+            return
+        if self._pending is None:
+            self.write_rows(query, rows)
+        else:
+            self._pending.setdefault(query, []).extend(rows)
+
+    def flush_pending(self):
+        # Vuelca las filas acumuladas del lote, en el orden en que se acumularon
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        for query, rows in pending.items():
+            self.write_rows(query, rows)
+
+    def write_rows(self, query, rows):
+        if query == LABCOR_FROM_LABCOT:
+            self.insert_columns(rows)
+        else:
+            self.cursor.executemany(query, rows)
+
+    def insert_columns(self, rows):
+        # Genera LABCOR desde la plantilla LABCOT de cada técnica en una sola sentencia.
+        # rows: tuplas (OPE3DEL, OPE3SER, OPE3COD, TEC3DEL, TEC3COD); se admiten
+        # técnicas de varias operaciones (lote).
+        rows_sql, rows_val = self.values_table(rows, ["OPE3DEL", "OPE3SER", "OPE3COD", "TEC3DEL", "TEC3COD"])
+        query = f"""
+            INSERT INTO LABCOR (OPE3DEL, OPE3SER, OPE3COD, TEC3DEL, TEC3COD, COR1COD, CORCTIT,
+                CORCTI2, CORCTI3, CORBINF, CORBRES, CORBEDI, CORBACT)
+            SELECT T.OPE3DEL, T.OPE3SER, T.OPE3COD, LABCOT.TEC3DEL, LABCOT.TEC3COD, COT1COD, COTCTIT,
+                COTCTI2, COTCTI3, COTBINF, COTBRES, COTBEDI, COTBACT
+            FROM {rows_sql} AS T
+            JOIN LABCOT ON (LABCOT.TEC3DEL = T.TEC3DEL AND LABCOT.TEC3COD = T.TEC3COD)
+        """
+        self.cursor.execute(query, rows_val)
+
+    def refresh_mappings(self):
+        # Descarta de la caché compartida los mapeos de tablas modificadas en Veolab.
+        # Se llama al empezar cada mensaje, nunca en mitad de un lote.
+        if not self._batch:
+            mapping_cache.check_stale(self.cursor)
+
     def column_exists(self, table, column):
         # Comprueba (cacheado) si una columna existe. Sirve para campos opcionales
         # que el usuario puede haber añadido en Veolab (p.ej. OPECJSO, INFCJSO) o no.
@@ -115,78 +334,39 @@ class DatabaseVeolab (object):
         return ".pre." in host.lower()
 
     def get_technical_key(self, table_name):
-        # Obtiene la clave técnica para tabla de entrada
-        query = """
-            SELECT CLTNVAL FROM ACCCLT 
-            WHERE DEL3COD = %s AND CLTCTAB = %s AND CLTCSER = %s 
-            FOR UPDATE
-        """
-        self.cursor.execute(query, (self.division, table_name, self.serial))
-        row = self.cursor.fetchone()
-        
-        if row is None:
-            next_key = 1
-            query = """
-                INSERT INTO ACCCLT (CLTNVAL, DEL3COD, CLTCTAB, CLTCSER) 
-                VALUES (%s, %s, %s, %s)
-            """
-        else:
-            max_key = row['CLTNVAL']
-            next_key = max_key + 1
-            query = """
-                UPDATE ACCCLT SET CLTNVAL = %s 
-                WHERE DEL3COD = %s AND CLTCTAB = %s AND CLTCSER = %s
-            """
-
-        val = (next_key, self.division, table_name, self.serial)
-        self.cursor.execute(query, val)
-        self.connection.commit()
-        return next_key 
+        # Obtiene la clave técnica para tabla de entrada. Las claves salen de bloques
+        # reservados en ACCCLT (VEOLAB_KEY_BLOCK) compartidos por todo el proceso.
+        return key_allocator.next_key(self.division, table_name, self.serial)
 
     def next_igelog_key(self):
         # IGELOG tiene PK (DEL3COD, LOG1COD), SIN serie, y solo lo escribe este servicio.
-        # Por eso el contador va por delegación (no por serie, a diferencia de get_technical_key)
-        # y se sincroniza con el máximo real para no colisionar tras restauraciones, cambios de
-        # serie o limpiezas del log.
-        self.cursor.execute(
-            "SELECT CLTNVAL FROM ACCCLT WHERE DEL3COD = %s AND CLTCTAB = 'IGELOG' AND CLTCSER = '' FOR UPDATE",
-            (self.division,)
-        )
-        row = self.cursor.fetchone()
-        self.cursor.execute(
-            "SELECT COALESCE(MAX(LOG1COD), 0) AS maximo FROM IGELOG WHERE DEL3COD = %s",
-            (self.division,)
-        )
-        max_real = self.cursor.fetchone()['maximo']
-        contador = row['CLTNVAL'] if row is not None else 0
-        next_key = max(contador, max_real) + 1
-        if row is None:
-            self.cursor.execute(
-                "INSERT INTO ACCCLT (CLTNVAL, DEL3COD, CLTCTAB, CLTCSER) VALUES (%s, %s, 'IGELOG', '')",
-                (next_key, self.division)
-            )
-        else:
-            self.cursor.execute(
-                "UPDATE ACCCLT SET CLTNVAL = %s WHERE DEL3COD = %s AND CLTCTAB = 'IGELOG' AND CLTCSER = ''",
-                (next_key, self.division)
-            )
-        self.connection.commit()
-        return next_key
-
-    def logdb(self, command, text, details, commit=False):
+        # Por eso el contador va por delegación (no por serie, a diferencia de get_technical_key).
+        # Se sincroniza con el máximo real una vez al arrancar (y tras una colisión) para no
+        # colisionar tras restauraciones, cambios de serie o limpiezas del log; después las
+        # claves salen de bloques reservados en memoria.
+        return key_allocator.next_key(self.division, 'IGELOG', '')
+
+    def logdb(self, command, text, details, commit=False, critical=False):
+        # Registra una línea en IGELOG. Si el escritor en segundo plano está activo
+        # se encola (y se vuelca en bloque por su propia conexión); las líneas
+        # críticas (critical) se escriben siempre en el momento. En modo lote las
+        # líneas se retienen hasta confirmar el lote y se descartan si se deshace.
+        # commit confirma la transacción de esta conexión en cualquier caso.
         val = None
         try:
-            cod = self.next_igelog_key()
-            query = """
-                INSERT INTO IGELOG (DEL3COD, LOG1COD, LOGTFEC, LOGCTIP, LOGCDES, LOGCDET) 
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """
             dateReg = datetime.now().strftime('%Y/%m/%d %H:%M:%S')
             str_details = str(details).replace("\n", "").replace("\t", "")
-            val = (self.division, cod, dateReg, command, text, str_details)
-            self.cursor.execute(query, val)
+            record = (self.division, dateReg, command, text, str_details)
+            val = record
+            if self._batch:
+                self._batch_logs.append(record)
+            elif log_writer.running and not critical:
+                log_writer.submit(record)
+            else:
+                self.write_log_records([record])
+            # commit confirma también la transacción del llamante (p.ej. mark_sample_sent)
             if commit:
-                self.connection.commit()
+                self.commit()
 
             # Logging con nivel según el tipo de comando
             fecha = time.strftime('%d/%m/%y')
@@ -204,7 +384,31 @@ class DatabaseVeolab (object):
             logging.error(f"Intento de insertar: {val}")
             logging.error(traceback.format_exc())            
 
-
+    def write_log_records(self, records):
+        # Inserta líneas de IGELOG (DEL3COD, LOGTFEC, LOGCTIP, LOGCDES, LOGCDET) en un
+        # INSERT multi-fila, asignándoles clave. No confirma.
+        query = """
+            INSERT INTO IGELOG (DEL3COD, LOG1COD, LOGTFEC, LOGCTIP, LOGCDES, LOGCDET) 
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        for attempt in range(2):
+            val = [
+                (division, key_allocator.next_key(division, 'IGELOG', ''), dateReg, command, text, details)
+                for division, dateReg, command, text, details in records
+            ]
+            try:
+                self.cursor.executemany(query, val)
+                return
+            except pymysql.IntegrityError as e:
+                # Clave duplicada: alguien escribió IGELOG por fuera. Se resincroniza
+                # el contador con el máximo real y se reintenta para no perder las líneas.
+                if attempt == 1 or e.args[0] != DUPLICATE_KEY:
+                    raise
+                for division in {record[0] for record in records}:
+                    key_allocator.resync(division, 'IGELOG', '')
+
+
+    @cached_mapping('SINCLI')
     def get_client(self, client_igeo, codigo_delegacion=None):
         # Obtiene el código del cliente según Veolab. Si el mismo Id. iGEO
         # (CLICIGC) está repetido en varios clientes, se desambigua por
@@ -226,6 +430,7 @@ class DatabaseVeolab (object):
         row = rows[0]
         return row['DEL3COD'], row['CLI1COD']
 
+    @cached_mapping('LABSYC', 'LABSER')
     def get_service(self, service_igeo, div_client, cod_client):
         # Obtiene datos del servicio buscando por el mapeo de cliente. Aplica el
         # precio especial por cliente (LABSYC) igual que Veolab
@@ -259,20 +464,17 @@ class DatabaseVeolab (object):
         else:
             return ("", "", 0, "", "", 0, "", 0, "", "")
 
+    @cached_mapping('LABTYC', 'LABTEC', 'LABTYN')
     def get_parameter(self, parameter_igeo, div_client, cod_client, div_nor="", cod_nor=""):
         # Obtiene datos de la técnica buscando por el id de IGEO. Aplica el
         # precio especial por cliente (LABTYC) igual que Veolab
         # (FAC_ObtenerPrecioTecnica), y resuelve RESCNOR igual que
         # AcumulaGrabarTecnicas: usa la leyenda de la normativa del servicio
         # (LABTYN.TYNCVAL) si existe, si no la genérica de la técnica (TECCNOR).
-        query = """
-            SELECT LABTEC.DEL3COD, LABTEC.TEC1COD, LABTEC.TECCNOM, LABTEC.TECCNOI, LABTEC.TECBCUR, LABTEC.TECDACR, LABTEC.TECCPAR,
-                LABTEC.TECCABR, LABTEC.TECCCAS, LABTEC.TECNPRE, LABTEC.TECCDTO, LABTEC.TECCUNI, LABTEC.TECCLEY, LABTEC.TECCMET,
-                LABTEC.TECCMEA,
-                CASE WHEN LABTYN.TYNCVAL <> '' THEN LABTYN.TYNCVAL ELSE LABTEC.TECCNOR END AS TECCNOR,
-                LABTEC.TECNTIE, LABTEC.TECCLIM, LABTEC.TECCMIN, LABTEC.TECCINC, LABTEC.TECCINS,
-                LABTEC.TECBEXP, LABTEC.SEC2DEL, LABTEC.SEC2COD,
-                LABTYC.TYCNPRE, LABTYC.TYCCDTO
+        # Si el código aparece en varias técnicas del cliente, manda la primera por
+        # clave de técnica (el mismo orden que resolve_parameters).
+        query = f"""
+            SELECT {PARAMETER_COLUMNS}
             FROM LABTYC
             LEFT JOIN LABTEC ON (LABTYC.TEC3DEL = LABTEC.DEL3COD AND LABTYC.TEC3COD = LABTEC.TEC1COD)
             LEFT JOIN LABTYN ON (LABTYN.TEC3DEL = LABTEC.DEL3COD AND LABTYN.TEC3COD = LABTEC.TEC1COD
@@ -280,17 +482,113 @@ class DatabaseVeolab (object):
             WHERE FIND_IN_SET(%s, LABTYC.TYCCREF) > 0
                 AND LABTYC.CLI3DEL = %s
                 AND LABTYC.CLI3COD = %s
+            ORDER BY LABTYC.TEC3DEL, LABTYC.TEC3COD
         """
         self.cursor.execute(query, (div_nor, cod_nor, parameter_igeo, div_client, cod_client))
         row = self.cursor.fetchone()
         if row is None:
             return None
+        return self.apply_parameter_price(row)
+
+    def apply_parameter_price(self, row):
+        # Sustituye precio/descuento de la técnica por los del cliente (LABTYC) si los tiene
         tyc_precio = row.pop('TYCNPRE')
         tyc_descuento = row.pop('TYCCDTO')
         row['TECNPRE'] = tyc_precio if tyc_precio else row['TECNPRE']
         row['TECCDTO'] = tyc_descuento if tyc_descuento else row['TECCDTO']
         return row
 
+    def values_table(self, keys, names):
+        # Construye una tabla derivada (SELECT ... UNION ALL ...) con las claves de
+        # entrada, para resolver muchas claves en una sola consulta y poder asociar
+        # cada fila a la clave pedida (no a la devuelta, que puede diferir en
+        # mayúsculas según la intercalación).
+        select_row = "SELECT " + ", ".join(f"%s AS {name}" for name in names)
+        sql = "(" + " UNION ALL ".join([select_row] * len(keys)) + ")"
+        return sql, [value for key in keys for value in key]
+
+    def resolve_parameters(self, parameters_igeo, div_client, cod_client, div_nor="", cod_nor=""):
+        # Versión por conjuntos de get_parameter + get_analyst + get_department para
+        # todos los objetos de análisis de una muestra: como mucho tres consultas en
+        # lugar de dos por parámetro y una por sección. Comparte la caché de mapeos
+        # con los métodos unitarios y solo consulta las claves que no están en ella.
+        # Devuelve un dict con:
+        #   'parameters':  código IGEO -> fila de get_parameter (o None si no se mapea)
+        #   'analysts':    (TEC3DEL, TEC3COD) -> fila de get_analyst (o None)
+        #   'departments': (SEC2DEL, SEC2COD) -> fila de get_department (o None)
+        codes = [(code, ) for code in dict.fromkeys(parameters_igeo)]
+        query = f"""
+            SELECT {PARAMETER_COLUMNS}, CLAVES.K_IDX
+            FROM {{keys}} AS CLAVES
+            JOIN LABTYC ON (FIND_IN_SET(CLAVES.K_CODE, LABTYC.TYCCREF) > 0)
+            LEFT JOIN LABTEC ON (LABTYC.TEC3DEL = LABTEC.DEL3COD AND LABTYC.TEC3COD = LABTEC.TEC1COD)
+            LEFT JOIN LABTYN ON (LABTYN.TEC3DEL = LABTEC.DEL3COD AND LABTYN.TEC3COD = LABTEC.TEC1COD
+                AND LABTYN.NOR3DEL = %s AND LABTYN.NOR3COD = %s)
+            WHERE LABTYC.CLI3DEL = %s
+                AND LABTYC.CLI3COD = %s
+            ORDER BY CLAVES.K_IDX, LABTYC.TEC3DEL, LABTYC.TEC3COD
+        """
+        parameters = self.resolve_keys(
+            'get_parameter', ('LABTYC', 'LABTEC', 'LABTYN'), codes, ["K_CODE"], query,
+            extra_key=(div_client, cod_client, div_nor, cod_nor), extra_val=[div_nor, cod_nor, div_client, cod_client],
+            transform=self.apply_parameter_price
+        )
+        parameters = {key[0]: row for key, row in parameters.items()}
+        found = [row for row in parameters.values() if row is not None]
+
+        # Analistas (primer analista de cada técnica, como get_analyst)
+        query = """
+            SELECT CLAVES.K_IDX, LABTYE.EMP3DEL, LABTYE.EMP3COD
+            FROM {keys} AS CLAVES
+            JOIN LABTYE ON (LABTYE.TEC3DEL = CLAVES.K_DEL AND LABTYE.TEC3COD = CLAVES.K_COD)
+            ORDER BY CLAVES.K_IDX, LABTYE.EMP3DEL, LABTYE.EMP3COD
+        """
+        tec_keys = [(row['DEL3COD'], row['TEC1COD']) for row in found if row['TEC1COD'] is not None]
+        analysts = self.resolve_keys('get_analyst', ('LABTYE', ), tec_keys, ["K_DEL", "K_COD"], query)
+
+        # Departamentos de las secciones de las técnicas (para LABOYD, como get_department)
+        query = """
+            SELECT DISTINCT CLAVES.K_IDX, LABSEC.DEP2DEL, LABSEC.DEP2COD
+            FROM {keys} AS CLAVES
+            JOIN LABSEC ON (LABSEC.DEL3COD = CLAVES.K_DEL AND LABSEC.SEC1COD = CLAVES.K_COD)
+            ORDER BY CLAVES.K_IDX, LABSEC.DEP2DEL, LABSEC.DEP2COD
+        """
+        sec_keys = [(row['SEC2DEL'], row['SEC2COD']) for row in found if row['SEC2COD'] is not None]
+        departments = self.resolve_keys('get_department', ('LABSEC', ), sec_keys, ["K_DEL", "K_COD"], query)
+
+        return {'parameters': parameters, 'analysts': analysts, 'departments': departments}
+
+    def resolve_keys(self, name, tables, keys, key_names, query, extra_key=(), extra_val=(), transform=None):
+        # Resuelve un conjunto de claves de un método de mapeo unitario (name): toma de
+        # la caché las que ya estén y consulta el resto de una vez, pasando las claves
+        # como tabla derivada ({keys} en query, con su ordinal K_IDX para asociar cada
+        # fila a la clave pedida). Como fetchone, se queda con la primera fila de cada
+        # clave, así que query debe ordenar por K_IDX y después igual que la consulta
+        # unitaria; transform se aplica a cada fila antes de guardarla, igual que en el
+        # método unitario. Devuelve clave -> fila (sin K_IDX) o None.
+        result = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            found, value = mapping_cache.get(mapping_key(name, *key, *extra_key))
+            if found:
+                result[key] = copy_value(value)
+            else:
+                missing.append(key)
+        if missing:
+            keys_sql, keys_val = self.values_table(
+                [(idx, *key) for idx, key in enumerate(missing)], ["K_IDX"] + key_names
+            )
+            self.cursor.execute(query.replace("{keys}", keys_sql), keys_val + list(extra_val))
+            loaded = [None] * len(missing)
+            for row in self.cursor.fetchall():
+                idx = int(row.pop('K_IDX'))
+                if loaded[idx] is None:
+                    loaded[idx] = transform(row) if transform is not None else row
+            for key, row in zip(missing, loaded):
+                mapping_cache.put(mapping_key(name, *key, *extra_key), copy_value(row), tables)
+                result[key] = row
+        return result
+
     def get_parameters_op(self, division, serial, code_op):
         # Obtiene la lista de técnicas de la operación de entrada
         query = """
@@ -307,13 +605,22 @@ class DatabaseVeolab (object):
         rows = self.cursor.fetchall()
         return rows
 
+    @cached_mapping('LABTYE')
     def get_analyst(self, division, code):
         # Obtiene el código del primer analista asignado a la técnica
-        query = "SELECT EMP3DEL, EMP3COD FROM LABTYE WHERE TEC3DEL = %s AND TEC3COD = %s"
+        query = "SELECT EMP3DEL, EMP3COD FROM LABTYE WHERE TEC3DEL = %s AND TEC3COD = %s ORDER BY EMP3DEL, EMP3COD"
         self.cursor.execute(query, (division, code))
         row = self.cursor.fetchone()
         return row
 
+    @cached_mapping('LABSEC')
+    def get_department(self, division, section):
+        # Obtiene el departamento de la sección de entrada (para LABOYD)
+        query = "SELECT DISTINCT DEP2DEL, DEP2COD FROM LABSEC WHERE DEL3COD = %s AND SEC1COD = %s ORDER BY DEP2DEL, DEP2COD"
+        self.cursor.execute(query, (division, section))
+        return self.cursor.fetchone()
+
+    @cached_mapping('LABCON')
     def get_breakdown_type(self):
         # Obtiene el tipo de desglose configurado en Veolab
         query = "SELECT CONCTID FROM LABCON WHERE CON1COD = 1"
@@ -348,34 +655,80 @@ class DatabaseVeolab (object):
             return None
 
     def get_document_pdf(self, division, serial, code_inf):
-        # Obtiene el contenido en PDF en base 64 del documento del informe 
-        query = """
-            SELECT BLOLCON, BLONTAM FROM DOCBLO 
+        # Obtiene el contenido en PDF en base 64 del documento del informe, como bytes
+        # ASCII. Los bloques se leen en streaming (cursor sin buffer) y se codifican
+        # según llegan, en trozos múltiplos de 3 bytes, directamente sobre un buffer
+        # preasignado con el tamaño final: el pico de memoria es ~1,33 veces el PDF.
+        condition = """
+            FROM DOCBLO 
                 LEFT JOIN DOCFAT ON (DOCBLO.DEL3COD = DOCFAT.DEL3COD 
                     AND DOCBLO.FAT3COD = DOCFAT.FAT1COD 
                     AND DOCBLO.VER3COD = DOCFAT.VER2COD)
             WHERE DOCFAT.DEL3COD = %s AND DOCFAT.INF2SER = %s AND DOCFAT.INF2COD = %s
-            ORDER BY DOCBLO.DEL3COD, DOCBLO.BLO1COD
         """
-        self.cursor.execute(query, (division, serial, code_inf))
-        rows = self.cursor.fetchall()
-        blob = b""
-        for row in rows:
-            chunk = row['BLOLCON']
-            size = row['BLONTAM']
-            blob += chunk[:size]  
-        
-        return base64.b64encode(blob).decode('utf8')
+        val = (division, serial, code_inf)
+        self.cursor.execute("SELECT COALESCE(SUM(BLONTAM), 0) AS TOTAL " + condition, val)
+        total = int(self.cursor.fetchone()['TOTAL'])
+        encoded = bytearray(4 * ((total + 2) // 3))
+        written = 0
+        carry = b""  # Bytes pendientes (menos de 3) hasta completar un grupo
+        cursor = self.connection.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute("SELECT BLOLCON, BLONTAM " + condition + " ORDER BY DOCBLO.DEL3COD, DOCBLO.BLO1COD", val)
+            for chunk, size in cursor:
+                data = memoryview(chunk or b"")[:size]
+                if carry:
+                    head = 3 - len(carry)
+                    carry, data = carry + bytes(data[:head]), data[head:]
+                    if len(carry) < 3:
+                        continue
+                    written = self.write_base64(encoded, written, carry)
+                    carry = b""
+                aligned = len(data) - len(data) % 3
+                if aligned:
+                    written = self.write_base64(encoded, written, data[:aligned])
+                carry = bytes(data[aligned:])
+        finally:
+            cursor.close()
+        if carry:
+            written = self.write_base64(encoded, written, carry)
+        if written < len(encoded):
+            # BLONTAM mayor que el contenido real de algún bloque
+            del encoded[written:]
+        return encoded
+
+    def write_base64(self, encoded, offset, data):
+        # Codifica data (un memoryview del bloque, sin copiarlo) en base64 sobre
+        # encoded a partir de offset y devuelve el nuevo offset. La asignación de un
+        # trozo del mismo tamaño se hace en sitio; si el documento creció desde que
+        # se midió, el buffer se amplía.
+        piece = base64.b64encode(data)
+        end = offset + len(piece)
+        encoded[offset:end] = piece
+        return end
+
+    def get_reports_signature(self):
+        # Sonda barata de cambios para la búsqueda de informes: operaciones pendientes
+        # de enviar y recuento/máximo de fechas de envío de informes.
+        query = """
+            SELECT (SELECT COUNT(*) FROM LABOPE WHERE OPECIGE = 'R') AS OPE_R,
+                (SELECT COUNT(INFDENV) FROM LABINF) AS INF_ENV,
+                (SELECT MAX(INFDENV) FROM LABINF) AS INF_MAX
+        """
+        self.cursor.execute(query)
+        row = self.cursor.fetchone()
+        return (row['OPE_R'], row['INF_ENV'], row['INF_MAX'])
 
-    def get_reports(self):
-        # Obtiene la estructura exacta para enviar el informe a la cola de IGEO
+    def report_rows_query(self, since=None):
+        # Consulta de filas candidatas a informe; con since, solo las de informes con
+        # INFDENV >= since. Devuelve (consulta, parámetros).
         query = """
             SELECT DISTINCT LABOPE.DEL3COD AS OPE1DEL, OPE1COD, OPE1SER, OPECREF, OPECDES, 
                 OPEDREG, OPETREC, OPECOBS, LABOPE.CLI2DEL, LABOPE.CLI2COD, OPECTEM, OPECENV, 
                 OPECLUR, OPECCAN, OPECREC, OPECTIP, OPENPRE, OPECDTO, OPECTEC, OPEBFAB, OPECTID, 
                 LABOPE.TIO2DEL, LABOPE.TIO2COD, LABOPE.MAT2DEL, LABOPE.MAT2COD, OPEDINI, OPEDFIN, 
                 OPECIDG, SINCLI.CLICIGC, SINCLI.CLICCIG, LABSER.SERCNOM, LABSYC.SYCCREF, 
-                LABINF.DEL3COD AS INF1DEL, INF1SER, INF1COD 
+                LABINF.DEL3COD AS INF1DEL, INF1SER, INF1COD, LABINF.INFDENV 
             FROM LABOPE 
             LEFT JOIN SINCLI ON (LABOPE.CLI2DEL = SINCLI.DEL3COD
                 AND LABOPE.CLI2COD = SINCLI.CLI1COD)
@@ -396,26 +749,159 @@ class DatabaseVeolab (object):
                 AND LABOPE.CLI2COD = LABSYC.CLI3COD)
             WHERE LABOPE.OPECIGE = 'R' AND LABINF.INFDENV IS NOT NULL
         """
-        self.cursor.execute(query)
-        rows = self.cursor.fetchall()
-        include_pdf_json = self.is_pre_environment()
-        reports = []
-        for row in rows:
-            try:
-                reports.append(self.build_report(row, include_pdf_json))
-            except Exception as e:
-                logging.error(
-                    f"Error al construir el informe de la operación {row.get('OPECREF')}: {e}. "
-                    f"Se omite esa muestra y se continúa con el resto."
+        if since is not None:
+            return query + " AND LABINF.INFDENV >= %s", (since, )
+        return query, ()
+
+    def iter_reports(self, since=None, window=20, skip=None):
+        # Genera (fila, informe) sin materializar el ciclo completo: las candidatas se
+        # leen en streaming (SSDictCursor, en una conexión propia para poder seguir
+        # consultando por esta) de window en window, se precargan sus datos por
+        # bloque y cada informe se construye cuando el publicador lo pide. informe es
+        # None si no se pudo construir (la muestra se omite sin perder el resto) o si
+        # skip(fila) indica que no hace falta construirlo.
+        reader = open_database()
+        if reader.connection is None:
+            raise pymysql.Error("No se pudo abrir la conexión de lectura de informes")
+        cursor = None
+        write_timeout = None
+        try:
+            # El publicador puede tardar en pedir el siguiente bloque: se da margen al
+            # servidor antes de cortar el envío de resultados pendientes. La conexión
+            # es del pool: al terminar se deja el valor que tenía.
+            reader.cursor.execute("SELECT @@SESSION.net_write_timeout AS TIMEOUT")
+            write_timeout = reader.cursor.fetchone()['TIMEOUT']
+            reader.cursor.execute("SET SESSION net_write_timeout = 600")
+            cursor = reader.connection.cursor(pymysql.cursors.SSDictCursor)
+            cursor.execute(*self.report_rows_query(since))
+            while True:
+                rows = cursor.fetchmany(window)
+                if not rows:
+                    break
+                try:
+                    context = self.load_report_context(rows)
+                except pymysql.Error as e:
+                    logging.warning(f"No se pudieron precargar los datos de los informes: {e}")
+                    context = None
+                for row in rows:
+                    # Entra en la firma de la bandeja de salida (ReportOutbox.signature)
+                    row['_version'] = self.report_version(row, context)
+                    if skip is not None and skip(row):
+                        yield row, None
+                        continue
+                    try:
+                        report = self.build_report(row, context)
+                    except Exception as e:
+                        logging.error(
+                            f"Error al construir el informe de la operación {row.get('OPECREF')}: {e}. "
+                            f"Se omite esa muestra y se continúa con el resto."
+                        )
+                        report = None
+                    yield row, report
+                    report = None  # Se libera antes de construir el siguiente
+        finally:
+            if cursor is not None:
+                cursor.close()
+            discard = False
+            if write_timeout is not None:
+                try:
+                    reader.cursor.execute("SET SESSION net_write_timeout = %s", (int(write_timeout), ))
+                except pymysql.Error as e:
+                    # No se devuelve al pool una conexión con el ajuste cambiado
+                    logging.warning(f"No se pudo restaurar net_write_timeout: {e}")
+                    discard = True
+            if discard and reader.pool is not None:
+                reader.pool.release(reader, discard=True)
+            else:
+                reader.close()
+
+    def load_report_context(self, rows):
+        # Precarga para todo el ciclo lo que build_report consulta por informe:
+        # técnicas (LABRES/LABCOR), nombres de documento (DOCFAT) y autodefinibles
+        # (LABOYA), con una consulta IN (...) por tabla, agrupado por operación/informe.
+        operations = list(dict.fromkeys((row['OPE1DEL'], row['OPE1SER'], row['OPE1COD']) for row in rows))
+        reports = list(dict.fromkeys(
+            (row['INF1DEL'], row['INF1SER'], row['INF1COD']) for row in rows if row['INF1COD'] is not None
+        ))
+        context = {
+            'parameters': {operation: [] for operation in operations},
+            'documents': {},
+            'selfdefining': {operation: [] for operation in operations},
+            'document_versions': {},
+        }
+        for start in range(0, len(operations), REPORT_CHUNK):
+            chunk = operations[start:start + REPORT_CHUNK]
+            condition, val = tuple_in(["LABRES.OPE3DEL", "LABRES.OPE3SER", "LABRES.OPE3COD"], chunk)
+            query = f"""
+                SELECT LABRES.OPE3DEL, LABRES.OPE3SER, LABRES.OPE3COD,
+                    RESCNOM, RESCREF, RESCMET, RESCMIN, CORCVAL, RESCUNI 
+                FROM LABRES 
+                LEFT JOIN LABCOR ON (LABRES.OPE3DEL = LABCOR.OPE3DEL 
+                    AND LABRES.OPE3SER = LABCOR.OPE3SER 
+                    AND LABRES.OPE3COD = LABCOR.OPE3COD 
+                    AND LABRES.TEC3DEL = LABCOR.TEC3DEL 
+                    AND LABRES.TEC3COD = LABCOR.TEC3COD)
+                WHERE {condition} AND COR1COD = 1
+            """
+            self.cursor.execute(query, val)
+            for tec_row in self.cursor.fetchall():
+                operation = (tec_row['OPE3DEL'], tec_row['OPE3SER'], tec_row['OPE3COD'])
+                context['parameters'].setdefault(operation, []).append(tec_row)
+
+            condition, val = tuple_in(["OPE3DEL", "OPE3SER", "OPE3COD"], chunk)
+            self.cursor.execute(f"SELECT OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD, OYACVAL FROM LABOYA WHERE {condition}", val)
+            for aut_row in self.cursor.fetchall():
+                operation = (aut_row['OPE3DEL'], aut_row['OPE3SER'], aut_row['OPE3COD'])
+                context['selfdefining'].setdefault(operation, []).append(aut_row)
+
+        for start in range(0, len(reports), REPORT_CHUNK):
+            condition, val = tuple_in(["DEL3COD", "INF2SER", "INF2COD"], reports[start:start + REPORT_CHUNK])
+            self.cursor.execute(f"SELECT DEL3COD, INF2SER, INF2COD, FATCNOM FROM DOCFAT WHERE {condition}", val)
+            for doc_row in self.cursor.fetchall():
+                # Como get_document_name: el primer documento del informe
+                context['documents'].setdefault((doc_row['DEL3COD'], doc_row['INF2SER'], doc_row['INF2COD']), doc_row['FATCNOM'])
+
+            # Versión del PDF (bloques de DOCBLO) sin leer su contenido
+            condition, val = tuple_in(["DOCFAT.DEL3COD", "DOCFAT.INF2SER", "DOCFAT.INF2COD"], reports[start:start + REPORT_CHUNK])
+            self.cursor.execute(f"""
+                SELECT DOCFAT.DEL3COD, DOCFAT.INF2SER, DOCFAT.INF2COD, MAX(DOCFAT.VER2COD) AS VER,
+                    COUNT(DOCBLO.BLO1COD) AS BLOCKS, COALESCE(SUM(DOCBLO.BLONTAM), 0) AS SIZE, MAX(DOCBLO.BLO1COD) AS LAST_BLOCK
+                FROM DOCFAT
+                LEFT JOIN DOCBLO ON (DOCBLO.DEL3COD = DOCFAT.DEL3COD
+                    AND DOCBLO.FAT3COD = DOCFAT.FAT1COD
+                    AND DOCBLO.VER3COD = DOCFAT.VER2COD)
+                WHERE {condition}
+                GROUP BY DOCFAT.DEL3COD, DOCFAT.INF2SER, DOCFAT.INF2COD
+            """, val)
+            for doc_row in self.cursor.fetchall():
+                context['document_versions'][(doc_row['DEL3COD'], doc_row['INF2SER'], doc_row['INF2COD'])] = (
+                    doc_row['VER'], doc_row['BLOCKS'], doc_row['SIZE'], doc_row['LAST_BLOCK']
                 )
-        return reports
+        return context
+
+    @staticmethod
+    def report_version(row, context):
+        # Huella del contenido del informe que no está en la fila: resultados
+        # (LABRES/LABCOR), autodefinibles, nombre y versión del documento. None si no
+        # hay datos precargados.
+        if context is None:
+            return None
+        operation = (row['OPE1DEL'], row['OPE1SER'], row['OPE1COD'])
+        document = (row['INF1DEL'], row['INF1SER'], row['INF1COD'])
+        content = (
+            [sorted(parameter.items()) for parameter in context['parameters'].get(operation, [])],
+            [sorted(value.items()) for value in context['selfdefining'].get(operation, [])],
+            context['documents'].get(document),
+            context['document_versions'].get(document),
+        )
+        return hashlib.sha1(repr(content).encode('utf-8')).hexdigest()
 
-    def build_report(self, row, include_pdf_json=False):
-        # Construye el dict de un informe a partir de una fila de get_reports.
+    def build_report(self, row, context=None):
+        # Construye el dict de un informe a partir de una fila candidata (report_rows_query).
         # Aislado para que un fallo en una muestra (p.ej. fecha nula) no tumbe todo el lote.
-        # include_pdf_json: en PRE se guarda pdfAnalitica tambien en INFCJSO (para
-        # poder inspeccionar el JSON completo que recibiria IGEO); en PRO se sigue
-        # omitiendo para no engordar la BD con PDFs en base64.
+        # context: datos precargados del ciclo (load_report_context); sin él, se
+        # consultan aquí los de esta operación.
+        # No escribe nada: INFCJSO se guarda al publicarse el informe (save_reports_json).
         def fmt_dt(value):
             return value.strftime('%d/%m/%Y %H:%M:%S') if value else None
 
@@ -453,7 +939,11 @@ class DatabaseVeolab (object):
         report['datos']['transportista'] = row['OPECREC']
 
         report['datos']['objetosAnalisis'] = []
-        tec_rows = self.get_parameters_op(row['OPE1DEL'], row['OPE1SER'], row['OPE1COD'])
+        operation = (row['OPE1DEL'], row['OPE1SER'], row['OPE1COD'])
+        if context is not None and operation in context['parameters']:
+            tec_rows = context['parameters'][operation]
+        else:
+            tec_rows = self.get_parameters_op(*operation)
         for tec_row in tec_rows:
             objeto_analisis = {
                 'objetoAnalisis': tec_row['RESCNOM'],
@@ -465,72 +955,165 @@ class DatabaseVeolab (object):
             }
             report['datos']['objetosAnalisis'].append(objeto_analisis)
 
-        report['datos']['nombreDocumento'] = self.get_document_name(row['INF1DEL'], row['INF1SER'], row['INF1COD'])
+        document = (row['INF1DEL'], row['INF1SER'], row['INF1COD'])
+        if context is not None:
+            report['datos']['nombreDocumento'] = context['documents'].get(document)
+        else:
+            report['datos']['nombreDocumento'] = self.get_document_name(*document)
         report['datos']['pdfAnalitica'] = self.get_document_pdf(row['INF1DEL'], row['INF1SER'], row['INF1COD'])
         report['empresaId'] = to_int(row['CLICIGC'])
 
-        # Autodefinibles
-        query_aut = """
-            SELECT AUT3DEL, AUT3COD, OYACVAL, AUTCNOM FROM LABOYA
-                LEFT JOIN LABAUT ON (LABOYA.AUT3DEL = LABAUT.DEL3COD AND LABOYA.AUT3COD = LABAUT.AUT1COD)
-                WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s
-        """
-        self.cursor.execute(query_aut, (row['OPE1DEL'], row['OPE1SER'], row['OPE1COD']))
-        rows_selfdefining = self.cursor.fetchall()
+        # Autodefinibles (el nombre del campo sale del índice de LABAUT)
+        if context is not None and operation in context['selfdefining']:
+            rows_selfdefining = context['selfdefining'][operation]
+        else:
+            query_aut = """
+                SELECT AUT3DEL, AUT3COD, OYACVAL FROM LABOYA
+                    WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s
+            """
+            self.cursor.execute(query_aut, operation)
+            rows_selfdefining = self.cursor.fetchall()
 
+        fields_selfdefining = self.get_selfdefining_index().by_key
         for row_selfdefining in rows_selfdefining:
-            if row_selfdefining['AUTCNOM'] is not None:
-                field_selfdefining = self.get_field_selfdefining(row_selfdefining['AUTCNOM'])
+            field_selfdefining = fields_selfdefining.get((row_selfdefining['AUT3DEL'], row_selfdefining['AUT3COD']))
+            if field_selfdefining is not None:
                 report['datos'][field_selfdefining] = row_selfdefining['OYACVAL']
 
-        # Guarda el JSON que se envía a IGEO si el usuario ha añadido la columna
-        # INFCJSO en LABINF (opcional). En este punto report aún no lleva la
-        # clave 'cola', así que coincide con el mensaje que se envía a la cola.
-        # El PDF se omite salvo en PRE (include_pdf_json), donde interesa ver
-        # el JSON completo tal cual se envía a IGEO.
-        if row['INF1COD'] is not None and self.column_exists('LABINF', 'INFCJSO'):
-            try:
-                envio = dict(report)
-                if include_pdf_json:
-                    envio['datos'] = dict(report['datos'])
-                else:
-                    envio['datos'] = {k: v for k, v in report['datos'].items() if k != 'pdfAnalitica'}
-                # El visor de JSON de Veolab espera saltos de línea CRLF; json.dumps
-                # solo pone \n, así que se normaliza en json_for_viewer.
-                json_envio = self.json_for_viewer(envio)
+        report['cola'] = row['CLICCIG']
+        return report
+
+    def save_reports_json(self, reports):
+        # Guarda en INFCJSO (LABINF, opcional) el JSON enviado a IGEO de los informes
+        # publicados. reports: [((DEL3COD, INF1SER, INF1COD), cuerpo del mensaje)].
+        # Solo se escribe donde el contenido cambia (SHA1 de lo guardado), con un
+        # UPDATE por informe en la transacción del llamante. No confirma.
+        # Va tras un SAVEPOINT: un error de datos deshace solo esta parte y devuelve 0.
+        # Los OperationalError (deadlock, espera de bloqueo, conexión) se propagan:
+        # InnoDB puede haber deshecho ya la transacción entera del llamante.
+        # El PDF se omite salvo en PRE, donde interesa ver el JSON completo tal
+        # cual se envía a IGEO. Devuelve el número de informes escritos.
+        if not reports or not self.column_exists('LABINF', 'INFCJSO'):
+            return 0
+        include_pdf_json = self.is_pre_environment()
+        texts = {}
+        for document, body in reports:
+            if document is None or document[2] is None:
+                continue
+            envio = json.loads(body)
+            if not include_pdf_json:
+                envio['datos'].pop('pdfAnalitica', None)
+            # El visor de JSON de Veolab espera saltos de línea CRLF; json.dumps
+            # solo pone \n, así que se normaliza en json_for_viewer.
+            texts[tuple(document)] = self.json_for_viewer(envio)
+        documents = list(texts)
+        if not documents:
+            return 0
+        self.cursor.execute("SAVEPOINT informes_json")
+        try:
+            stored = {}
+            for start in range(0, len(documents), REPORT_CHUNK):
+                condition, val = tuple_in(["DEL3COD", "INF1SER", "INF1COD"], documents[start:start + REPORT_CHUNK])
+                # El hash se compara con el del texto en UTF-8, sea cual sea el juego de
+                # caracteres de la columna
                 self.cursor.execute(
+                    f"SELECT DEL3COD, INF1SER, INF1COD, SHA1(CONVERT(INFCJSO USING utf8mb4)) AS JSOHASH FROM LABINF WHERE {condition}",
+                    val
+                )
+                for row in self.cursor.fetchall():
+                    stored[(row['DEL3COD'], row['INF1SER'], row['INF1COD'])] = row['JSOHASH']
+            changed = [
+                (text, ) + document
+                for document, text in texts.items()
+                if stored.get(document) != hashlib.sha1(text.encode('utf-8')).hexdigest()
+            ]
+            if changed:
+                self.cursor.executemany(
                     "UPDATE LABINF SET INFCJSO = %s WHERE DEL3COD = %s AND INF1SER = %s AND INF1COD = %s",
-                    (json_envio, row['INF1DEL'], row['INF1SER'], row['INF1COD'])
+                    changed
                 )
-                self.connection.commit()
-            except Exception as e:
-                logging.warning(f"No se pudo guardar INFCJSO de la operación {row['OPECREF']}: {e}")
-
-        report['cola'] = row['CLICCIG']
-        return report
+        except pymysql.OperationalError:
+            raise
+        except pymysql.Error as e:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT informes_json")
+            logging.warning(f"No se pudo guardar INFCJSO de {len(documents)} informe(s): {e}")
+            return 0
+        return len(changed)
+
+    def pending_operations(self, operations):
+        # De las operaciones indicadas, las que siguen pendientes de enviar a IGEO
+        operations = list(operations)
+        pending = set()
+        for start in range(0, len(operations), REPORT_CHUNK):
+            condition, val = tuple_in(["DEL3COD", "OPE1SER", "OPE1COD"], operations[start:start + REPORT_CHUNK])
+            self.cursor.execute(f"SELECT DEL3COD, OPE1SER, OPE1COD FROM LABOPE WHERE OPECIGE = 'R' AND {condition}", val)
+            pending.update((row['DEL3COD'], row['OPE1SER'], row['OPE1COD']) for row in self.cursor.fetchall())
+        return pending
 
     def mark_sample_sent(self, reference_op):
         # Actualiza el estado de la operación a enviada a IGEO
-        query = "UPDATE LABOPE SET OPECIGE = 'E' WHERE OPECIGE = 'R' AND OPECREF = %s"
-        self.cursor.execute(query, (reference_op, ))    
+        self.mark_samples_sent([reference_op])
 
     def mark_sample_report(self, reference_op):
         # Actualiza el estado de la operación a informe correctamente recibido por IGEO
-        query = "UPDATE LABOPE SET OPECIGE = 'I' WHERE OPECIGE = 'E' AND OPECREF = %s"
-        self.cursor.execute(query, (reference_op, ))    
+        self.mark_samples_report([reference_op])
+
+    def mark_samples_sent(self, references):
+        # Como mark_sample_sent para varias operaciones, con UPDATE ... IN por bloques
+        self.set_samples_state(references, 'R', 'E')
+
+    def mark_samples_report(self, references):
+        # Como mark_sample_report para varias operaciones, con UPDATE ... IN por bloques
+        self.set_samples_state(references, 'E', 'I')
+
+    def set_samples_state(self, references, current, state):
+        # Pasa OPECIGE de current a state en las operaciones indicadas (por OPECREF). No confirma.
+        references = list(dict.fromkeys(references))
+        for start in range(0, len(references), REPORT_CHUNK):
+            chunk = references[start:start + REPORT_CHUNK]
+            query = f"UPDATE LABOPE SET OPECIGE = %s WHERE OPECIGE = %s AND OPECREF IN ({', '.join(['%s'] * len(chunk))})"
+            self.cursor.execute(query, [state, current] + chunk)
+
+    def get_selfdefining_index(self):
+        # Catálogo completo de LABAUT, cargado una vez y compartido (caché de mapeos,
+        # se recarga cuando cambia LABAUT):
+        #   by_name: nombre normalizado (selfdefining_key) -> SelfDefining(division, code)
+        #   by_key:  (DEL3COD, AUT1COD) -> campo camelCase (get_field_selfdefining)
+        key = mapping_key('get_selfdefining_index')
+        found, index = mapping_cache.get(key)
+        if found:
+            return index
+        self.cursor.execute("SELECT DEL3COD, AUT1COD, AUTCNOM FROM LABAUT")
+        by_name = {}
+        by_key = {}
+        for row in self.cursor.fetchall():
+            if row['AUTCNOM'] is None:
+                continue
+            # Como fetchone en la búsqueda por nombre: gana el primero
+            by_name.setdefault(selfdefining_key(row['AUTCNOM']), SelfDefining(row['DEL3COD'], row['AUT1COD']))
+            by_key[(row['DEL3COD'], row['AUT1COD'])] = self.get_field_selfdefining(row['AUTCNOM'])
+        index = SelfDefiningIndex(by_name, by_key)
+        mapping_cache.put(key, index, ('LABAUT', ))
+        return index
 
     def get_selfdefining(self, field):
         # Obtiene el autodefinible de Veolab para el campo de entrada que corresponda con la nomenclatura
-        import re
-        humanName = re.sub(r'([A-Z])', r' \1', field).capitalize()
-        query = "SELECT DEL3COD, AUT1COD FROM LABAUT WHERE AUTCNOM = %s"        
-        self.cursor.execute(query, (humanName, ))
-        row = self.cursor.fetchone()
-        if row is not None:
-            SelfDefining = namedtuple('SelfDefining', ['division', 'code'])
-            return SelfDefining(row['DEL3COD'], row['AUT1COD'])
-        return None
-    
+        return self.get_selfdefining_index().by_name.get(selfdefining_key(selfdefining_name(field)))
+
+    def selfdefining_rows(self, payload, division, serial, code_op):
+        # Filas LABOYA de los campos del payload (y de otrosParametros) que tienen
+        # autodefinible. Las listas y objetos (objetosAnalisis...) no son valores de
+        # autodefinible y se saltan sin buscarlos.
+        by_name = self.get_selfdefining_index().by_name
+        rows = []
+        for field, value in self.iter_fields_with_subgroup(payload, "otrosParametros"):
+            if isinstance(value, (dict, list)):
+                continue
+            selfdefining = by_name.get(selfdefining_key(selfdefining_name(field)))
+            if selfdefining is not None:
+                rows.append((division, serial, code_op, selfdefining.division, selfdefining.code, value))
+        return rows
+
     def get_field_selfdefining(self, human_name):
         parts = human_name.split()
         field = parts[0].lower() + ''.join(part.capitalize() for part in parts[1:])
@@ -614,11 +1197,16 @@ class DatabaseVeolab (object):
             "INSERT INTO LABRES (" + ", ".join(labres_columns) + ") "
             "VALUES (" + ", ".join(["%s"] * len(labres_columns)) + ")"
         )
+        # Resuelve técnicas, analistas y departamentos de todos los parámetros de una vez
+        resolved = self.resolve_parameters(
+            [igeo_parameter['codigoObjetoAnalisis'] for igeo_parameter in payload['objetosAnalisis']],
+            div_client, cod_client, div_nor, cod_nor
+        )
         resnord = 1  # Ordinal 1..n de la técnica en la operación (convenio RESNORD); solo avanza en filas insertadas
         for igeo_parameter in payload['objetosAnalisis']:
-            tec_fields = self.get_parameter(igeo_parameter['codigoObjetoAnalisis'], div_client, cod_client, div_nor, cod_nor)
+            tec_fields = resolved['parameters'][igeo_parameter['codigoObjetoAnalisis']]
             if tec_fields is not None:
-                analyst = self.get_analyst(tec_fields['DEL3COD'], tec_fields['TEC1COD'])
+                analyst = resolved['analysts'].get((tec_fields['DEL3COD'], tec_fields['TEC1COD']))
                 if analyst is not None:
                     div_analyst = analyst['EMP3DEL']
                     cod_analyst = analyst['EMP3COD']
@@ -658,18 +1246,10 @@ class DatabaseVeolab (object):
             else:
                 errores_mapeo.append(f"Parámetro sin mapear (LABTYC.TYCCREF): {igeo_parameter['codigoObjetoAnalisis']}")
 
-        if len(array_val) > 0:
-            self.cursor.executemany(labres_query, array_val)
+        self.queue_rows(labres_query, array_val)
 
         # Tabla LABCOR (columnas)
-        query = """
-            INSERT INTO LABCOR (OPE3DEL, OPE3SER, OPE3COD, TEC3DEL, TEC3COD, COR1COD, CORCTIT, 
-                CORCTI2, CORCTI3, CORBINF, CORBRES, CORBEDI, CORBACT)
-            SELECT %s, %s, %s, TEC3DEL, TEC3COD, COT1COD, COTCTIT, 
-                COTCTI2, COTCTI3, COTBINF, COTBRES, COTBEDI, COTBACT FROM LABCOT                
-            WHERE TEC3DEL = %s AND TEC3COD = %s
-        """
-        self.cursor.executemany(query, array_cor)
+        self.queue_rows(LABCOR_FROM_LABCOT, array_cor)
 
         # Tabla LABOPE (operaciones)
         columns = [
@@ -716,9 +1296,15 @@ class DatabaseVeolab (object):
         if self.column_exists('LABOPE', 'OPEBMAP'):
             columns.append("OPEBMAP")
             val.append("T" if errores_mapeo else "F")
+        # Huella de los datos aplicados, para reconocer un UPDATE idéntico posterior
+        fingerprint = payload_fingerprint(payload, igeo_id)
+        if self.column_exists('LABOPE', 'OPECHSH'):
+            columns.append("OPECHSH")
+            val.append(fingerprint)
+        self._applied.append(((self.division, self.serial, id_op), fingerprint))
         placeholders = ", ".join(["%s"] * len(val))
         query = f"INSERT INTO LABOPE ({', '.join(columns)}) VALUES ({placeholders})"
-        self.cursor.execute(query, val)
+        self.queue_rows(query, [val])
         
         # Tabla LABOYA (valores de autodefinibles)
         query = """
@@ -726,53 +1312,39 @@ class DatabaseVeolab (object):
             VALUES (%s, %s, %s, %s, %s)
         """
         val = (self.division, self.serial, id_op, '', 0) # El autodefinible cero es obligatorio
-        self.cursor.execute(query, val)
+        self.queue_rows(query, [val])
 
-        for field, value in self.iter_fields_with_subgroup(payload, "otrosParametros"):
-            selfdefining = self.get_selfdefining(field)
-            if selfdefining is not None:
-                # Inserta los campos autodefinibles
-                query = """
-                    INSERT INTO LABOYA (OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD, OYACVAL) 
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                val = (self.division, self.serial, id_op, selfdefining.division, selfdefining.code, value)
-                self.cursor.execute(query, val)
+        # Inserta los campos autodefinibles
+        self.queue_rows(LABOYA_VALUES, self.selfdefining_rows(payload, self.division, self.serial, id_op))
 
         # Tabla LABOYS (servicios)
         if cod_service is not None:
             query = """
                 INSERT INTO LABOYS (OPE3DEL, OPE3SER, OPE3COD, SER3DEL, SER3COD, OYSNPRE, OYSCDTO, OYSNPOS, OYSBPRE) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'T')
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             """
-            val = (self.division, self.serial, id_op, div_service, cod_service, prize, discount, 1)
-            self.cursor.execute(query, val)
+            val = (self.division, self.serial, id_op, div_service, cod_service, prize, discount, 1, 'T')
+            self.queue_rows(query, [val])
         
         # Tabla LABOYE (empleados)
-        array_val.clear()
         query = """
             INSERT INTO LABOYE (OPE3DEL, OPE3SER, OPE3COD, EMP3DEL, EMP3COD) 
             VALUES (%s, %s, %s, %s, %s)
         """
-        for employe in array_employes:
-            array_val.append((self.division, self.serial, id_op, employe[0], employe[1]))        
-        if len(array_val) > 0:
-            self.cursor.executemany(query, array_val)
+        array_val = [(self.division, self.serial, id_op, employe[0], employe[1]) for employe in array_employes]
+        self.queue_rows(query, array_val)
 
         # Tabla LABOYD (departamentos)            
-        array_val.clear()
+        array_val = []
         for section in array_sections:
-            query = "SELECT DISTINCT DEP2DEL, DEP2COD FROM LABSEC WHERE DEL3COD = %s AND SEC1COD = %s "
-            self.cursor.execute(query, section)
-            row = self.cursor.fetchone()
+            row = resolved['departments'].get(section)
             if row is not None:            
-                query = """
-                    INSERT INTO LABOYD (OPE3DEL, OPE3SER, OPE3COD, DEP3DEL, DEP3COD) 
-                    VALUES (%s, %s, %s, %s, %s)
-                """
                 array_val.append((self.division, self.serial, id_op, row['DEP2DEL'], row['DEP2COD']))
-
-        self.cursor.executemany(query, array_val)
+        query = """
+            INSERT INTO LABOYD (OPE3DEL, OPE3SER, OPE3COD, DEP3DEL, DEP3COD) 
+            VALUES (%s, %s, %s, %s, %s)
+        """
+        self.queue_rows(query, array_val)
 
         # Avisos de errores de mapeo en IGELOG (el canal que el usuario consulta en Veolab).
         # Se emiten con la operación ya insertada: un aviso por código y un resumen por muestra.
@@ -787,24 +1359,39 @@ class DatabaseVeolab (object):
             self.logdb(nivel, f"Muestra creada con errores de mapeo: {ref}", "; ".join(errores_mapeo))
 
     def script_delete_sample(self, reference_op):
-        # Crea todos los registros necesarios para crear una muestra en Veolab
-        dic_val = self.get_operation (reference_op)        
-        if dic_val is not None:
-            val = list(dic_val.values())
-            query = "DELETE FROM LABCOR WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)
-            query = "DELETE FROM LABOYE WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)
-            query = "DELETE FROM LABOYD WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)
-            query = "DELETE FROM LABOYA WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)
-            query = "DELETE FROM LABOYS WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)        
-            query = "DELETE FROM LABRES WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s"
-            self.cursor.execute(query, val)
-            query = "DELETE FROM LABOPE WHERE DEL3COD = %s AND OPE1SER = %s AND OPE1COD = %s"
-            self.cursor.execute(query, val)
+        # Borra todos los registros de la operación con la referencia indicada.
+        # Devuelve True si existía.
+        return reference_op in self.script_delete_samples([reference_op])
+
+    def script_delete_samples(self, references):
+        # Borrado por conjuntos: localiza todas las operaciones en una consulta y borra
+        # cada tabla con un único DELETE por clave (OPE3DEL, OPE3SER, OPE3COD) IN (...).
+        # Devuelve las referencias que existían.
+        references = [ref for ref in dict.fromkeys(references) if ref != "" and ref is not None]
+        if not references:
+            return set()
+        keys_sql, keys_val = self.values_table(list(enumerate(references)), ["K_IDX", "K_REF"])
+        query = f"""
+            SELECT CLAVES.K_IDX, LABOPE.DEL3COD, LABOPE.OPE1SER, LABOPE.OPE1COD
+            FROM {keys_sql} AS CLAVES
+            JOIN LABOPE ON (LABOPE.OPECREF = CLAVES.K_REF)
+            WHERE (LABOPE.OPECIGE = 'R' OR LABOPE.OPECIGE = 'E')
+        """
+        self.cursor.execute(query, keys_val)
+        operations = {}
+        for row in self.cursor.fetchall():
+            # Como get_operation: la primera operación de cada referencia
+            operations.setdefault(references[row['K_IDX']], (row['DEL3COD'], row['OPE1SER'], row['OPE1COD']))
+        if not operations:
+            return set()
+        keys = list(operations.values())
+        condition, val = tuple_in(["OPE3DEL", "OPE3SER", "OPE3COD"], keys)
+        # Hijas primero y la cabecera al final, como el cliente de Veolab
+        for table in DELETE_TABLES:
+            self.cursor.execute(f"DELETE FROM {table} WHERE {condition}", val)
+        condition, val = tuple_in(["DEL3COD", "OPE1SER", "OPE1COD"], keys)
+        self.cursor.execute(f"DELETE FROM LABOPE WHERE {condition}", val)
+        return set(operations)
 
     def sample_exists(self, reference_op, client_igeo, codigo_delegacion=None, igeo_id=None):
         # Comprueba si ya existe la operación (para idempotencia: RabbitMQ puede
@@ -818,92 +1405,148 @@ class DatabaseVeolab (object):
         # entre el CREATE y sus UPDATE, y no depende de cómo se resuelva el cliente (que puede
         # cambiar entre mensajes y provocaba duplicados). Si no hay id o no aparece, se cae al
         # emparejamiento histórico por referencia (OPECREF) + cliente Veolab resuelto.
-        # Devuelve dict (DEL3COD, OPE1SER, OPE1COD, OPENEST) o None.
+        # Devuelve dict (DEL3COD, OPE1SER, OPE1COD, OPENEST y OPECHSH si existe) o None.
+        columns = "DEL3COD, OPE1SER, OPE1COD, OPENEST"
+        if self.column_exists('LABOPE', 'OPECHSH'):
+            columns += ", OPECHSH"
         if igeo_id is not None and str(igeo_id).strip() != "":
             self.cursor.execute(
-                "SELECT DEL3COD, OPE1SER, OPE1COD, OPENEST FROM LABOPE WHERE OPECIDG = %s",
+                f"SELECT {columns} FROM LABOPE WHERE OPECIDG = %s",
                 (igeo_id,)
             )
             row = self.cursor.fetchone()
             if row is not None:
                 return row
         div_client, cod_client = self.get_client(client_igeo, codigo_delegacion)
-        query = """
-            SELECT DEL3COD, OPE1SER, OPE1COD, OPENEST FROM LABOPE
+        query = f"""
+            SELECT {columns} FROM LABOPE
             WHERE OPECREF = %s AND CLI2DEL = %s AND CLI2COD = %s
         """
         self.cursor.execute(query, (reference_op, div_client, cod_client))
         return self.cursor.fetchone()
 
+    def batch_keys(self, reference_op, client_igeo, igeo_id):
+        keys = [("REF", reference_op, client_igeo)]
+        if igeo_id is not None and str(igeo_id).strip() != "":
+            keys.append(("IDG", str(igeo_id)))
+        return keys
+
+    def sample_in_batch(self, reference_op, client_igeo, igeo_id):
+        # En modo lote las altas aún no están en LABOPE (se vuelcan al cerrar el lote),
+        # así que una reentrega dentro del mismo lote se detecta aquí.
+        return self._batch and any(k in self._batch_keys for k in self.batch_keys(reference_op, client_igeo, igeo_id))
+
     def create_sample(self, payload, client_id, igeo_id, raw_json=None):
         self.ensure_connection()
+        self.refresh_mappings()
         # Relee la serie predeterminada vigente (puede haber cambiado sin reiniciar).
         self.refresh_serial()
-        if self.sample_exists(payload['codigoMuestra'], client_id, payload.get('codigoDelegacion'), igeo_id):
+        if self.sample_in_batch(payload['codigoMuestra'], client_id, igeo_id) or \
+                self.sample_exists(payload['codigoMuestra'], client_id, payload.get('codigoDelegacion'), igeo_id):
             self.logdb("WARNING", f"Alta duplicada ignorada (la muestra ya existe): {payload['codigoMuestra']}", "", True)
             return
         self.script_create_sample(payload, client_id, igeo_id, raw_json)
+        if self._batch:
+            self._batch_keys.update(self.batch_keys(payload['codigoMuestra'], client_id, igeo_id))
         self.logdb("CREATE", f"Muestra creada: {payload['codigoMuestra']}", "")
-        self.connection.commit()
-
-    def script_update_sample(self, payload, op, igeo_id=None, raw_json=None):
-        # Actualiza SOLO la cabecera de la operación y rehace los autodefinibles.
-        # No toca parámetros (LABRES/LABCOR) ni resultados del laboratorio.
+        self.commit()
+
+    def script_update_sample(self, payload, op, igeo_id=None, raw_json=None, fingerprint=None):
+        # Actualiza SOLO la cabecera de la operación y los autodefinibles, escribiendo
+        # únicamente las columnas y filas de LABOYA que han cambiado respecto a lo
+        # guardado. No toca parámetros (LABRES/LABCOR) ni resultados del laboratorio.
+        # Devuelve False si los datos ya coincidían y no se escribió nada (salvo, si
+        # difería, la huella OPECHSH).
         div, serial, code = op['DEL3COD'], op['OPE1SER'], op['OPE1COD']
-
-        set_cols = ["OPECDES = %s", "OPECOBS = %s", "OPETREC = %s", "OPECTEM = %s",
-                    "OPECENV = %s", "OPECLUR = %s", "OPECCAN = %s", "OPECREC = %s"]
-        set_val = [
-            payload['muestra'],
-            payload['observaciones'],
-            datetime.strptime(payload['fechaCreacion'], '%d/%m/%Y %H:%M:%S'),
-            payload['temperatura'],
-            payload['tipoEnvase'],
-            payload['lugarRecogidaMuestra'],
-            payload['volumenMuestra'],
-            payload['transportista'],
-        ]
+        key = (div, serial, code)
+
+        values = {
+            "OPECDES": payload['muestra'],
+            "OPECOBS": payload['observaciones'],
+            "OPETREC": datetime.strptime(payload['fechaCreacion'], '%d/%m/%Y %H:%M:%S'),
+            "OPECTEM": payload['temperatura'],
+            "OPECENV": payload['tipoEnvase'],
+            "OPECLUR": payload['lugarRecogidaMuestra'],
+            "OPECCAN": payload['volumenMuestra'],
+            "OPECREC": payload['transportista'],
+        }
         # Si la operación se emparejó por referencia+cliente (respaldo) pero no tenía el
         # id de iGEO guardado, se rellena ahora OPECIDG para que los próximos UPDATE la
         # localicen directamente por id.
         if igeo_id is not None and str(igeo_id).strip() != "":
-            set_cols.append("OPECIDG = %s")
-            set_val.append(igeo_id)
-        # Actualiza el JSON recibido si el usuario ha añadido la columna OPECJSO (opcional).
-        # Se normaliza (indentado + CRLF) para que el visor de Veolab lo muestre bien.
-        if raw_json is not None and self.column_exists('LABOPE', 'OPECJSO'):
-            set_cols.append("OPECJSO = %s")
-            set_val.append(self.json_for_viewer(raw_json))
-        query = (
-            "UPDATE LABOPE SET " + ", ".join(set_cols) +
-            " WHERE DEL3COD = %s AND OPE1SER = %s AND OPE1COD = %s"
-        )
-        val = tuple(set_val) + (div, serial, code)
-        self.cursor.execute(query, val)
-
-        # Los autodefinibles son valores del técnico (sin resultados de laboratorio),
-        # así que se pueden rehacer a partir del payload.
+            values["OPECIDG"] = igeo_id
         self.cursor.execute(
-            "DELETE FROM LABOYA WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s",
-            (div, serial, code)
+            f"SELECT {', '.join(values)} FROM LABOPE WHERE DEL3COD = %s AND OPE1SER = %s AND OPE1COD = %s",
+            key
         )
-        # El autodefinible cero es obligatorio
+        current = self.cursor.fetchone() or {}
+        changes = {column: value for column, value in values.items() if not same_value(current.get(column), value)}
+
+        # Autodefinibles: se comparan con las filas guardadas y solo se borran, cambian
+        # o insertan las que difieren.
+        desired = {(row[3], row[4]): row[5] for row in self.selfdefining_rows(payload, div, serial, code)}
         self.cursor.execute(
-            "INSERT INTO LABOYA (OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD) VALUES (%s, %s, %s, %s, %s)",
-            (div, serial, code, '', 0)
+            "SELECT AUT3DEL, AUT3COD, OYACVAL FROM LABOYA WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s",
+            key
         )
-        for field, value in self.iter_fields_with_subgroup(payload, "otrosParametros"):
-            selfdefining = self.get_selfdefining(field)
-            if selfdefining is not None:
+        stored = {(row['AUT3DEL'], row['AUT3COD']): row['OYACVAL'] for row in self.cursor.fetchall()}
+        removed = [aut for aut in stored if aut != SELFDEFINING_ZERO and aut not in desired]
+        updated = [(value, ) + key + aut for aut, value in desired.items() if aut in stored and not same_value(stored[aut], value)]
+        inserted = [key + aut + (value, ) for aut, value in desired.items() if aut not in stored]
+
+        has_hash = fingerprint is not None and self.column_exists('LABOPE', 'OPECHSH')
+        if not changes and not removed and not updated and not inserted and SELFDEFINING_ZERO in stored:
+            # Nada que escribir: como mucho se guarda la huella, si la guardada es otra
+            if has_hash and op.get('OPECHSH') != fingerprint:
                 self.cursor.execute(
-                    "INSERT INTO LABOYA (OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD, OYACVAL) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (div, serial, code, selfdefining.division, selfdefining.code, value)
+                    "UPDATE LABOPE SET OPECHSH = %s WHERE DEL3COD = %s AND OPE1SER = %s AND OPE1COD = %s",
+                    (fingerprint, ) + key
                 )
+            if fingerprint is not None:
+                self._applied.append((key, fingerprint))
+            return False
+
+        # Con algún cambio se guardan también el JSON recibido y la huella (columnas opcionales)
+        if raw_json is not None and self.column_exists('LABOPE', 'OPECJSO'):
+            changes["OPECJSO"] = self.json_for_viewer(raw_json)
+        if has_hash:
+            changes["OPECHSH"] = fingerprint
+        if changes:
+            query = (
+                "UPDATE LABOPE SET " + ", ".join(f"{column} = %s" for column in changes) +
+                " WHERE DEL3COD = %s AND OPE1SER = %s AND OPE1COD = %s"
+            )
+            self.cursor.execute(query, tuple(changes.values()) + key)
+
+        if removed:
+            placeholders = ", ".join(["(%s, %s)"] * len(removed))
+            self.cursor.execute(
+                f"DELETE FROM LABOYA WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s AND (AUT3DEL, AUT3COD) IN ({placeholders})",
+                key + tuple(value for aut in removed for value in aut)
+            )
+        if updated:
+            self.cursor.executemany(
+                "UPDATE LABOYA SET OYACVAL = %s WHERE OPE3DEL = %s AND OPE3SER = %s AND OPE3COD = %s AND AUT3DEL = %s AND AUT3COD = %s",
+                updated
+            )
+        # El autodefinible cero es obligatorio
+        if SELFDEFINING_ZERO not in stored:
+            self.cursor.execute(
+                "INSERT INTO LABOYA (OPE3DEL, OPE3SER, OPE3COD, AUT3DEL, AUT3COD) VALUES (%s, %s, %s, %s, %s)",
+                key + SELFDEFINING_ZERO
+            )
+        self.queue_rows(LABOYA_VALUES, inserted)
+        if fingerprint is not None:
+            self._applied.append((key, fingerprint))
+        return True
 
     def update_sample(self, payload, client_id, igeo_id, raw_json=None):
         # Modifica una muestra existente EN SITIO: solo cabecera + autodefinibles, y solo
         # si está registrada (OPENEST=0). Si no se encuentra, se da de alta. No borra ni recrea.
         self.ensure_connection()
+        self.refresh_mappings()
+        # En modo lote, vuelca antes las altas pendientes para que la búsqueda las vea.
+        self.flush_pending()
         op = self.get_operation_full(payload['codigoMuestra'], client_id, payload.get('codigoDelegacion'), igeo_id)
         if op is None:
             # No existía (p.ej. el CREATE se perdió o la muestra se borró en Veolab): se crea
@@ -913,7 +1556,9 @@ class DatabaseVeolab (object):
             self.refresh_serial()
             self.logdb("WARNING", f"UPDATE de muestra inexistente; se crea como alta: {payload['codigoMuestra']}", f"idEntidadIgeo={igeo_id}", True)
             self.script_create_sample(payload, client_id, igeo_id, raw_json)
-            self.connection.commit()
+            if self._batch:
+                self._batch_keys.update(self.batch_keys(payload['codigoMuestra'], client_id, igeo_id))
+            self.commit()
             return
         try:
             registrada = int(op['OPENEST']) == 0
@@ -922,13 +1567,65 @@ class DatabaseVeolab (object):
         if not registrada:
             self.logdb("WARNING", f"UPDATE no aplicado: la muestra ya avanzó de estado y no admite cambios (OPENEST={op['OPENEST']}): {payload['codigoMuestra']}", "", True)
             return
-        self.script_update_sample(payload, op, igeo_id, raw_json)
-        self.logdb("UPDATE", f"Muestra actualizada: {payload['codigoMuestra']}", "")
-        self.connection.commit()
+        # Un UPDATE con los mismos datos que los ya aplicados no escribe nada
+        fingerprint = payload_fingerprint(payload, igeo_id)
+        operation = (op['DEL3COD'], op['OPE1SER'], op['OPE1COD'])
+        if fingerprint in (op.get('OPECHSH'), idempotency_index.applied_fingerprint(operation)):
+            logging.info(f"UPDATE idéntico al ya aplicado; no se modifica: {payload['codigoMuestra']}")
+            return
+        if self.script_update_sample(payload, op, igeo_id, raw_json, fingerprint):
+            self.logdb("UPDATE", f"Muestra actualizada: {payload['codigoMuestra']}", "")
+        else:
+            logging.info(f"UPDATE sin cambios en cabecera ni autodefinibles: {payload['codigoMuestra']}")
+        self.commit()
 
     def delete_sample(self, payload):
         # Borra de la base de datos la muestra de entrada
+        self.delete_samples([payload])
+
+    def delete_samples(self, payloads):
+        # Borra varias muestras (p.ej. DELETE consecutivos de una campaña anulada) en
+        # una sola transacción, con el resultado de cada una en el log.
         self.ensure_connection()
-        self.script_delete_sample(payload['codigoMuestra'])
-        self.logdb("DELETE", f"Muestra eliminada: {payload['codigoMuestra']}", "")
-        self.connection.commit()
\ No newline at end of file
+        self.flush_pending()
+        deleted = self.script_delete_samples([payload['codigoMuestra'] for payload in payloads])
+        for payload in payloads:
+            if payload['codigoMuestra'] in deleted:
+                self.logdb("DELETE", f"Muestra eliminada: {payload['codigoMuestra']}", "")
+            else:
+                self.logdb("WARNING", f"DELETE de muestra inexistente (ya borrada o no enviada por iGEO): {payload['codigoMuestra']}", "")
+        self.commit()
+
+
+def connect_database():
+    # Abre una conexión nueva, fuera del pool
+    database = DatabaseVeolab()
+    database.open()
+    return database
+
+
+database_pool = ConnectionPool(connect_database)
+
+
+def open_database():
+    # Saca una conexión del pool; close() la devuelve. Si no se consigue, devuelve
+    # un DatabaseVeolab sin conexión (connection None), como open().
+    try:
+        return database_pool.acquire()
+    except pymysql.Error as e:
+        logging.error(f"Error al establecer la conexión con la base de datos: {e}")
+        return DatabaseVeolab()
+
+
+key_allocator = KeyAllocator(open_database)
+
+
+def configure():
+    # Aplica VEOLAB_DB_* y VEOLAB_KEY_BLOCK al pool y al reparto de claves; se llama
+    # al arrancar el servicio, antes de abrir la primera conexión
+    database_pool.size = settings.env_int('VEOLAB_DB_POOL', 16, minimum=1)
+    database_pool.wait_timeout = settings.env_int('VEOLAB_DB_POOL_WAIT', 30, minimum=1)
+    database_pool.validate_idle = settings.env_int('VEOLAB_DB_VALIDATE', 30, minimum=0)
+    database_pool.idle_timeout = settings.env_int('VEOLAB_DB_IDLE_TIMEOUT', 600, minimum=1)
+    database_pool.max_retry_delay = settings.env_int('VEOLAB_DB_RETRY_MAX', 60, minimum=1)
+    key_allocator.block_size = settings.env_int('VEOLAB_KEY_BLOCK', 50, minimum=1)
@@ -0,0 +1,114 @@
+import logging
+import math
+import time
+
+class PrefetchController(object):
+    """
+    Ajusta el prefetch de un consumidor a la velocidad de MySQL. Cada interval
+    segundos recibe el tiempo de servicio de los mensajes procesados (media móvil
+    por mensaje), la profundidad de la cola en el broker (queue_declare pasivo) y
+    los fallos del handler, y decide:
+      - prefetch: los mensajes que caben en buffer segundos de trabajo (con
+        workers hilos procesando), entre minimum y maximum. Con MySQL lento baja
+        (menos mensajes retenidos sin confirmar); con MySQL rápido y cola acumulada sube
+        (como mucho el doble en cada ajuste) para cubrir la latencia con el broker.
+        Si la cola está vacía no sube: no hay nada que traer.
+      - pausa: el circuito se abre tras failure_threshold fallos seguidos (o
+        mientras el pool de MySQL está en espera de reconexión) y el consumo se
+        detiene cooldown segundos; después se prueba de nuevo y, si vuelve a
+        fallar, la espera se dobla hasta max_cooldown. Un éxito lo cierra.
+    No habla con RabbitMQ: quien lo usa aplica las decisiones (ver
+    ShardedWorkerPool.regulate y AsyncConsumer).
+    """
+
+    def __init__(self, name, initial=50, minimum=10, maximum=200, buffer=2.0, workers=1, batch_size=1,
+                 failure_threshold=3, cooldown=10, max_cooldown=120, interval=5, circuit=None):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = min(max(1, minimum, batch_size), self.maximum)  # Que quepa un lote entero
+        self.prefetch = min(max(initial, self.minimum), self.maximum)
+        self.buffer = buffer
+        self.workers = max(1, workers)
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.interval = interval
+        self.circuit = circuit  # circuit() -> True si MySQL no está disponible
+        self.service_time = None  # Segundos por mensaje (media móvil)
+        self.depth = None  # Mensajes en la cola del broker
+        self._cooldown = cooldown
+        self._open_until = 0.0
+        self._last = time.monotonic()
+        self._last_stats = time.monotonic()
+        self.paused = False
+        self.adjustments = 0
+        self.circuit_opens = 0
+
+    @property
+    def adaptive(self):
+        return self.minimum < self.maximum
+
+    def due(self):
+        return time.monotonic() - self._last >= self.interval
+
+    def update(self, seconds, messages, failures, failures_in_row, depth):
+        # seconds / messages: tiempo de servicio y mensajes procesados desde la última
+        # llamada; failures: fallos en ese tiempo; failures_in_row: fallos seguidos
+        # hasta ahora; depth: mensajes en cola (None si no se pudo consultar).
+        # Devuelve (prefetch, pausa).
+        now = time.monotonic()
+        self._last = now
+        if messages:
+            sample = seconds / messages
+            self.service_time = sample if self.service_time is None else 0.7 * self.service_time + 0.3 * sample
+        if depth is not None:
+            self.depth = depth
+
+        if failures and failures_in_row >= self.failure_threshold and now >= self._open_until:
+            self._open_until = now + self._cooldown
+            self.circuit_opens += 1
+            logging.warning(
+                f"Circuito de MySQL abierto en {self.name} tras {failures_in_row} fallos seguidos; "
+                f"consumo en pausa {self._cooldown:.0f}s"
+            )
+            self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+        elif messages > failures and failures_in_row == 0:
+            self._cooldown = self.base_cooldown
+        paused = now < self._open_until or (self.circuit is not None and self.circuit())
+        if paused != self.paused:
+            self.paused = paused
+            if not paused:
+                logging.info(f"Circuito de MySQL cerrado en {self.name}; se reanuda el consumo")
+
+        if self.adaptive and self.service_time and not paused:
+            target = math.ceil(self.buffer * self.workers / max(self.service_time, 0.0001))
+            target = min(max(target, self.minimum), self.maximum)
+            if target > self.prefetch:
+                target = self.prefetch if self.depth == 0 else min(target, self.prefetch * 2)
+            if abs(target - self.prefetch) >= max(2, self.prefetch // 4):
+                logging.info(
+                    f"Prefetch de {self.name}: {self.prefetch} -> {target} "
+                    f"({self.service_time * 1000:.1f} ms por mensaje, {self.depth if self.depth is not None else '?'} en cola)"
+                )
+                self.prefetch = target
+                self.adjustments += 1
+        self.log_stats()
+        return self.prefetch, paused
+
+    def log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Prefetch de {self.name}: {self.stats()}")
+
+    def stats(self):
+        return {
+            'prefetch': self.prefetch,
+            'min': self.minimum,
+            'max': self.maximum,
+            'service_ms': round(self.service_time * 1000, 1) if self.service_time is not None else None,
+            'depth': self.depth,
+            'adjustments': self.adjustments,
+            'circuit_opens': self.circuit_opens,
+            'paused': self.paused,
+        }
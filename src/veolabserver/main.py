@@ -1,4 +1,5 @@
 import pika
+import pymysql
 import json
 import time
 import signal
@@ -7,101 +8,313 @@ import re
 import logging
 import hashlib
 from logging.handlers import RotatingFileHandler
-from threading import Thread, Event
+from threading import Thread, Event, current_thread, main_thread
 from .database.database_config import DatabaseConfig
-from .database.database_veolab import DatabaseVeolab
+from .database import database_veolab, database_log, database_cache, database_idempotency
+from .database.database_veolab import open_database, database_pool, key_allocator
+from .database.database_log import log_writer
+from .database.database_idempotency import idempotency_index
+from .database.database_reports import ReportScanner
+from . import settings
+from .workers import ShardedWorkerPool
+from .flow import PrefetchController
+from .publisher import ConfirmedPublisher
+from .runtime_asyncio import AsyncioRuntime
+from .outbox import ReportOutbox
 from pika.exceptions import AMQPConnectionError, IncompatibleProtocolError
 
-db_cfg = DatabaseConfig()
-db_cfg.read_config()
-
-instance_id = re.sub(r"[^a-zA-Z0-9_-]", "_", db_cfg.database.lower())
-
-base_log_dir = "/var/log/veolabserver"
-if os.name == 'nt':  # Windows
-    base_log_dir = "C:\\veolabserver\\logs"
-
-log_dir = os.path.join(base_log_dir, instance_id)
-os.makedirs(log_dir, exist_ok=True)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        RotatingFileHandler(
-            os.path.join(log_dir, "veolabserver.log"),
-            maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
-        ),
-        logging.StreamHandler()
-    ]
-)
-# pika es muy verboso en INFO (estado de canales, "Connection is idle", etc.);
-# solo nos interesan sus avisos y errores.
-logging.getLogger("pika").setLevel(logging.WARNING)
-
 stop_event = Event()
 
+# Configuración de RabbitMQ vigente (ACCPAR) y su generación, que aumenta con cada cambio
+rabbit_state = (0, None)
+
+# Se preparan en configure(), al arrancar el servicio (no al importar el módulo)
+log_dir = None
+report_scanner = None  # Marca de agua de la búsqueda de informes
+report_outbox = None  # Bandeja de salida de informes no entregados
+started_at = None  # Arranque del proceso (time.monotonic), para medir el primer mensaje
+imported_at = time.monotonic()  # Respaldo de started_at donde no hay /proc
+first_message_at = None
+
+
+def configure():
+    # Lee la configuración, prepara el directorio de logs de la instancia y el
+    # logging, y crea los componentes que guardan su estado junto a los logs.
+    # Solo la primera llamada hace algo.
+    global log_dir, report_scanner, report_outbox, started_at
+    if log_dir is not None:
+        return
+    started_at = process_started_at()
+    db_cfg = DatabaseConfig.snapshot()
+
+    instance_id = re.sub(r"[^a-zA-Z0-9_-]", "_", db_cfg.database.lower())
+
+    base_log_dir = "/var/log/veolabserver"
+    if os.name == 'nt':  # Windows
+        base_log_dir = "C:\\veolabserver\\logs"
+
+    instance_log_dir = os.path.join(base_log_dir, instance_id)
+    os.makedirs(instance_log_dir, exist_ok=True)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        handlers=[
+            RotatingFileHandler(
+                os.path.join(instance_log_dir, "veolabserver.log"),
+                maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
+            ),
+            logging.StreamHandler()
+        ]
+    )
+    # pika es muy verboso en INFO (estado de canales, "Connection is idle", etc.);
+    # solo nos interesan sus avisos y errores.
+    logging.getLogger("pika").setLevel(logging.WARNING)
+
+    configure_settings()
+
+    # Marca de agua de la búsqueda de informes, persistida junto a los logs de la instancia
+    report_scanner = ReportScanner(
+        os.path.join(instance_log_dir, "report_watermark.json"),
+        settings.env_int('VEOLAB_REPORT_RESCAN', 3600, minimum=0)
+    )
+
+    # Bandeja de salida de informes no entregados (por defecto, junto a los logs)
+    report_outbox = ReportOutbox(
+        settings.env_str('VEOLAB_OUTBOX_DIR', os.path.join(instance_log_dir, "outbox")),
+        base_delay=settings.env_int('VEOLAB_OUTBOX_RETRY', 10, minimum=1),
+        max_delay=settings.env_int('VEOLAB_OUTBOX_MAX_DELAY', 3600, minimum=1)
+    )
+    log_dir = instance_log_dir
+
+
+def configure_settings():
+    # Lee los ajustes VEOLAB_* del entorno y los aplica a los parámetros del módulo
+    # y a los componentes compartidos (pool, caché, IGELOG...). Importar el paquete
+    # no lee el .env ni toca os.environ.
+    global PREFETCH_MIN, PREFETCH_MAX, PREFETCH_BUFFER, REPORT_WINDOW, PUBLISH_WINDOW, RUNTIME
+    global HANDOFF_MAX, HANDOFF_BYTES, STATE_BATCH, STATE_BATCH_WAIT
+    PREFETCH_MIN = settings.env_int('VEOLAB_PREFETCH_MIN', 10, minimum=1)
+    PREFETCH_MAX = settings.env_int('VEOLAB_PREFETCH_MAX', 200, minimum=1)
+    PREFETCH_BUFFER = settings.env_int('VEOLAB_PREFETCH_BUFFER_MS', 2000, minimum=1) / 1000
+    REPORT_WINDOW = settings.env_int('VEOLAB_REPORT_WINDOW', 20, minimum=1)
+    PUBLISH_WINDOW = settings.env_int('VEOLAB_PUBLISH_WINDOW', 10, minimum=1)
+    RUNTIME = (settings.env_str('VEOLAB_RUNTIME', 'threads') or 'threads').lower()
+    HANDOFF_MAX = settings.env_int('VEOLAB_HANDOFF_MAX', 200, minimum=1)
+    HANDOFF_BYTES = settings.env_int('VEOLAB_HANDOFF_MB', 32, minimum=1) * 1024 * 1024
+    STATE_BATCH = settings.env_int('VEOLAB_STATE_BATCH', 100, minimum=1)
+    STATE_BATCH_WAIT = settings.env_int('VEOLAB_STATE_BATCH_MS', 200, minimum=0) / 1000
+    database_veolab.configure()
+    database_log.configure()
+    database_cache.configure()
+    database_idempotency.configure()
+
+
+def process_started_at():
+    # Instante de arranque del proceso en la escala de time.monotonic(), para que
+    # el tiempo hasta el primer mensaje incluya el arranque del intérprete y los
+    # imports. Sin /proc (Windows) se usa el momento en que se importó el módulo.
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+        return time.monotonic() - max(0.0, age)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return imported_at
+
+
+def note_first_message(queue):
+    # Registra el tiempo desde el arranque hasta el primer mensaje recibido
+    global first_message_at
+    if first_message_at is None and started_at is not None:
+        first_message_at = time.monotonic()
+        logging.info(f"Primer mensaje recibido ({queue}) {first_message_at - started_at:.2f}s después del arranque")
+
+PREFETCH_COUNT = 50  # Mensajes sin confirmar que el broker entrega por consumidor (valor inicial)
+# Ajustes VEOLAB_*: valores por defecto; configure() los lee del entorno (y del .env)
+PREFETCH_MIN = 10
+PREFETCH_MAX = 200
+PREFETCH_BUFFER = 2.0  # Segundos de trabajo retenido en el proceso
+
+REPORT_WINDOW = 20  # Candidatas leídas y precargadas por bloque
+
+PUBLISH_WINDOW = 10  # Informes publicados sin confirmar
+REPORT_CONFIRM_TIMEOUT = 300  # Segundos sin confirmaciones antes de dar el ciclo por cerrado
+
+RUNTIME = 'threads'  # "threads" o "asyncio"
+
+HANDOFF_MAX = 200  # Mensajes entregados a los hilos sin confirmar antes de pausar el consumo
+HANDOFF_BYTES = 32 * 1024 * 1024
+
+STATE_BATCH = 100  # Cambios de estado de LABOPE por transacción
+STATE_BATCH_WAIT = 0.2  # Espera máxima para agruparlos
+
+PDF_PLACEHOLDER = "\u0000pdfAnalitica\u0000"  # Hueco del PDF al serializar un informe
+
+def encode_report(report):
+    # Serializa el informe a JSON UTF-8. El PDF llega ya en base64 como bytes ASCII
+    # (que no necesitan escape en JSON) y se inserta tal cual en su sitio, sin
+    # pasar por str ni copiarlo más de una vez.
+    datos = report.get('datos') or {}
+    pdf = datos.get('pdfAnalitica')
+    if not isinstance(pdf, (bytes, bytearray)):
+        return json.dumps(report, ensure_ascii=False).encode('utf8')
+    text = json.dumps({**report, 'datos': {**datos, 'pdfAnalitica': PDF_PLACEHOLDER}}, ensure_ascii=False).encode('utf8')
+    prefix, suffix = text.split(json.dumps(PDF_PLACEHOLDER).encode('utf8'), 1)
+    return b"".join((prefix, b'"', pdf, b'"', suffix))
+
+
+def handle_received(json_body, raw_json, database):
+    # Aplica un mensaje de analíticasRecibidas ya decodificado. Propaga las excepciones.
+    payload = json_body['datos']
+    client_id = json_body['empresaId']
+    igeo_id = json_body['idEntidadIgeo']
+
+    comando = json_body['comando'] or 'CREATE'
+    logging.info(f"Recibido {comando} muestra {json_body.get('codigoEntidadIgeo')} (empresa {client_id})")
+    logging.debug(f"Payload recibido: {raw_json}")
+
+    if json_body['comando'] == 'CREATE' or json_body['comando'] is None:
+        database.create_sample(payload, client_id, igeo_id, raw_json)
+    elif json_body['comando'] == 'UPDATE':
+        database.update_sample(payload, client_id, igeo_id, raw_json)
+    elif json_body['comando'] == 'DELETE':
+        database.delete_sample(payload)
+
+
 def process_received(body, database):
     # Procesa mensajes recibidos en la cola de analíticasRecibidas
     try:
         json_body = json.loads(body)
-
-        payload = json_body['datos']
-        client_id = json_body['empresaId']
-        igeo_id = json_body['idEntidadIgeo']
         raw_json = body.decode('utf-8')  # JSON recibido tal cual, para guardarlo en OPECJSO
-
-        comando = json_body['comando'] or 'CREATE'
-        logging.info(f"Recibido {comando} muestra {json_body.get('codigoEntidadIgeo')} (empresa {client_id})")
-        logging.debug(f"Payload recibido: {raw_json}")
-
-        if json_body['comando'] == 'CREATE' or json_body['comando'] is None:
-            database.create_sample(payload, client_id, igeo_id, raw_json)
-        elif json_body['comando'] == 'UPDATE':
-            database.update_sample(payload, client_id, igeo_id, raw_json)
-        elif json_body['comando'] == 'DELETE':
-            database.delete_sample(payload)
+        handle_received(json_body, raw_json, database)
 
     except json.JSONDecodeError as e:
         database.logdb("ERROR", "Error al decodificar el cuerpo JSON:", e, True)
     except Exception as e:
+        # Lo que se llegó a insertar se deshace: el commit del log no debe confirmar un
+        # alta a medias ni recordar su huella (un UPDATE idéntico no la repararía).
+        database.rollback()
         database.logdb("ERROR", "Error inesperado:", e, True)
+        # Un error de MySQL (caído, deadlock...) se propaga: el pool devuelve el mensaje
+        # a la cola y cuenta el fallo para el circuito. Si MySQL rechaza los datos del
+        # propio mensaje, reintentarlo no cambiaría nada: queda registrado y se confirma.
+        if isinstance(e, pymysql.Error) and not isinstance(e, (pymysql.IntegrityError, pymysql.DataError)):
+            raise
+
+
+def process_received_batch(bodies, database):
+    # Aplica varios mensajes de analíticasRecibidas en una sola transacción, con
+    # INSERT multi-fila por tabla. Si cualquiera falla se deshace el lote entero
+    # y se reprocesan uno a uno, para que el mensaje erróneo no arrastre al resto.
+    if len(bodies) == 1:
+        process_received(bodies[0], database)
+        return
+    database.ensure_connection()
+    database.begin_batch()
+    try:
+        deletes = []  # DELETE consecutivos, que se borran juntos por conjuntos
+        for body in bodies:
+            json_body = json.loads(body)
+            if json_body['comando'] == 'DELETE':
+                logging.info(f"Recibido DELETE muestra {json_body.get('codigoEntidadIgeo')} (empresa {json_body['empresaId']})")
+                deletes.append(json_body['datos'])
+            else:
+                if deletes:
+                    database.delete_samples(deletes)
+                    deletes = []
+                handle_received(json_body, body.decode('utf-8'), database)
+        if deletes:
+            database.delete_samples(deletes)
+        database.commit_batch()
+        logging.info(f"Lote de {len(bodies)} mensajes aplicado en una transacción")
+    except Exception as e:
+        database.rollback_batch()
+        if isinstance(e, (pymysql.OperationalError, pymysql.InterfaceError)):
+            # MySQL no está disponible: el lote entero vuelve a la cola
+            raise
+        logging.warning(f"Lote de {len(bodies)} mensajes deshecho ({e}); se procesan uno a uno")
+        for body in bodies:
+            process_received(body, database)
 
 
 def process_performed(body, database):
     # Procesa mensajes recibidos en la cola de resultadoAnaliticasRealizadas
+    process_performed_batch([body], database)
+
+
+def process_performed_batch(bodies, database):
+    # Procesa varios resultados de resultadoAnaliticasRealizadas en una transacción:
+    # un UPDATE ... IN para las operaciones confirmadas y sus líneas de IGELOG en
+    # bloque. Los mensajes se confirman al broker después del commit; si este falla
+    # se propaga la excepción y no se confirman.
+    # La conexión MySQL puede haberse cerrado por inactividad: se revalida una vez
+    # por lote, antes de marcar las muestras o escribir en el log.
+    database.ensure_connection()
+    database.begin_batch()
     try:
-        # La conexión MySQL de este listener puede haberse cerrado por inactividad;
-        # la revalidamos/reconectamos antes de marcar la muestra o escribir en el log.
-        database.ensure_connection()
-        json_body = json.loads(body)
-        if json_body['codigo'] == "1":  # Sin errores
-            codeSample = json_body['mensajeEnviado']['datos']['codigoMuestra']
-            database.mark_sample_report(codeSample)
-            database.logdb("OK", json_body['mensaje'], codeSample, True)
-        else:           
-            database.logdb("ERROR", json_body['mensaje'], json_body['errores'], True)
-
-    except json.JSONDecodeError as e:
-        database.logdb("ERROR", "Error al decodificar el cuerpo JSON:", e, True)
+        references = []
+        for body in bodies:
+            try:
+                json_body = json.loads(body)
+                if json_body['codigo'] == "1":  # Sin errores
+                    codeSample = json_body['mensajeEnviado']['datos']['codigoMuestra']
+                    references.append(codeSample)
+                    database.logdb("OK", json_body['mensaje'], codeSample)
+                else:
+                    database.logdb("ERROR", json_body['mensaje'], json_body['errores'])
+            except json.JSONDecodeError as e:
+                database.logdb("ERROR", "Error al decodificar el cuerpo JSON:", e)
+            except (KeyError, TypeError) as e:
+                database.logdb("ERROR", "Error inesperado:", e)
+        database.mark_samples_report(references)
+        database.commit_batch()
+        if len(bodies) > 1:
+            logging.info(f"Lote de {len(bodies)} resultados aplicado en una transacción ({len(references)} informes recibidos por IGEO)")
     except Exception as e:
+        database.rollback_batch()
         database.logdb("ERROR", "Error inesperado:", e, True)
+        raise
 
 
-def process_reports(connection, channel):    
-    # Envía informes finalizados a la cola de analiticasRealizadas
+def process_reports(publisher):
+    # Envía informes finalizados a la cola de analiticasRealizadas. Se publican en
+    # ventana (hasta VEOLAB_PUBLISH_WINDOW sin confirmar): la operación se marca como
+    # enviada solo cuando el broker confirma su informe. Un informe rechazado,
+    # devuelto o sin confirmar pasa a la bandeja de salida (report_outbox), que lo
+    # reintenta con backoff sin reconstruirlo mientras su fila de origen no cambie.
     database = None
+    in_flight = {}  # clave -> informe publicado pendiente de confirmación
+    confirmed = []  # Informes confirmados por el broker pendientes de marcar como enviados
     try:
-        database = DatabaseVeolab()
-        database.open()
+        database = open_database()
 
         if database.connection is not None:
-            reports = database.get_reports()
-            if reports is not None:                
-                for report in reports:
-                    queue = report.get('cola') # or 'analiticasRealizadas'
+            scan, since = report_scanner.begin(database)
+            # Los informes se construyen de uno en uno a medida que se publican (de
+            # VEOLAB_REPORT_WINDOW en VEOLAB_REPORT_WINDOW candidatas), así que la
+            # memoria del ciclo no depende de cuántos haya pendientes. Los que ya están
+            # en la bandeja no se reconstruyen.
+            in_outbox = set()
+
+            def skip(row):
+                if report_outbox.should_build(row):
+                    return False
+                in_outbox.add(ReportOutbox.key(row))
+                return True
+
+            reports = database.iter_reports(since, REPORT_WINDOW, skip) if scan else iter(())
+            try:
+                for row, report in reports:
+                    report_scanner.row_seen(row)
+                    key = ReportOutbox.key(row)
+                    if key in in_outbox:
+                        # Se reintenta desde la bandeja: la marca de agua no lo sobrepasa
+                        report_scanner.row_pending(row)
+                        continue
+                    if report is None:
+                        continue
                     report_copy = {k: v for k, v in report.items() if k != 'cola'}
-                    report_json = json.dumps(report_copy, ensure_ascii=False)
 
                     report_to_log = report_copy.copy()
                     if 'datos' in report_to_log:
@@ -115,32 +328,25 @@ def process_reports(connection, channel):
                         f"JSON enviado a IGEO - {report['codigoEntidadIgeo']}: {report_json_log}"
                     )
 
-                    if not channel.is_open:
-                        database.logdb("EXCEPTION", "Canal cerrado, no se pudo enviar informe", report['codigoEntidadIgeo'], True)
-                        channel = connection.channel()
-                        channel.confirm_delivery()                        
-
-                    for attempt in range(3):  # Hasta 3 intentos
-                        try:
-                            if not channel.is_open:
-                                raise Exception("Canal cerrado")
-
-                            channel.basic_publish(
-                                exchange='analiticasRealizadas_exchange',
-                                routing_key=queue,
-                                body=report_json.encode('utf8'),
-                                properties=pika.BasicProperties(delivery_mode=2),
-                                mandatory=True
-                            )
-                            database.mark_sample_sent(report['codigoEntidadIgeo'])
-                            database.logdb("OK", "Informe enviado", report['codigoEntidadIgeo'], True)
-                            break  # Éxito, salir del bucle de reintentos
-                        
-                        except Exception as e:
-                            logging.warning(f"Intento {attempt+1} fallido al enviar informe {report['codigoEntidadIgeo']}: {e}")
-                            time.sleep(2)
-                            if attempt == 2:  # último intento
-                                database.logdb("EXCEPTION", f"Excepción al enviar informe {report['codigoEntidadIgeo']}: {str(e)}", report['codigoEntidadIgeo'], True)
+                    entry = {
+                        'row': row,
+                        'key': key,
+                        'signature': ReportOutbox.signature(row),
+                        'operation': (row['OPE1DEL'], row['OPE1SER'], row['OPE1COD']),
+                        'document': (row['INF1DEL'], row['INF1SER'], row['INF1COD']),
+                        'reference': report['codigoEntidadIgeo'],
+                        'queue': report.get('cola'),  # or 'analiticasRealizadas'
+                        'body': encode_report(report_copy),
+                        'attempts': report_outbox.attempts(key) + 1,
+                    }
+                    # Solo se conserva el cuerpo serializado hasta su confirmación
+                    report = report_copy = report_to_log = report_json_log = None
+                    publish_report(database, publisher, in_flight, confirmed, entry)
+                wait_reports(database, publisher, in_flight, confirmed)
+            finally:
+                release_reports(database, publisher, in_flight, confirmed, "Informe sin confirmar por el broker")
+            if scan:
+                report_scanner.finish(database)
 
         logging.debug("Procesando informes ...")
 
@@ -152,135 +358,405 @@ def process_reports(connection, channel):
             database.close()
 
 
-def listener_receive(channel, database):
-    # Escucha la cola analiticasRecibidas
-    def callback(ch, method, properties, body):
+def retry_reports(publisher):
+    # Reintenta los informes de la bandeja de salida cuyo backoff ha vencido, fuera
+    # del ciclo de búsqueda de informes.
+    database = None
+    in_flight = {}
+    confirmed = []
+    try:
+        database = open_database()
+        if database.connection is None:
+            return
+        # Las operaciones que ya no están pendientes (enviadas o borradas) salen de la bandeja
+        dropped = report_outbox.prune(database.pending_operations(report_outbox.operations()))
+        if dropped:
+            logging.info(f"{dropped} informe(s) de la bandeja ya no están pendientes; se descartan")
         try:
-            process_received(body, database)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except Exception as e:
-            logging.error(f"Error al procesar mensaje en analiticasRecibidas: {e}")            
+            for item in report_outbox.due():
+                logging.info(f"Reintentando informe a IGEO desde la bandeja: {item['reference']} (intento {item['attempts'] + 1})")
+                entry = dict(item, row=None, body=report_outbox.body(item), attempts=item['attempts'] + 1)
+                publish_report(database, publisher, in_flight, confirmed, entry)
+            wait_reports(database, publisher, in_flight, confirmed)
+        finally:
+            release_reports(database, publisher, in_flight, confirmed, "Reintento sin confirmar por el broker")
+        report_outbox.log_stats()
+    except Exception as e:
+        logging.error(f"Error al reintentar informes de la bandeja: {e}")
+    finally:
+        if database is not None:
+            database.close()
 
-    def on_cancel_callback(method_frame):
-        logging.warning(f"Consumidor cancelado en analiticasRecibidas: {method_frame}")
 
-    channel.basic_qos(prefetch_count=50)
-    channel.basic_consume(queue='analiticasRecibidas', on_message_callback=callback, auto_ack=False)
-    channel.add_on_cancel_callback(on_cancel_callback)
+def publish_report(database, publisher, in_flight, confirmed, entry):
+    # Publica un informe y atiende los resultados que ya hayan llegado
+    in_flight[entry['key']] = entry
+    report_scanner.track_memory(sum(len(e['body']) for e in in_flight.values()))
+    publisher.publish(entry['key'], entry['queue'], entry['body'])
+    handle_report_results(database, in_flight, confirmed, publisher.poll())
 
-    logging.info("Esperando muestras ...")
-    while not stop_event.is_set():
-        try:
-            channel.connection.process_data_events(time_limit=1)  # Reemplaza start_consuming
-        except Exception as e:
-            if stop_event.is_set():
+
+def wait_reports(database, publisher, in_flight, confirmed):
+    # Espera las confirmaciones de lo que queda en vuelo
+    waited = 0
+    while in_flight and waited < REPORT_CONFIRM_TIMEOUT:
+        results = publisher.wait(timeout=1)
+        if results:
+            waited = 0
+        else:
+            waited += 1
+            if not publisher.is_open and publisher.in_flight == 0:
                 break
-            # Conexión perdida (p.ej. heartbeat por inactividad). Salimos para que
-            # systemd (Restart=always) reinicie el servicio y reconecte.
-            logging.error(f"Conexión perdida en analiticasRecibidas, reiniciando servicio: {e}")
-            os._exit(1)
+        handle_report_results(database, in_flight, confirmed, results)
+
+
+def release_reports(database, publisher, in_flight, confirmed, reason):
+    # Lo que ya confirmó el broker se marca aunque el ciclo se corte; el resto pasa
+    # a la bandeja de salida.
+    handle_report_results(database, in_flight, confirmed, publisher.poll())
+    mark_reports_sent(database, confirmed, force=True)
+    for entry in in_flight.values():
+        report_failed(database, entry, reason)
+    in_flight.clear()
+
+
+def handle_report_results(database, in_flight, confirmed, results):
+    # Aplica los resultados del publicador: confirmado -> se acumula para marcar la
+    # operación como enviada; rechazado o devuelto -> a la bandeja de salida.
+    for key, ok, reason in results:
+        entry = in_flight.pop(key, None)
+        if entry is None:
+            continue
+        if ok:
+            entry['confirmed_at'] = time.monotonic()
+            confirmed.append(entry)
+        else:
+            report_failed(database, entry, reason)
+    mark_reports_sent(database, confirmed)
 
 
-def listener_perform(channel, database):
-    # Escucha la cola resultadoAnaliticasRealizadas
-    def callback(ch, method, properties, body):
+def mark_reports_sent(database, confirmed, force=False):
+    # Marca como enviadas las operaciones de los informes confirmados: en una sola
+    # transacción (UPDATE ... IN y líneas de IGELOG en bloque) cada VEOLAB_STATE_BATCH
+    # informes o cuando el más antiguo lleva VEOLAB_STATE_BATCH_MS esperando.
+    if not confirmed:
+        return
+    if not force and len(confirmed) < STATE_BATCH and time.monotonic() - confirmed[0]['confirmed_at'] < STATE_BATCH_WAIT:
+        return
+    entries = confirmed[:]
+    del confirmed[:]
+    database.begin_batch()
+    try:
+        database.mark_samples_sent(entry['reference'] for entry in entries)
         try:
-            process_performed(body, database)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            # INFCJSO solo de lo publicado y solo si cambia (un reintento no lo reescribe)
+            database.save_reports_json([(entry.get('document'), entry['body']) for entry in entries])
+        except pymysql.OperationalError:
+            # Un deadlock deshace también el cambio de estado: falla el lote entero
+            raise
         except Exception as e:
-            logging.error(f"Error al procesar mensaje en resultadoAnaliticasRealizadas: {e}")   
+            logging.warning(f"No se pudo guardar INFCJSO de {len(entries)} informe(s): {e}")
+        for entry in entries:
+            database.logdb("OK", "Informe enviado", entry['reference'])
+        database.commit_batch()
+    except Exception as e:
+        database.rollback_batch()
+        # Siguen pendientes en LABOPE: se volverán a enviar en un próximo ciclo
+        logging.error(f"No se pudieron marcar {len(entries)} informe(s) como enviados: {e}")
+        for entry in entries:
+            if entry['row'] is not None:
+                report_scanner.row_pending(entry['row'])
+        return
+    for entry in entries:
+        report_outbox.remove(entry['key'])
+        if entry['row'] is not None:
+            report_scanner.row_published(entry['row'])
+
+
+def report_failed(database, entry, reason):
+    report_outbox.add(entry, entry['body'], reason)
+    database.logdb("EXCEPTION", f"Excepción al enviar informe {entry['reference']}: {reason}", entry['reference'], True)
+    if entry['row'] is not None:
+        report_scanner.row_pending(entry['row'])
+
+
+def listener_receive(channel, database, generation):
+    # Escucha la cola analiticasRecibidas. Los mensajes se procesan en un pool de
+    # VEOLAB_WORKERS hilos (cada uno con su conexión MySQL), repartidos por muestra
+    # para conservar el orden CREATE -> UPDATE -> DELETE de cada una. Con
+    # VEOLAB_BATCH_SIZE > 1 cada hilo agrupa hasta ese número de mensajes (o los
+    # que lleguen en VEOLAB_BATCH_MS) y los aplica en una sola transacción.
+    # Devuelve el motivo por el que deja de escuchar (ver serve_channel).
+    workers = settings.env_int('VEOLAB_WORKERS', 1, minimum=1)
+    batch_size = min(settings.env_int('VEOLAB_BATCH_SIZE', 1, minimum=1), PREFETCH_COUNT)
+    pool = ShardedWorkerPool(
+        "analiticasRecibidas",
+        channel.connection,
+        channel,
+        process_received,
+        open_database,
+        size=workers,
+        batch_handler=process_received_batch,
+        batch_size=batch_size,
+        batch_wait=settings.env_int('VEOLAB_BATCH_MS', 200, minimum=0) / 1000,
+        databases=[database],
+        max_pending=HANDOFF_MAX,
+        max_bytes=HANDOFF_BYTES,
+        controller=prefetch_controller("analiticasRecibidas", workers, batch_size)
+    )
+    pool.start()
+
+    def callback(ch, method, properties, body):
+        note_first_message("analiticasRecibidas")
+        pool.submit(method.delivery_tag, body)
+
+    def on_cancel_callback(method_frame):
+        logging.warning(f"Consumidor cancelado en analiticasRecibidas: {method_frame}")
+
+    try:
+        pool.set_prefetch(pool.controller.prefetch)
+        pool.consume('analiticasRecibidas', callback)
+        channel.add_on_cancel_callback(on_cancel_callback)
+
+        if pool.batch_size > 1:
+            logging.info(f"Modo lote activo en analiticasRecibidas: hasta {pool.batch_size} mensajes o {int(pool.batch_wait * 1000)} ms")
+        logging.info("Esperando muestras ...")
+        return serve_channel(channel, "analiticasRecibidas", pool, generation)
+    finally:
+        pool.stop()
+
+
+def listener_perform(channel, database, generation):
+    # Escucha la cola resultadoAnaliticasRealizadas. Los resultados se agrupan (hasta
+    # VEOLAB_STATE_BATCH o los que lleguen en VEOLAB_STATE_BATCH_MS) y se aplican en
+    # una transacción fuera del hilo de la conexión; se confirman tras el commit.
+    batch_size = min(STATE_BATCH, PREFETCH_COUNT)
+    pool = ShardedWorkerPool(
+        "resultadoAnaliticasRealizadas",
+        channel.connection,
+        channel,
+        process_performed,
+        open_database,
+        batch_handler=process_performed_batch,
+        batch_size=batch_size,
+        batch_wait=STATE_BATCH_WAIT,
+        databases=[database],
+        max_pending=HANDOFF_MAX,
+        max_bytes=HANDOFF_BYTES,
+        controller=prefetch_controller("resultadoAnaliticasRealizadas", 1, batch_size)
+    )
+    pool.start()
+
+    def callback(ch, method, properties, body):
+        note_first_message("resultadoAnaliticasRealizadas")
+        pool.submit(method.delivery_tag, body)
 
     def on_cancel_callback(method_frame):
         logging.warning(f"Consumidor cancelado en resultadoAnaliticasRealizadas: {method_frame}")
 
-    channel.basic_qos(prefetch_count=50)
-    channel.basic_consume(queue='resultadoAnaliticasRealizadas', on_message_callback=callback, auto_ack=False)
-    channel.add_on_cancel_callback(on_cancel_callback)
-    
-    logging.info("Esperando resultados ...")
+    try:
+        pool.set_prefetch(pool.controller.prefetch)
+        pool.consume('resultadoAnaliticasRealizadas', callback)
+        channel.add_on_cancel_callback(on_cancel_callback)
+
+        logging.info("Esperando resultados ...")
+        return serve_channel(channel, "resultadoAnaliticasRealizadas", pool, generation)
+    finally:
+        pool.stop()
+
+
+def prefetch_controller(queue, workers, batch_size):
+    # Prefetch adaptativo entre VEOLAB_PREFETCH_MIN y VEOLAB_PREFETCH_MAX (sin pasar
+    # del límite de traspaso); con MySQL caído se pausa el consumo.
+    return PrefetchController(
+        queue,
+        initial=PREFETCH_COUNT,
+        minimum=PREFETCH_MIN,
+        maximum=min(PREFETCH_MAX, HANDOFF_MAX),
+        buffer=PREFETCH_BUFFER,
+        workers=workers,
+        batch_size=batch_size,
+        circuit=lambda: database_pool.circuit_open
+    )
+
+
+def serve_channel(channel, queue, pool, generation):
+    # Atiende la conexión de un escuchador hasta la parada del servicio ("stop"), un
+    # cambio de configuración de RabbitMQ ("config") o la caída de la conexión
+    # ("lost"). Salvo en una caída, antes de volver deja de recibir, termina los
+    # mensajes ya entregados al pool y envía sus confirmaciones, para que el broker
+    # no tenga que reentregarlos. Mientras el pool termina se siguen atendiendo los
+    # eventos de la conexión (heartbeats incluidos).
+    reason = "stop"
+    try:
+        while not stop_event.is_set():
+            if rabbit_state[0] != generation:
+                reason = "config"
+                break
+            channel.connection.process_data_events(time_limit=1)  # Reemplaza start_consuming
+            pool.regulate()
+    except Exception as e:
+        if not stop_event.is_set():
+            # Conexión perdida (p.ej. heartbeat por inactividad): se reconecta
+            logging.error(f"Conexión perdida en {queue}: {e}")
+            reason = "lost"
+    if reason != "lost":
+        try:
+            pool.cancel()
+            pool.request_stop()
+            deadline = time.monotonic() + 30
+            while pool.busy and time.monotonic() < deadline:
+                channel.connection.process_data_events(time_limit=0.2)
+            channel.connection.process_data_events(time_limit=0)
+        except Exception as e:
+            logging.warning(f"No se pudieron confirmar los últimos mensajes de {queue}; se reentregarán: {e}")
+    return reason
+
+
+def consume(queue, listener, announce=False):
+    # Mantiene el escuchador de queue dentro del proceso: si su conexión cae o cambia
+    # la configuración de RabbitMQ (ACCPAR), se rehace solo esa conexión; el pool de
+    # MySQL, las cachés y el resto de conexiones siguen como estaban.
+    lost_at = None
     while not stop_event.is_set():
+        database = open_database()  # Para los avisos en IGELOG; luego, para el escuchador
+        connection, generation, config = connect_rabbit(queue, database)
+        if connection is None:
+            database.close()
+            break
+        if lost_at is not None:
+            logging.info(f"Reconectado a RabbitMQ ({queue}) en {time.monotonic() - lost_at:.2f}s")
+        if announce:
+            notify_db(database, "OK", "Servicio conectado a RabbitMQ", config.get('PARCIGV', ''))
+        reason = "lost"
         try:
-            channel.connection.process_data_events(time_limit=1)
+            channel = connection.channel()
+            channel.add_on_cancel_callback(lambda method_frame: logging.warning(f"Canal {queue} cancelado: {method_frame}"))
+            # Desde aquí la conexión MySQL es del escuchador: su pool de hilos la
+            # devuelve al terminar, también si el escuchador falla.
+            listener_database, database = database, None
+            reason = listener(channel, listener_database, generation)
         except Exception as e:
-            if stop_event.is_set():
-                break
-            # Conexión perdida. Salimos para que systemd reinicie y reconecte.
-            logging.error(f"Conexión perdida en resultadoAnaliticasRealizadas, reiniciando servicio: {e}")
-            os._exit(1)
+            logging.error(f"Error en el escuchador de {queue}: {e}")
+        finally:
+            if database is not None:
+                database.close()
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+        if reason == "stop":
+            break
+        lost_at = time.monotonic()
+        if reason == "config":
+            logging.info(f"Reconectando {queue} con la nueva configuración de RabbitMQ")
+        else:
+            stop_event.wait(1)
 
-def process_reports_loop():
-    database = DatabaseVeolab()
-    database.open()
-    rb_config = database.get_rabbit_config() if database.connection else None
-    database.close()
 
-    if not rb_config or not is_valid_rabbit_config(rb_config):
-        logging.error("Configuración RabbitMQ inválida. No se puede iniciar el bucle de informes.")
-        return
+def rabbit_parameters(config):
+    # Parámetros de conexión a RabbitMQ a partir de ACCPAR
+    return pika.ConnectionParameters(
+        host=config['PARCIGI'],
+        port=config['PARCIGP'],
+        virtual_host=config['PARCIGV'],
+        credentials=pika.PlainCredentials(config['PARCIGU'], config['PARCIGC']),
+        heartbeat=30,
+        blocked_connection_timeout=300
+    )
 
-    seconds = int(rb_config.get('PARNSEC', 60))
-    if seconds <= 0:
-        seconds = 60
 
-    connection = None
-    channel = None
+def set_rabbit_config(config):
+    # Publica una nueva configuración de RabbitMQ; los escuchadores y el publicador
+    # de informes se reconectan al ver que cambia la generación.
+    global rabbit_state
+    rabbit_state = (rabbit_state[0] + 1, config)
+
+
+def process_reports_loop():
+    publisher = None
+    publisher_generation = None
+    lost_at = None
 
     while not stop_event.is_set():
+        generation, rb_config = rabbit_state
+        seconds = int(rb_config.get('PARNSEC') or 60)
+        if seconds <= 0:
+            seconds = 60
         try:
-            if not connection or connection.is_closed:
+            if publisher is not None and publisher_generation != generation:
+                logging.info("Configuración RabbitMQ cambiada: se rehace la conexión de informes.")
+                publisher.stop()
+                publisher = None
+                lost_at = time.monotonic()
+            if publisher is None or not publisher.is_open:
+                if publisher is not None:
+                    publisher.stop()
+                    lost_at = lost_at or time.monotonic()
                 logging.info("Creando nueva conexión RabbitMQ para informes.")
-                connection = pika.BlockingConnection(pika.ConnectionParameters(
-                    host=rb_config['PARCIGI'],
-                    port=rb_config['PARCIGP'],
-                    virtual_host=rb_config['PARCIGV'],
-                    credentials=pika.PlainCredentials(rb_config['PARCIGU'], rb_config['PARCIGC']),
-                    heartbeat=30,
-                    blocked_connection_timeout=300
-                ))
-                channel = connection.channel()
-                channel.confirm_delivery()
+                # El publicador atiende su conexión (y los heartbeats) en su propio hilo
+                publisher = ConfirmedPublisher(
+                    rabbit_parameters(rb_config),
+                    'analiticasRealizadas_exchange',
+                    window=PUBLISH_WINDOW
+                )
+                publisher_generation = generation
+                publisher.start()
                 logging.info("Canal RabbitMQ creado correctamente.")
+                if lost_at is not None:
+                    logging.info(f"Reconectado a RabbitMQ (informes) en {time.monotonic() - lost_at:.2f}s")
+                    lost_at = None
 
-            process_reports(connection, channel)
+            process_reports(publisher)
         except Exception as e:
             logging.error(f"Error en el bucle de informes: {e}")
 
-        # Espera entre ciclos atendiendo la conexión (heartbeats), para que el
-        # broker no la cierre por inactividad y el siguiente envío no se resetee.
-        deadline = time.time() + seconds
-        while not stop_event.is_set() and time.time() < deadline:
-            try:
-                if connection is not None and connection.is_open:
-                    connection.process_data_events(time_limit=1)
-                else:
-                    stop_event.wait(1)
-            except Exception as e:
-                logging.warning(f"Conexión de informes perdida durante la espera: {e}")
+        # Espera entre ciclos, atendiendo entretanto los reintentos de la bandeja
+        deadline = time.monotonic() + seconds
+        while not stop_event.is_set() and rabbit_state[0] == generation:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 break
+            retry_in = report_outbox.next_retry()
+            if retry_in is not None and retry_in <= 0 and publisher is not None and publisher.is_open:
+                retry_reports(publisher)
+                stop_event.wait(1)
+                continue
+            stop_event.wait(min(remaining, retry_in, 1) if retry_in is not None else min(remaining, 1))
 
-    if connection and not connection.is_closed:
-        connection.close()
+    if publisher is not None:
+        publisher.stop()
 
 def hash_config(config):
-    config_string = ''.join([config.get(k, '') for k in ['PARCIGU', 'PARCIGC', 'PARCIGI', 'PARCIGP', 'PARCIGV']])
+    config_string = ''.join([str(config.get(k) or '') for k in ['PARCIGU', 'PARCIGC', 'PARCIGI', 'PARCIGP', 'PARCIGV']])
     return hashlib.sha256(config_string.encode()).hexdigest()
 
-def monitor_config_changes(initial_hash):
-    while not stop_event.is_set():
-        try:
-            db = DatabaseVeolab()
-            db.open()
-            if db.connection is not None:
-                new_config = db.get_rabbit_config()
-                new_hash = hash_config(new_config)
-                if new_hash != initial_hash:
-                    logging.info("Cambio detectado en configuración Rabbit. Reiniciando servicio...")
-                    os._exit(1)
-        except Exception as e:
-            logging.error(f"Error al comprobar cambios en configuración: {e}")
-        finally:
+def monitor_config_changes():
+    # Comprueba cada minuto la configuración de RabbitMQ en ACCPAR; si cambia, la
+    # publica para que se reconecten solo las conexiones a RabbitMQ.
+    while not stop_event.wait(60):
+        check_rabbit_config()
+
+def check_rabbit_config():
+    # Lee ACCPAR y publica la configuración de RabbitMQ si ha cambiado. Devuelve True en ese caso.
+    db = None
+    try:
+        db = open_database()
+        if db.connection is not None:
+            new_config = db.get_rabbit_config()
+            if new_config and hash_config(new_config) != hash_config(rabbit_state[1]):
+                if is_valid_rabbit_config(new_config):
+                    logging.info("Cambio detectado en configuración Rabbit. Reconectando con la nueva configuración...")
+                    set_rabbit_config(new_config)
+                    return True
+                logging.error("Nueva configuración RabbitMQ incompleta o inválida; se mantiene la actual.")
+    except Exception as e:
+        logging.error(f"Error al comprobar cambios en configuración: {e}")
+    finally:
+        if db is not None:
             db.close()
-        time.sleep(60)
+    return False
 
 def is_valid_rabbit_config(config):
     required_keys = ['PARCIGU', 'PARCIGC', 'PARCIGI', 'PARCIGP', 'PARCIGV']
@@ -291,20 +767,29 @@ def notify_db(database, level, text, details=""):
     # independiente de RabbitMQ, así que el cliente se entera aunque la cola esté caída.
     try:
         database.ensure_connection()
-        database.logdb(level, text, details, True)
+        database.logdb(level, text, details, True, critical=True)
     except Exception as e:
         logging.error(f"No se pudo registrar el aviso en el log de Veolab: {e}")
 
-def connect_rabbit(conn_params, role, database):
+def connect_rabbit(role, database):
     # Conecta a RabbitMQ reintentando indefinidamente con backoff (5s..60s).
+    # Cada intento usa la configuración vigente (rabbit_state): si ACCPAR cambia
+    # mientras RabbitMQ no responde, el siguiente intento ya va al nuevo destino.
     # Avisa en IGELOG al primer fallo y luego, como mucho, una vez por hora
-    # mientras siga caído. Devuelve la conexión, o None si se pide parada.
+    # mientras siga caído. Devuelve (conexión, generación, configuración) con la
+    # que se conectó, o (None, None, None) si se pide parada.
     first_failure = None
     last_notified = 0.0
     backoff = 5
+    last_generation = None
     while not stop_event.is_set():
+        generation, config = rabbit_state
+        if last_generation is not None and generation != last_generation:
+            logging.info(f"Nueva configuración de RabbitMQ; reintentando ({role}) con ella")
+            backoff = 5
+        last_generation = generation
         try:
-            return pika.BlockingConnection(conn_params)
+            return pika.BlockingConnection(rabbit_parameters(config)), generation, config
         except Exception as e:
             now = time.time()
             if first_failure is None:
@@ -316,79 +801,162 @@ def connect_rabbit(conn_params, role, database):
                 notify_db(database, "WARNING", f"Sigue sin conexión con RabbitMQ ({role}) tras {horas} h", str(e))
                 last_notified = now
             logging.error(f"Error de conexión con RabbitMQ ({role}): {e}. Reintento en {backoff}s")
-            stop_event.wait(backoff)
+            deadline = time.monotonic() + backoff
+            while not stop_event.is_set() and rabbit_state[0] == generation and time.monotonic() < deadline:
+                stop_event.wait(1)
             backoff = min(backoff * 2, 60)
-    return None
+    return None, None, None
+
+def run_asyncio():
+    # VEOLAB_RUNTIME=asyncio: las dos colas, el publicador de informes y el monitor de
+    # configuración comparten un bucle asyncio y una conexión a RabbitMQ; MySQL se
+    # atiende en un pool de VEOLAB_DB_THREADS hilos.
+    workers = settings.env_int('VEOLAB_WORKERS', 1, minimum=1)
+    runtime = AsyncioRuntime(
+        lambda: rabbit_parameters(rabbit_state[1]),
+        executor_size=settings.env_int('VEOLAB_DB_THREADS', workers + 3, minimum=2),
+        on_connect=announce_connected
+    )
+    batch_size = min(settings.env_int('VEOLAB_BATCH_SIZE', 1, minimum=1), PREFETCH_COUNT)
+    runtime.consumer(
+        "analiticasRecibidas",
+        process_received,
+        open_database,
+        batch_handler=process_received_batch,
+        shards=workers,
+        batch_size=batch_size,
+        batch_wait=settings.env_int('VEOLAB_BATCH_MS', 200, minimum=0) / 1000,
+        prefetch=PREFETCH_COUNT,
+        on_delivery=lambda method, body: note_first_message("analiticasRecibidas"),
+        max_pending=HANDOFF_MAX,
+        max_bytes=HANDOFF_BYTES,
+        controller=prefetch_controller("analiticasRecibidas", workers, batch_size)
+    )
+    runtime.consumer(
+        "resultadoAnaliticasRealizadas",
+        process_performed,
+        open_database,
+        batch_handler=process_performed_batch,
+        batch_size=min(STATE_BATCH, PREFETCH_COUNT),
+        batch_wait=STATE_BATCH_WAIT,
+        prefetch=PREFETCH_COUNT,
+        on_delivery=lambda method, body: note_first_message("resultadoAnaliticasRealizadas"),
+        max_pending=HANDOFF_MAX,
+        max_bytes=HANDOFF_BYTES,
+        controller=prefetch_controller("resultadoAnaliticasRealizadas", 1, min(STATE_BATCH, PREFETCH_COUNT))
+    )
+    publisher = ConfirmedPublisher(None, 'analiticasRealizadas_exchange', window=PUBLISH_WINDOW)
+    runtime.publisher(publisher)
+    runtime.task(lambda runtime: reports_task(runtime, publisher))
+    runtime.task(monitor_task)
+    runtime.run(stop_event)
+
+
+def announce_connected():
+    database = open_database()
+    try:
+        notify_db(database, "OK", "Servicio conectado a RabbitMQ", rabbit_state[1].get('PARCIGV', ''))
+    finally:
+        database.close()
+
+
+async def reports_task(runtime, publisher):
+    # process_reports_loop para el runtime asyncio: el ciclo de informes corre en el
+    # executor y las esperas son temporizadores del bucle.
+    while not runtime.stopping:
+        if not publisher.is_open:
+            await runtime.sleep(1)
+            continue
+        seconds = int(rabbit_state[1].get('PARNSEC') or 60)
+        if seconds <= 0:
+            seconds = 60
+        try:
+            await runtime.run_blocking(process_reports, publisher)
+        except Exception as e:
+            logging.error(f"Error en el bucle de informes: {e}")
+
+        # Espera entre ciclos, atendiendo entretanto los reintentos de la bandeja
+        deadline = runtime.loop.time() + seconds
+        while not runtime.stopping:
+            remaining = deadline - runtime.loop.time()
+            if remaining <= 0:
+                break
+            retry_in = report_outbox.next_retry()
+            if retry_in is not None and retry_in <= 0 and publisher.is_open:
+                await runtime.run_blocking(retry_reports, publisher)
+                await runtime.sleep(1)
+                continue
+            await runtime.sleep(min(remaining, retry_in) if retry_in is not None else remaining)
+
+
+async def monitor_task(runtime):
+    # monitor_config_changes para el runtime asyncio: al cambiar ACCPAR se rehace la conexión
+    while not runtime.stopping:
+        await runtime.sleep(60)
+        if not runtime.stopping and await runtime.run_blocking(check_rabbit_config):
+            runtime.reconnect()
+
+
+def handle_stop_signal(signal_received, frame):
+    # SIGTERM (systemctl stop/restart) o SIGINT: parada ordenada, para que se vuelquen
+    # las líneas de IGELOG en memoria. Una segunda señal sale sin esperar.
+    if stop_event.is_set():
+        os._exit(1)
+    logging.info(f"Señal {signal.Signals(signal_received).name} recibida; deteniendo el servicio")
+    stop_event.set()
+
+
+def install_signal_handlers():
+    # Solo el hilo principal puede instalar manejadores de señales
+    if current_thread() is main_thread():
+        signal.signal(signal.SIGTERM, handle_stop_signal)
+        signal.signal(signal.SIGINT, handle_stop_signal)
+
 
 def run():
     thread_receive = None
     thread_perform = None
     thread_report = None    
     database = None
-    database_receive = None
-    database_perform = None
-    connection_reports = None
-    connection_receive = None
-    connection_perform = None
-    channel_receive = None
-    channel_perform = None
+    configure()
+    install_signal_handlers()
+    run_started = time.monotonic()
 
     try:
-        database = DatabaseVeolab()
-        database.open()
+        database = open_database()
         rb_config = None
         if database.connection is not None:
             rb_config = database.get_rabbit_config()
+            # IGELOG se escribe en segundo plano, en bloque y con conexión propia
+            log_writer.start(open_database)
+        database.close()
+        database = None
 
         if rb_config and is_valid_rabbit_config(rb_config):
-            credentials = pika.PlainCredentials(rb_config['PARCIGU'], rb_config['PARCIGC'])
-            conn_params = pika.ConnectionParameters(
-                host=rb_config['PARCIGI'],
-                port=rb_config['PARCIGP'],
-                virtual_host=rb_config['PARCIGV'],
-                credentials=credentials,
-                heartbeat=30,
-                blocked_connection_timeout=300)
+            set_rabbit_config(rb_config)
+
+            if RUNTIME == "asyncio":
+                run_asyncio()
+                return
 
             # Iniciar monitor de cambios de configuración
-            initial_hash = hash_config(rb_config)
-            Thread(target=monitor_config_changes, args=(initial_hash,), daemon=True).start()
+            Thread(target=monitor_config_changes, daemon=True).start()
             
-            # Inicia el escuchador para la cola analiticasRecibidas 
-            database_receive = DatabaseVeolab()
-            database_receive.open()
-            if database_receive.connection is not None:
-                connection_receive = connect_rabbit(conn_params, "analiticasRecibidas", database)
-                if connection_receive is not None:
-                    channel_receive = connection_receive.channel()
-                    channel_receive.add_on_cancel_callback(lambda method_frame: logging.warning(f"Canal analiticasRecibidas cancelado: {method_frame}"))
-                    thread_receive = Thread(target=listener_receive, args=(channel_receive, database_receive))
-                    thread_receive.start()
-                    notify_db(database, "OK", "Servicio conectado a RabbitMQ", rb_config.get('PARCIGV', ''))
-
-            # Inicia el escuchador para la cola resultadoAnaliticasRealizadas
-            database_perform = DatabaseVeolab()
-            database_perform.open()
-            if database_perform.connection is not None:
-                connection_perform = connect_rabbit(conn_params, "resultadoAnaliticasRealizadas", database)
-                if connection_perform is not None:
-                    channel_perform = connection_perform.channel()
-                    channel_perform.add_on_cancel_callback(lambda method_frame: logging.warning(f"Canal resultadoAnaliticasRealizadas cancelado: {method_frame}"))
-                    thread_perform = Thread(target=listener_perform, args=(channel_perform, database_perform))
-                    thread_perform.start()
+            # Inicia los escuchadores de analiticasRecibidas y resultadoAnaliticasRealizadas.
+            # Cada uno mantiene su conexión: si cae o cambia la configuración, reconecta.
+            thread_receive = Thread(target=consume, args=("analiticasRecibidas", listener_receive, True))
+            thread_receive.start()
+            thread_perform = Thread(target=consume, args=("resultadoAnaliticasRealizadas", listener_perform))
+            thread_perform.start()
 
             # Inicia una consulta periódica a la base de datos para procesar informes
             thread_report = Thread(target=process_reports_loop)
             thread_report.start()            
+            logging.info(f"Servicio en marcha en {time.monotonic() - run_started:.2f}s")
 
             while not stop_event.is_set():
                 time.sleep(1) 
 
-            if channel_receive is not None and channel_receive.is_open:
-                channel_receive.stop_consuming()
-            if channel_perform is not None and channel_perform.is_open:
-                channel_perform.stop_consuming()
-
             if thread_receive is not None:
                 thread_receive.join()
             if thread_perform is not None:
@@ -406,19 +974,16 @@ def run():
         logging.error(f"Error inesperado: {e}")
 
     finally:
-        if connection_receive is not None and not connection_receive.is_closed:
-            connection_receive.close()
-        if connection_perform is not None and not connection_perform.is_closed:
-            connection_perform.close()
-        if connection_reports is not None and not connection_reports.is_closed:
-            connection_reports.close()
+        # Vuelca las líneas de IGELOG pendientes antes de soltar las claves
+        log_writer.stop()
+        logging.info(f"Claves técnicas: {key_allocator.stats()}")
+        logging.info(f"Índice de idempotencia: {idempotency_index.stats()}")
+        key_allocator.close()
 
         if database is not None:
             database.close()
-        if database_receive is not None:
-            database_receive.close()
-        if database_perform is not None:
-            database_perform.close()
+        logging.info(f"Pool de conexiones: {database_pool.stats()}")
+        database_pool.close()
 
 def run_with_reconnect():
     while not stop_event.is_set():
@@ -432,10 +997,5 @@ def run_with_reconnect():
             time.sleep(5)
 
 if __name__ == '__main__':
-    def handle_interrupt(signal_received, frame):
-        logging.info("Interrumpido")        
-        stop_event.set()
-        os._exit(0)
-
-    signal.signal(signal.SIGINT, handle_interrupt)   
-    run_with_reconnect()
\ No newline at end of file
+    # run() instala los manejadores de SIGTERM/SIGINT
+    run_with_reconnect()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+class ReportOutbox(object):
+    """
+    Bandeja de salida de informes que no se pudieron entregar a iGEO. Guarda el
+    mensaje ya construido, así que el reintento no vuelve a leer el PDF ni a
+    escribir INFCJSO. Cada entrada lleva la firma de la fila de origen y de la
+    versión de su contenido (resultados, autodefinibles y PDF): si cambia (p.ej.
+    se corrige un resultado o se reemite el informe), el informe se reconstruye
+    en el siguiente ciclo.
+    Los reintentos siguen un backoff exponencial propio (base_delay, 2x, ... hasta
+    max_delay), independiente del ciclo PARNSEC.
+    Con spill_dir, cada mensaje se guarda en un fichero y el índice (outbox.json)
+    se reescribe con cada cambio, de modo que la bandeja sobrevive a un reinicio y
+    se puede inspeccionar. Sin él, los mensajes quedan en memoria hasta
+    memory_limit bytes; por encima solo se guarda la firma y el informe se
+    reconstruye cuando toca reintentarlo.
+    """
+
+    def __init__(self, spill_dir=None, base_delay=10, max_delay=3600, memory_limit=64 * 1024 * 1024):
+        self.spill_dir = spill_dir
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.memory_limit = memory_limit
+        self._entries = {}  # clave -> entrada (dict)
+        self._lock = threading.Lock()
+        self._last_stats = time.monotonic()
+        if spill_dir:
+            try:
+                os.makedirs(spill_dir, exist_ok=True)
+                self.load()
+            except OSError as e:
+                logging.warning(f"No se pudo usar {spill_dir} para la bandeja de informes; se mantiene en memoria: {e}")
+                self.spill_dir = None
+
+    @staticmethod
+    def key(row):
+        # Un informe por operación e informe de Veolab
+        return "|".join(str(row[column]) for column in ('OPE1DEL', 'OPE1SER', 'OPE1COD', 'INF1DEL', 'INF1SER', 'INF1COD'))
+
+    @staticmethod
+    def signature(row):
+        # Firma de la fila de origen (cabecera de la operación, cliente, informe y su fecha
+        # de envío) y de _version, la versión del contenido que añade iter_reports
+        return hashlib.sha1(repr(sorted(row.items())).encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def should_build(self, row):
+        # False si el informe de esta fila ya está en la bandeja con la misma firma y
+        # su mensaje guardado (o aún no toca reintentarlo): el reintento lo publica
+        # desde la bandeja sin reconstruirlo.
+        with self._lock:
+            entry = self._entries.get(self.key(row))
+            if entry is None or entry['signature'] != self.signature(row):
+                return True
+            return not self.has_body(entry) and entry['next_retry'] <= time.time()
+
+    def attempts(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['attempts'] if entry is not None else 0
+
+    def add(self, item, body, error):
+        # Registra un informe que no se pudo entregar (o su nuevo fallo). item lleva
+        # key, signature, operation, document, reference, queue y attempts (intentos hechos).
+        attempts = item['attempts']
+        delay = min(self.max_delay, self.base_delay * 2 ** max(0, attempts - 1))
+        entry = {
+            'key': item['key'],
+            'reference': item['reference'],
+            'queue': item['queue'],
+            'operation': list(item['operation']),
+            'document': list(item['document']) if item.get('document') else None,
+            'signature': item['signature'],
+            'attempts': attempts,
+            'next_retry': time.time() + delay,
+            'last_error': str(error),
+            'size': len(body) if body is not None else 0,
+            'body': None,
+            'file': None,
+        }
+        with self._lock:
+            self.discard_body(self._entries.get(entry['key']))
+            if body is not None:
+                if self.spill_dir:
+                    entry['file'] = self.write_body(entry['key'], body)
+                elif self.memory_bytes() + len(body) <= self.memory_limit:
+                    entry['body'] = body
+            self._entries[entry['key']] = entry
+            self.save()
+        logging.warning(
+            f"Informe {entry['reference']} en la bandeja de salida (intento {attempts}, "
+            f"reintento en {delay:.0f}s): {error}"
+        )
+
+    def remove(self, key):
+        with self._lock:
+            self.discard_body(self._entries.pop(key, None))
+            self.save()
+
+    def operations(self):
+        with self._lock:
+            return {tuple(entry['operation']) for entry in self._entries.values()}
+
+    def prune(self, pending_operations):
+        # Descarta las entradas cuya operación ya no está pendiente de enviar
+        # (enviada por otra vía, borrada...)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if tuple(entry['operation']) not in pending_operations]
+            for key in stale:
+                self.discard_body(self._entries.pop(key))
+            if stale:
+                self.save()
+        return len(stale)
+
+    def due(self):
+        # Entradas con mensaje guardado cuyo reintento ya toca
+        now = time.time()
+        with self._lock:
+            return [dict(entry) for entry in self._entries.values() if entry['next_retry'] <= now and self.has_body(entry)]
+
+    def next_retry(self):
+        # Segundos hasta el próximo reintento (None si no hay ninguno programado)
+        with self._lock:
+            retries = [entry['next_retry'] for entry in self._entries.values() if self.has_body(entry)]
+        return max(0, min(retries) - time.time()) if retries else None
+
+    def body(self, entry):
+        if entry['body'] is not None:
+            return entry['body']
+        with open(entry['file'], 'rb') as f:
+            return f.read()
+
+    def snapshot(self):
+        # Estado inspeccionable de la bandeja: intentos, próximo reintento y último error
+        with self._lock:
+            return [
+                {
+                    'reference': entry['reference'],
+                    'key': entry['key'],
+                    'attempts': entry['attempts'],
+                    'next_retry': datetime.fromtimestamp(entry['next_retry']).isoformat(timespec='seconds'),
+                    'last_error': entry['last_error'],
+                    'size': entry['size'],
+                    'stored': 'file' if entry['file'] else ('memory' if entry['body'] is not None else 'rebuild'),
+                }
+                for entry in sorted(self._entries.values(), key=lambda entry: entry['next_retry'])
+            ]
+
+    def log_stats(self):
+        now = time.monotonic()
+        if self._entries and now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Bandeja de informes: {self.snapshot()}")
+
+    # Almacenamiento (con el lock tomado)
+
+    def has_body(self, entry):
+        return entry['body'] is not None or entry['file'] is not None
+
+    def memory_bytes(self):
+        return sum(len(entry['body']) for entry in self._entries.values() if entry['body'] is not None)
+
+    def write_body(self, key, body):
+        path = os.path.join(self.spill_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".json")
+        try:
+            with open(path, "wb") as f:
+                f.write(body)
+            return path
+        except OSError as e:
+            logging.warning(f"No se pudo guardar el informe en la bandeja ({path}); se reconstruirá: {e}")
+            return None
+
+    def discard_body(self, entry):
+        if entry is not None and entry['file']:
+            try:
+                os.remove(entry['file'])
+            except OSError:
+                pass
+
+    def save(self):
+        if not self.spill_dir:
+            return
+        index = [{k: v for k, v in entry.items() if k != 'body'} for entry in self._entries.values()]
+        path = os.path.join(self.spill_dir, "outbox.json")
+        try:
+            with open(path + ".tmp", "w", encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, indent=2, default=str)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar el índice de la bandeja de informes: {e}")
+
+    def load(self):
+        path = os.path.join(self.spill_dir, "outbox.json")
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                for entry in json.load(f):
+                    if entry.get('file') and not os.path.exists(entry['file']):
+                        entry['file'] = None
+                    entry['body'] = None
+                    self._entries[entry['key']] = entry
+            if self._entries:
+                logging.info(f"Bandeja de informes recuperada: {len(self._entries)} pendientes")
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"No se pudo leer la bandeja de informes ({path}): {e}")
@@ -0,0 +1,231 @@
+import logging
+import queue
+import threading
+from functools import partial
+import pika
+
+class ConfirmedPublisher(object):
+    """
+    Publica en RabbitMQ con confirmaciones del broker sin esperar a cada una:
+    mantiene hasta `window` mensajes sin confirmar en vuelo y empareja los
+    ack/nack por delivery tag. Usa su propia SelectConnection, atendida por un
+    hilo de E/S (que también mantiene los heartbeats); publish() se llama desde
+    otro hilo y solo se bloquea cuando la ventana está llena.
+    Cada mensaje se publica con mandatory=True: si el broker lo devuelve
+    (Basic.Return, p.ej. cola inexistente) el resultado es un fallo aunque luego
+    llegue su ack. Los resultados se recogen con poll() / flush() como tuplas
+    (clave, ok, motivo).
+    Con attach() usa en cambio un canal de una conexión ajena ya abierta (la del
+    runtime asyncio), sin hilo propio.
+    """
+
+    def __init__(self, parameters, exchange, window=10, name="informes"):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.window = max(1, window)
+        self.name = name
+        self._connection = None
+        self._channel = None
+        self._thread = None
+        self._owned = True  # La conexión es propia (start) o ajena (attach)
+        self._call = None  # Programa una llamada en el hilo de E/S
+        self._ready = threading.Event()
+        self._closed = threading.Event()
+        self._error = None
+        self._slots = threading.Condition()
+        self._in_flight = 0
+        self._results = queue.Queue()
+        self._next_tag = 0  # Solo se usa en el hilo de E/S
+        self._pending = {}  # delivery tag -> clave (hilo de E/S)
+        self._returned = {}  # delivery tag -> motivo de la devolución (hilo de E/S)
+
+    @property
+    def is_open(self):
+        return self._ready.is_set() and not self._closed.is_set()
+
+    @property
+    def in_flight(self):
+        with self._slots:
+            return self._in_flight
+
+    def start(self, timeout=30):
+        # Abre la conexión y el canal en modo confirmación; lanza excepción si no se
+        # consigue en timeout segundos.
+        self._connection = pika.SelectConnection(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_error,
+            on_close_callback=self._on_connection_closed
+        )
+        self._call = self._connection.ioloop.add_callback_threadsafe
+        self._thread = threading.Thread(target=self._connection.ioloop.start, name=f"publisher-{self.name}", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout) or self._closed.is_set():
+            self.stop()
+            raise pika.exceptions.AMQPConnectionError(self._error or "Tiempo de espera agotado al abrir el canal")
+        logging.info(f"Publicador de {self.name} listo (hasta {self.window} mensajes sin confirmar)")
+
+    def attach(self, connection, call_threadsafe):
+        # Abre el canal en una conexión ya abierta que atiende otro (se llama desde su
+        # hilo); call_threadsafe(callback) programa una llamada en ese hilo. Se puede
+        # volver a llamar tras una reconexión.
+        self._connection = connection
+        self._owned = False
+        self._call = call_threadsafe
+        self._channel = None
+        self._error = None
+        self._next_tag = 0  # Los delivery tags empiezan de nuevo en cada canal
+        self._pending = {}
+        self._returned = {}
+        with self._slots:
+            self._in_flight = 0
+        self._closed.clear()
+        self._ready.clear()
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def stop(self, timeout=10):
+        if not self._owned:
+            # Solo se cierra el canal; la conexión es de quien la abrió
+            if self._channel is not None and self._channel.is_open:
+                try:
+                    self._call(self._channel.close)
+                except Exception:
+                    pass
+            self._closed.set()
+            with self._slots:
+                self._slots.notify_all()
+            return
+        if self._connection is not None and self._thread is not None and self._thread.is_alive():
+            try:
+                self._connection.ioloop.add_callback_threadsafe(self._close)
+            except Exception:
+                pass
+            self._thread.join(timeout)
+        self._closed.set()
+
+    def publish(self, key, routing_key, body, timeout=None):
+        # Encola la publicación de body. Espera mientras la ventana está llena; si el
+        # publicador se cierra entretanto, lanza excepción.
+        with self._slots:
+            while self._in_flight >= self.window and not self._closed.is_set():
+                if not self._slots.wait(timeout):
+                    raise TimeoutError("Ventana de publicación llena")
+            if self._closed.is_set():
+                raise pika.exceptions.AMQPConnectionError(self._error or "Publicador cerrado")
+            self._in_flight += 1
+        self._call(partial(self._publish, key, routing_key, body))
+
+    def poll(self):
+        # Resultados disponibles sin esperar
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def wait(self, timeout=None):
+        # Espera al menos un resultado (o timeout) y devuelve los disponibles
+        try:
+            results = [self._results.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        return results + self.poll()
+
+    def flush(self, timeout=300):
+        # Espera a que se confirme todo lo que está en vuelo y devuelve los resultados
+        with self._slots:
+            self._slots.wait_for(lambda: self._in_flight == 0 or self._closed.is_set(), timeout)
+        return self.poll()
+
+    # Hilo de E/S
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        self._error = str(error) or repr(error)
+        self._closed.set()
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        self._error = self._error or str(reason)
+        self._fail_all(f"Conexión cerrada: {reason}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=lambda _frame: self._ready.set())
+
+    def _on_channel_closed(self, channel, reason):
+        logging.warning(f"Canal del publicador de {self.name} cerrado: {reason}")
+        self._error = str(reason)
+        self._fail_all(f"Canal cerrado: {reason}")
+        if self._owned and self._connection.is_open:
+            self._connection.close()
+
+    def _close(self):
+        if self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
+    def _publish(self, key, routing_key, body):
+        if self._channel is None or not self._channel.is_open:
+            self._done(key, False, "Canal cerrado")
+            return
+        # El broker numera los mensajes del canal al recibirlos: el tag solo avanza si
+        # basic_publish no falla, para que los ack sigan emparejándose con su clave.
+        tag = self._next_tag + 1
+        try:
+            self._channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=pika.BasicProperties(delivery_mode=2, message_id=str(tag)),
+                mandatory=True
+            )
+        except Exception as e:
+            self._done(key, False, str(e))
+            return
+        self._next_tag = tag
+        self._pending[tag] = key
+
+    def _on_return(self, channel, method, properties, body):
+        # Llega antes que el ack del mismo mensaje
+        try:
+            tag = int(properties.message_id)
+        except (TypeError, ValueError):
+            return
+        self._returned[tag] = f"Devuelto por el broker: {method.reply_code} {method.reply_text}"
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        ok = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = sorted(tag for tag in self._pending if tag <= method.delivery_tag)
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._pending else []
+        for tag in tags:
+            key = self._pending.pop(tag)
+            reason = self._returned.pop(tag, None)
+            if not ok:
+                reason = "Rechazado por el broker (nack)"
+            self._done(key, reason is None, reason)
+
+    def _fail_all(self, reason):
+        self._closed.set()
+        self._ready.set()
+        for tag in sorted(self._pending):
+            self._done(self._pending[tag], False, reason)
+        self._pending.clear()
+        self._returned.clear()
+
+    def _done(self, key, ok, reason):
+        self._results.put((key, ok, reason))
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
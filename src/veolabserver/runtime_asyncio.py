@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from .workers import ShardedWorkerPool
+
+class AsyncioRuntime(object):
+    """
+    Alternativa a un hilo y una BlockingConnection por cola (VEOLAB_RUNTIME=asyncio):
+    un solo bucle asyncio con una AsyncioConnection y un canal por consumidor y
+    por publicador. Heartbeats, entregas, confirmaciones y temporizadores los
+    atiende el bucle sin sondeos; el trabajo con MySQL (pymysql es bloqueante)
+    se ejecuta en un pool de hilos acotado (executor_size), independiente del
+    número de consumidores.
+    Si la conexión cae, o se pide con reconnect() (p.ej. cambio de ACCPAR), se
+    rehace con backoff sin salir del proceso.
+    """
+
+    def __init__(self, parameters, executor_size=4, on_connect=None):
+        self.parameters = parameters  # parameters() -> pika.ConnectionParameters, en cada conexión
+        self.executor_size = max(1, executor_size)
+        self.on_connect = on_connect  # on_connect() en el executor tras cada conexión
+        self.loop = None
+        self._executor = None
+        self._consumers = []
+        self._publishers = []
+        self._tasks = []  # factory(runtime) -> corrutina
+        self._connection = None
+        self._closed = None  # Futuro que se resuelve al cerrarse la conexión actual
+        self._stopping = None
+        self._reconnect = None
+        self.reconnects = 0
+
+    @property
+    def stopping(self):
+        return self._stopping is not None and self._stopping.is_set()
+
+    def consumer(self, queue, handler, database_factory, **options):
+        # Registra un consumidor (ver AsyncConsumer); se arranca en cada conexión
+        consumer = AsyncConsumer(self, queue, handler, database_factory, **options)
+        self._consumers.append(consumer)
+        return consumer
+
+    def publisher(self, publisher):
+        # Registra un ConfirmedPublisher que usará un canal de la conexión del bucle
+        self._publishers.append(publisher)
+
+    def task(self, factory):
+        # Registra una tarea de fondo (informes, monitor...) que vive mientras el servicio
+        self._tasks.append(factory)
+
+    async def run_blocking(self, func, *args):
+        # Ejecuta func(*args) en el executor acotado (trabajo con MySQL)
+        return await self.loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def sleep(self, seconds):
+        # Espera seconds segundos o hasta la parada del servicio
+        try:
+            await asyncio.wait_for(self._stopping.wait(), max(0, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    def reconnect(self):
+        # Pide rehacer la conexión (desde el bucle)
+        if self._reconnect is not None:
+            self._reconnect.set()
+
+    def run(self, stop_event):
+        # Bloquea hasta que se activa stop_event
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._executor = ThreadPoolExecutor(max_workers=self.executor_size, thread_name_prefix="db")
+        try:
+            self.loop.run_until_complete(self._main(stop_event))
+        finally:
+            self._executor.shutdown(wait=True)
+            self.loop.close()
+
+    async def _main(self, stop_event):
+        self._stopping = asyncio.Event()
+        # stop_event es de threading: se espera en un hilo aparte, sin sondeos
+        watcher = self.loop.run_in_executor(None, stop_event.wait)
+        watcher.add_done_callback(lambda _: self._stopping.set())
+        logging.info(f"Runtime asyncio: {len(self._consumers)} consumidor(es), {self.executor_size} hilo(s) para MySQL")
+        tasks = [self.loop.create_task(factory(self)) for factory in self._tasks]
+        backoff = 5
+        lost_at = None
+        while not self.stopping:
+            try:
+                await self._connect()
+            except Exception as e:
+                logging.error(f"Error de conexión con RabbitMQ: {e}. Reintento en {backoff}s")
+                for consumer in self._consumers:
+                    await consumer.stop(drain=False)
+                await self._disconnect()
+                await self.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            backoff = 5
+            if lost_at is not None:
+                self.reconnects += 1
+                logging.info(f"Reconectado a RabbitMQ en {time.monotonic() - lost_at:.2f}s")
+            if self.on_connect is not None:
+                try:
+                    await self.run_blocking(self.on_connect)
+                except Exception as e:
+                    logging.warning(f"Aviso de conexión no registrado: {e}")
+            reason = await self._serve()
+            lost_at = time.monotonic()
+            if reason == "stop":
+                # Los informes terminan su ciclo con el publicador aún abierto
+                await asyncio.gather(*tasks, return_exceptions=True)
+            elif reason == "lost":
+                logging.error("Conexión perdida con RabbitMQ; reconectando")
+            else:
+                logging.info("Reconectando con la nueva configuración de RabbitMQ")
+            for consumer in self._consumers:
+                await consumer.stop(drain=reason != "lost")
+            await self._disconnect()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _connect(self):
+        opened = self.loop.create_future()
+        self._closed = self.loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(pika.exceptions.AMQPConnectionError(str(error) or repr(error)))
+
+        def on_close(connection, reason):
+            if not opened.done():
+                opened.set_exception(pika.exceptions.AMQPConnectionError(str(reason)))
+            if not self._closed.done():
+                self._closed.set_result(reason)
+
+        self._connection = AsyncioConnection(
+            self.parameters(),
+            on_open_callback=on_open,
+            on_open_error_callback=on_open_error,
+            on_close_callback=on_close,
+            custom_ioloop=self.loop
+        )
+        await asyncio.wait_for(opened, 30)
+        for consumer in self._consumers:
+            await consumer.start(self._connection)
+        for publisher in self._publishers:
+            publisher.attach(self._connection, self.loop.call_soon_threadsafe)
+
+    async def _serve(self):
+        # Espera a la parada, a una petición de reconexión o a la caída de la conexión
+        self._reconnect = asyncio.Event()
+        waiters = {
+            self.loop.create_task(self._stopping.wait()): "stop",
+            self.loop.create_task(self._reconnect.wait()): "config",
+            self._closed: "lost",
+        }
+        done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            if waiter is not self._closed:
+                waiter.cancel()
+        return waiters[done.pop()]
+
+    async def _disconnect(self):
+        for publisher in self._publishers:
+            publisher.stop()
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            if connection.is_open:
+                connection.close()
+            if self._closed is not None and not self._closed.done():
+                await asyncio.wait_for(asyncio.shield(self._closed), 10)
+        except Exception as e:
+            logging.warning(f"Cierre de la conexión RabbitMQ incompleto: {e}")
+
+
+class AsyncConsumer(object):
+    """
+    Consumidor de una cola dentro de AsyncioRuntime, con el mismo reparto que
+    ShardedWorkerPool: los mensajes se reparten por muestra entre shards tareas,
+    cada una con su conexión MySQL, que los procesan en orden (de uno en uno o en
+    lotes de hasta batch_size / batch_wait) en el executor del runtime. Cada
+    mensaje se confirma al broker cuando su handler termina (o vuelve a la cola
+    con nack si lanza excepción: el handler sigue el mismo contrato que en
+    ShardedWorkerPool y debe lanzarla ante errores de base de datos).
+    on_delivery(method, body), si se indica, se llama al recibir cada mensaje.
+    Como en ShardedWorkerPool, el consumo se pausa si lo entregado sin confirmar
+    supera max_pending mensajes o max_bytes bytes, y con controller
+    (PrefetchController) el prefetch y la pausa por MySQL caído se ajustan en
+    una tarea del bucle.
+    """
+
+    def __init__(self, runtime, queue, handler, database_factory, batch_handler=None, shards=1,
+                 batch_size=1, batch_wait=0.2, prefetch=50, on_delivery=None,
+                 max_pending=200, max_bytes=32 * 1024 * 1024, retry_delay=1, controller=None):
+        self.runtime = runtime
+        self.queue = queue
+        self.handler = handler  # handler(body, database); lanza excepción si no se aplicó
+        self.batch_handler = batch_handler  # batch_handler([body, ...], database); ídem para el lote entero
+        self.database_factory = database_factory
+        self.shards = max(1, shards)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.controller = controller
+        self.prefetch = controller.prefetch if controller is not None else prefetch
+        self.on_delivery = on_delivery
+        self.max_pending = max(1, max_pending)
+        self.max_bytes = max(1, max_bytes)
+        self.retry_delay = retry_delay
+        self._channel = None
+        self._consumer_tag = None
+        self._paused = set()  # Motivos de pausa activos
+        self._pending = {}  # delivery tag -> bytes
+        self._pending_bytes = 0
+        self._service = [0.0, 0, 0, 0]  # Segundos, mensajes, fallos, fallos seguidos
+        self.pauses = 0
+        self.nacked = 0
+        self._queues = []
+        self._tasks = []
+        self._regulator = None
+
+    async def start(self, connection):
+        loop = self.runtime.loop
+        opened = loop.create_future()
+        connection.channel(on_open_callback=opened.set_result)
+        self._channel = await asyncio.wait_for(opened, 30)
+        qos = loop.create_future()
+        self._channel.basic_qos(prefetch_count=self.prefetch, callback=qos.set_result)
+        await asyncio.wait_for(qos, 30)
+        self._queues = [asyncio.Queue() for _ in range(self.shards)]
+        self._tasks = [loop.create_task(self._run(index)) for index in range(self.shards)]
+        self._pending = {}
+        self._pending_bytes = 0
+        self._paused = set()
+        self._channel.add_on_cancel_callback(lambda method_frame: logging.warning(f"Consumidor cancelado en {self.queue}: {method_frame}"))
+        self._consumer_tag = self._channel.basic_consume(self.queue, self._on_message, auto_ack=False)
+        if self.controller is not None:
+            self._regulator = loop.create_task(self._regulate())
+        logging.info(f"Esperando mensajes en {self.queue} ({self.shards} tarea(s))")
+
+    async def stop(self, drain=True):
+        # Con drain deja de recibir y termina (y confirma) lo ya entregado; si la
+        # conexión cayó, lo pendiente se descarta: el broker lo reentregará.
+        if self._channel is None:
+            return
+        if self._regulator is not None:
+            self._regulator.cancel()
+            await asyncio.gather(self._regulator, return_exceptions=True)
+            self._regulator = None
+        if drain and self._channel.is_open and self._consumer_tag is not None:
+            cancelled = self.runtime.loop.create_future()
+            try:
+                self._channel.basic_cancel(self._consumer_tag, callback=cancelled.set_result)
+                await asyncio.wait_for(cancelled, 10)
+            except Exception as e:
+                logging.warning(f"No se pudo cancelar el consumidor de {self.queue}: {e}")
+        for worker_queue in self._queues:
+            if not drain:
+                while not worker_queue.empty():
+                    worker_queue.get_nowait()
+            worker_queue.put_nowait(None)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._channel = None
+        self._consumer_tag = None
+
+    def _on_message(self, channel, method, properties, body):
+        if self.on_delivery is not None:
+            self.on_delivery(method, body)
+        self._pending[method.delivery_tag] = len(body)
+        self._pending_bytes += len(body)
+        index = zlib.crc32(ShardedWorkerPool.shard_key(body).encode('utf-8')) % self.shards
+        self._queues[index].put_nowait((method.delivery_tag, body))
+        self._update_flow()
+
+    def _pause(self, reason):
+        # Deja de recibir (basic_cancel) mientras haya algún motivo de pausa
+        if reason in self._paused:
+            return
+        self._paused.add(reason)
+        channel = self._channel
+        if self._consumer_tag is not None and channel is not None and channel.is_open:
+            channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+            self.pauses += 1
+            logging.info(f"Consumo de {self.queue} en pausa ({reason}): {len(self._pending)} mensajes sin confirmar")
+
+    def _resume(self, reason):
+        if reason not in self._paused:
+            return
+        self._paused.discard(reason)
+        channel = self._channel
+        if not self._paused and self._consumer_tag is None and channel is not None and channel.is_open:
+            self._consumer_tag = channel.basic_consume(self.queue, self._on_message, auto_ack=False)
+            logging.info(f"Consumo de {self.queue} reanudado")
+
+    def _update_flow(self):
+        # Pausa o reanuda según lo pendiente
+        if len(self._pending) >= self.max_pending or self._pending_bytes >= self.max_bytes:
+            self._pause("traspaso lleno")
+        elif len(self._pending) <= self.max_pending // 2 and self._pending_bytes <= self.max_bytes // 2:
+            self._resume("traspaso lleno")
+
+    async def _regulate(self):
+        # Aplica el PrefetchController (ver ShardedWorkerPool.regulate)
+        controller = self.controller
+        loop = self.runtime.loop
+        while True:
+            await asyncio.sleep(1)
+            channel = self._channel
+            if channel is None or not channel.is_open or not controller.due():
+                continue
+            seconds, messages, failures, failures_in_row = self._service
+            self._service = [0.0, 0, 0, failures_in_row]
+            depth = None
+            if controller.adaptive:
+                declared = loop.create_future()
+                try:
+                    channel.queue_declare(self.queue, passive=True, callback=declared.set_result)
+                    depth = (await asyncio.wait_for(declared, 10)).method.message_count
+                except Exception as e:
+                    logging.warning(f"No se pudo consultar la cola {self.queue}: {e}")
+            prefetch, paused = controller.update(seconds, messages, failures, failures_in_row, depth)
+            if paused:
+                self._pause("MySQL no disponible")
+            else:
+                self._resume("MySQL no disponible")
+            if prefetch != self.prefetch and channel.is_open:
+                # basic_qos solo se aplica a los consumidores registrados después
+                self.prefetch = prefetch
+                qos = loop.create_future()
+                channel.basic_qos(prefetch_count=prefetch, callback=qos.set_result)
+                await asyncio.wait_for(qos, 10)
+                if self._consumer_tag is not None:
+                    channel.basic_cancel(self._consumer_tag)
+                    self._consumer_tag = channel.basic_consume(self.queue, self._on_message, auto_ack=False)
+
+    def _record_service(self, seconds, messages, ok):
+        service = self._service
+        service[0] += seconds
+        service[1] += messages
+        if ok:
+            service[3] = 0
+        else:
+            service[2] += messages
+            service[3] += 1
+
+    def _settled(self, delivery_tags):
+        for delivery_tag in delivery_tags:
+            self._pending_bytes -= self._pending.pop(delivery_tag, 0)
+        self._update_flow()
+
+    def _nack(self, channel, delivery_tags):
+        if channel is self._channel:
+            self._settled(delivery_tags)
+        if not channel.is_open:
+            return
+        self.nacked += len(delivery_tags)
+        for delivery_tag in delivery_tags:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+    def _ack(self, channel, delivery_tags):
+        if channel is self._channel:
+            self._settled(delivery_tags)
+        if not channel.is_open:
+            logging.warning(f"Canal {self.queue} cerrado; {len(delivery_tags)} mensaje(s) sin confirmar se reentregarán")
+            return
+        if self.shards == 1:
+            channel.basic_ack(delivery_tag=delivery_tags[-1], multiple=True)
+        else:
+            for delivery_tag in delivery_tags:
+                channel.basic_ack(delivery_tag=delivery_tag)
+
+    async def _next_batch(self, worker_queue):
+        item = await worker_queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        if self.batch_size > 1 and self.batch_handler is not None:
+            deadline = self.runtime.loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - self.runtime.loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(worker_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    worker_queue.put_nowait(None)  # Se atiende la parada tras este lote
+                    break
+                batch.append(item)
+        return batch
+
+    async def _run(self, index):
+        channel = self._channel
+        worker_queue = self._queues[index]
+        database = await self.runtime.run_blocking(self.database_factory)
+        try:
+            while True:
+                batch = await self._next_batch(worker_queue)
+                if batch is None:
+                    break
+                bodies = [body for _, body in batch]
+                started = time.monotonic()
+                try:
+                    if len(bodies) > 1:
+                        await self.runtime.run_blocking(self.batch_handler, bodies, database)
+                    else:
+                        await self.runtime.run_blocking(self.handler, bodies[0], database)
+                except Exception as e:
+                    logging.error(f"Error al procesar mensaje en {self.queue}; se devuelve a la cola: {e}")
+                    self._record_service(time.monotonic() - started, len(bodies), False)
+                    self._nack(channel, [tag for tag, _ in batch])
+                    await self.runtime.sleep(self.retry_delay)
+                else:
+                    self._record_service(time.monotonic() - started, len(bodies), True)
+                    self._ack(channel, [tag for tag, _ in batch])
+        finally:
+            await self.runtime.run_blocking(database.close)
@@ -0,0 +1,53 @@
+import os
+from dotenv import load_dotenv
+
+# Ajustes opcionales del servicio. Se leen de variables de entorno (o del .env,
+# igual que VEOLAB_AES_KEY); si no están informadas se usa el valor por defecto,
+# que reproduce el comportamiento clásico del servicio.
+
+_dotenv_loaded = False
+
+
+def _env(name):
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        load_dotenv()
+        _dotenv_loaded = True
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return None
+    return value.strip()
+
+
+def env_int(name, default, minimum=None):
+    value = _env(name)
+    try:
+        result = int(value) if value is not None else default
+    except ValueError:
+        result = default
+    if minimum is not None and result < minimum:
+        result = minimum
+    return result
+
+
+def env_float(name, default, minimum=None):
+    value = _env(name)
+    try:
+        result = float(value) if value is not None else default
+    except ValueError:
+        result = default
+    if minimum is not None and result < minimum:
+        result = minimum
+    return result
+
+
+def env_bool(name, default=False):
+    value = _env(name)
+    if value is None:
+        return default
+    return value.lower() in ("1", "t", "true", "s", "si", "sí", "y", "yes", "on")
+
+
+def env_str(name, default=None):
+    value = _env(name)
+    return value if value is not None else default
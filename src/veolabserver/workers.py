@@ -0,0 +1,309 @@
+import json
+import logging
+import queue
+import threading
+import time
+import zlib
+from functools import partial
+from threading import Thread
+
+class ShardedWorkerPool(object):
+    """
+    Procesa los mensajes de una cola en un pool de hilos, fuera del hilo de la
+    conexión RabbitMQ, cada uno con su propia conexión a la base de datos.
+    Los mensajes se reparten por muestra (idEntidadIgeo / codigoEntidadIgeo), así
+    que CREATE -> UPDATE -> DELETE de una misma muestra se procesan en orden por
+    el mismo hilo. Las confirmaciones (ack, o nack con reentrega si el handler
+    falla) se devuelven al hilo de la conexión con add_callback_threadsafe, de
+    modo que los heartbeats siguen fluyendo aunque MySQL tarde.
+    Contrato del handler: si el mensaje no se pudo aplicar por un error de base
+    de datos (MySQL caído, deadlock...) debe deshacer lo hecho y lanzar la
+    excepción; solo así se devuelve a la cola y cuenta como fallo para el
+    circuito. Si termina sin excepción, el mensaje se confirma y el broker lo
+    olvida, aunque el handler haya registrado un error en IGELOG.
+    El traspaso está acotado: si los mensajes entregados al pool y aún sin
+    confirmar superan max_pending mensajes o max_bytes bytes, se deja de consumir
+    (basic_cancel) hasta que bajen a la mitad (basic_consume de nuevo). Lo que el
+    broker no llega a entregar se queda en la cola, no en memoria.
+    Con controller (PrefetchController) el prefetch y la pausa por MySQL caído se
+    ajustan según el tiempo de servicio medido y la cola (ver regulate).
+    """
+
+    def __init__(self, name, connection, channel, handler, database_factory, size=1,
+                 batch_handler=None, batch_size=1, batch_wait=0.2, databases=None,
+                 max_pending=200, max_bytes=32 * 1024 * 1024, retry_delay=1, controller=None):
+        self.name = name
+        self.connection = connection
+        self.channel = channel
+        self.handler = handler  # handler(body, database); lanza excepción si no se aplicó
+        self.batch_handler = batch_handler  # batch_handler([body, ...], database); ídem para el lote entero
+        self.database_factory = database_factory
+        self.size = max(1, size)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.max_pending = max(1, max_pending)
+        self.max_bytes = max(1, max_bytes)
+        self.retry_delay = retry_delay  # Pausa del hilo tras un fallo, para no reintentar en bucle
+        self.controller = controller
+        self.prefetch = None
+        # Tiempo de servicio, escrito por los hilos y leído por regulate
+        self._service_lock = threading.Lock()
+        self._service_time = 0.0
+        self._service_messages = 0
+        self._service_failures = 0
+        self._failures_in_row = 0
+        self._databases = list(databases or [])
+        self._queues = [queue.Queue() for _ in range(self.size)]
+        self._threads = []
+        self._stopping = False
+        # Estado del consumidor y del traspaso (solo en el hilo de la conexión)
+        self.queue = None
+        self._on_message = None
+        self._consumer_tag = None
+        self._paused = set()  # Motivos de pausa activos
+        self._cancelled = False
+        self._pending = {}  # delivery tag -> bytes
+        self._pending_bytes = 0
+        self._paused_at = None
+        self._last_stats = time.monotonic()
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.peak_pending = 0
+        self.nacked = 0
+
+    def start(self):
+        for index in range(self.size):
+            database = self._databases[index] if index < len(self._databases) else None
+            thread = Thread(target=self._run, args=(index, database), name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logging.info(f"Pool de {self.size} hilo(s) iniciado para {self.name}")
+
+    def stop(self, timeout=30):
+        # Pide a cada hilo que termine tras el mensaje en curso. Lo que quede en cola
+        # sin confirmar lo reentregará el broker.
+        self.request_stop()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def request_stop(self):
+        # Como stop, sin esperar a los hilos
+        if self._stopping:
+            return
+        self._stopping = True
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+
+    @property
+    def busy(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    # Consumidor y control de flujo (hilo de la conexión)
+
+    def consume(self, queue_name, on_message):
+        # basic_consume de queue_name; on_message es el callback de pika
+        self.queue = queue_name
+        self._on_message = on_message
+        self._consumer_tag = self.channel.basic_consume(queue=queue_name, on_message_callback=on_message, auto_ack=False)
+
+    def pause(self, reason):
+        # Deja de recibir mensajes mientras haya algún motivo de pausa
+        if reason in self._paused:
+            return
+        self._paused.add(reason)
+        if self._consumer_tag is not None and self.channel.is_open:
+            self.channel.basic_cancel(self._consumer_tag)
+            self._consumer_tag = None
+            self._paused_at = time.monotonic()
+            self.pauses += 1
+            logging.info(f"Consumo de {self.name} en pausa ({reason}): {len(self._pending)} mensajes, {self._pending_bytes / 1048576:.1f} MB sin confirmar")
+
+    def resume(self, reason):
+        if reason not in self._paused:
+            return
+        self._paused.discard(reason)
+        if not self._paused and not self._cancelled and self._consumer_tag is None and self.channel.is_open:
+            self.consume(self.queue, self._on_message)
+            if self._paused_at is not None:
+                paused = time.monotonic() - self._paused_at
+                self.paused_seconds += paused
+                self._paused_at = None
+                logging.info(f"Consumo de {self.name} reanudado tras {paused:.1f}s en pausa")
+
+    def cancel(self):
+        # Deja de recibir definitivamente (parada o reconexión)
+        self._cancelled = True
+        if self._consumer_tag is not None and self.channel.is_open:
+            self.channel.basic_cancel(self._consumer_tag)
+        self._consumer_tag = None
+
+    def set_prefetch(self, prefetch):
+        # basic_qos solo se aplica a los consumidores que se registran después: si
+        # ya se está consumiendo, se vuelve a registrar el consumidor.
+        self.prefetch = prefetch
+        self.channel.basic_qos(prefetch_count=prefetch)
+        if self._consumer_tag is not None and self.channel.is_open:
+            self.channel.basic_cancel(self._consumer_tag)
+            self.consume(self.queue, self._on_message)
+
+    def queue_depth(self):
+        # Mensajes en la cola del broker (queue_declare pasivo); None si no se sabe
+        try:
+            return self.channel.queue_declare(queue=self.queue, passive=True).method.message_count
+        except Exception as e:
+            logging.warning(f"No se pudo consultar la cola {self.queue}: {e}")
+            return None
+
+    def regulate(self):
+        # Aplica el PrefetchController cada controller.interval segundos
+        controller = self.controller
+        if controller is None or self._cancelled or not controller.due():
+            return
+        with self._service_lock:
+            seconds, messages, failures = self._service_time, self._service_messages, self._service_failures
+            failures_in_row = self._failures_in_row
+            self._service_time, self._service_messages, self._service_failures = 0.0, 0, 0
+        depth = self.queue_depth() if controller.adaptive else None
+        prefetch, paused = controller.update(seconds, messages, failures, failures_in_row, depth)
+        if paused:
+            self.pause("MySQL no disponible")
+        else:
+            self.resume("MySQL no disponible")
+        if prefetch != self.prefetch:
+            self.set_prefetch(prefetch)
+
+    def record_service(self, seconds, messages, ok):
+        # Llamado por los hilos tras cada mensaje o lote
+        with self._service_lock:
+            self._service_time += seconds
+            self._service_messages += messages
+            if ok:
+                self._failures_in_row = 0
+            else:
+                self._service_failures += messages
+                self._failures_in_row += 1
+
+    def update_flow(self):
+        # Pausa o reanuda el consumo según lo pendiente en el pool
+        if len(self._pending) >= self.max_pending or self._pending_bytes >= self.max_bytes:
+            self.pause("traspaso lleno")
+        elif len(self._pending) <= self.max_pending // 2 and self._pending_bytes <= self.max_bytes // 2:
+            self.resume("traspaso lleno")
+        self.log_stats()
+
+    def log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats >= 600:
+            self._last_stats = now
+            logging.info(f"Traspaso de {self.name}: {self.stats()}")
+
+    def stats(self):
+        paused = self.paused_seconds + (time.monotonic() - self._paused_at if self._paused_at is not None else 0)
+        return {
+            'prefetch': self.prefetch,
+            'pending': len(self._pending),
+            'pending_mb': round(self._pending_bytes / 1048576, 1),
+            'peak_pending': self.peak_pending,
+            'pauses': self.pauses,
+            'paused_s': round(paused, 1),
+            'nacked': self.nacked,
+        }
+
+    @staticmethod
+    def shard_key(body):
+        try:
+            json_body = json.loads(body)
+            key = json_body.get('idEntidadIgeo') or json_body.get('codigoEntidadIgeo') or ""
+        except (ValueError, AttributeError):
+            key = ""
+        return str(key)
+
+    def submit(self, delivery_tag, body):
+        # Llamado desde el hilo de la conexión (callback de basic_consume)
+        self._pending[delivery_tag] = len(body)
+        self._pending_bytes += len(body)
+        self.peak_pending = max(self.peak_pending, len(self._pending))
+        index = zlib.crc32(self.shard_key(body).encode('utf-8')) % self.size
+        self._queues[index].put((delivery_tag, body))
+        self.update_flow()
+
+    def _settled(self, delivery_tags):
+        for delivery_tag in delivery_tags:
+            self._pending_bytes -= self._pending.pop(delivery_tag, 0)
+        self.update_flow()
+
+    def _ack(self, delivery_tags):
+        # Se ejecuta en el hilo de la conexión
+        self._settled(delivery_tags)
+        if not self.channel.is_open:
+            logging.warning(f"Canal {self.name} cerrado; {len(delivery_tags)} mensaje(s) sin confirmar se reentregarán")
+            return
+        if self.size == 1:
+            # Un solo hilo procesa en orden de entrega: basta confirmar el último
+            self.channel.basic_ack(delivery_tag=delivery_tags[-1], multiple=True)
+        else:
+            for delivery_tag in delivery_tags:
+                self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _nack(self, delivery_tags):
+        # Se ejecuta en el hilo de la conexión. Los mensajes vuelven a la cola; sin esto
+        # quedarían sin confirmar hasta la reconexión (o los confirmaría el ack múltiple
+        # de un lote posterior).
+        self._settled(delivery_tags)
+        if not self.channel.is_open:
+            return
+        self.nacked += len(delivery_tags)
+        for delivery_tag in delivery_tags:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+    def _next_batch(self, worker_queue):
+        item = worker_queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        if self.batch_size > 1 and self.batch_handler is not None:
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = worker_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    worker_queue.put(None)  # Se atiende la parada tras este lote
+                    break
+                batch.append(item)
+        return batch
+
+    def _run(self, index, database):
+        if database is None:
+            database = self.database_factory()
+        worker_queue = self._queues[index]
+        try:
+            while True:
+                batch = self._next_batch(worker_queue)
+                if batch is None:
+                    break
+                bodies = [body for _, body in batch]
+                settle = self._ack
+                started = time.monotonic()
+                try:
+                    if len(bodies) > 1:
+                        self.batch_handler(bodies, database)
+                    else:
+                        self.handler(bodies[0], database)
+                except Exception as e:
+                    logging.error(f"Error al procesar mensaje en {self.name}; se devuelve a la cola: {e}")
+                    settle = self._nack
+                self.record_service(time.monotonic() - started, len(bodies), settle == self._ack)
+                try:
+                    self.connection.add_callback_threadsafe(partial(settle, [tag for tag, _ in batch]))
+                except Exception as e:
+                    # Conexión cerrada: el broker reentregará lo que quede sin confirmar
+                    logging.warning(f"No se pudo confirmar en {self.name}: {e}")
+                if settle == self._nack:
+                    time.sleep(self.retry_delay)
+        finally:
+            database.close()